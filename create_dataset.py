@@ -178,6 +178,14 @@ class ImageTextDataset(Dataset):
     def __len__(self):
         import math
         return int(math.ceil(len(self.image_filenames) / self.batch_size))
+
+    def num_samples(self):
+        """ Number of images, the length of the map-style view. """
+        return len(self.image_filenames)
+
+    def __getitem__(self, idx):
+        """ One (image, caption) sample, to be batched by MultiBlockCollator. """
+        return self.get_image(idx), self.get_text(idx)
     
     def __iter__(self):
         self.current_idx = 0
@@ -215,7 +223,13 @@ import time
 from PIL import Image
 import multiprocessing
 
-class ImageTextDatasetA100(Dataset):
+
+from src.datasets.image_shards import ImageShardStore
+from src.datasets.preprocess import ImageLoaderMixin, preprocess_images, save_tensor_files, save_to_shards
+from src.datasets.prefetch import prefetch
+from src.transforms import images_to_float
+
+class ImageTextDatasetA100(ImageLoaderMixin, Dataset):
     def __init__(
         self, 
         image_path, 
@@ -230,12 +244,21 @@ class ImageTextDatasetA100(Dataset):
         max=None,
         transform=None, 
         tensor_folder=None,
+        feature_store=None,
+        shard_folder=None,
+        storage_dtype='float32',
+        normalization=None,
+        prefetch_depth=0,
+        prefetch_workers=2,
+        mask_bank=None,
+        n_views=1,
     ):
         self.batch_size = batch_size
         self.img_size = img_size
         self.patch_size = patch_size
         self.device = device
         self.max=max
+        self.feature_store = feature_store # FeatureStore of frozen vision encoder outputs, see src/datasets/feature_store.py
 
         # Ensure img_size is divisible by patch_size
         assert img_size % patch_size == 0, f"img_size {img_size} is not divisible by patch_size {patch_size}"
@@ -257,52 +280,99 @@ class ImageTextDatasetA100(Dataset):
         self.transform = transform
         self.tensor_folder = tensor_folder
         self.image_path = image_path
+        self.shard_folder = shard_folder # ImageShardStore folder, replaces the one-.pt-per-image tensor_folder
+        self.shard_store = None
+        self.storage_dtype = storage_dtype # 'uint8' stores raw pixels, converted to float per batch on device
+        self.normalization = normalization # Optional ((mean), (std)) applied after the float conversion
+        self.prefetch_depth = prefetch_depth # Number of batches prepared ahead in background threads, 0 disables prefetching
+        self.prefetch_workers = prefetch_workers
+        self.batch_sampler = None # Optional LengthBucketBatchSampler over image indices, replaces the sequential batches
 
         self.multiblock = MultiBlock(
             grid_size= img_size // patch_size,
             block_scale=block_scale,
             block_aspect_ratio=block_aspect_ratio,
             device_context_masks = device,
-            device_predict_masks = device
+            device_predict_masks = device,
+            mask_bank=mask_bank, # Optional MaskBank path, masks then depend only on the step
+            n_views=n_views, # Context / target pairs per image, masks then (batch, n_views, K)
         )
+        self.steps_done = 0 # Batches yielded so far, the mask bank step; set to start_epoch * len(self) when resuming
 
         # Tensorize the data
         self.preload_images()
 
-    def process_and_save_image(self, image_file):
-        image_path = os.path.join(self.image_path, image_file)
-        save_path = os.path.join(self.tensor_folder, os.path.splitext(image_file)[0] + '.pt')
-        
-        if os.path.exists(save_path):
-            return
-        
-        # Open and process the image
-        image = Image.open(image_path).convert("RGB")
-        tensor = self.transform(image).unsqueeze(0)  # Apply transformations and add batch dimension
-        tensor = F.resize(tensor, (self.img_size, self.img_size))  # Resize
-        torch.save(tensor.squeeze(0), save_path)
+    def image_file_path(self, image_file):
+        return os.path.join(self.image_path, image_file)
 
     def preload_images(self):
-        """ Preload images as tensors and save them to disk as .pt files (if not already done). """
-        if self.tensor_folder is not None and os.path.exists(self.tensor_folder):
+        """ Preload images as tensors and save them to disk as .pt files or into a shard store (if not already done). """
+        if self.shard_folder is not None:
+            self.shard_store = ImageShardStore(self.shard_folder, self.img_size, dtype=self.storage_dtype)
+            preprocess_images(
+                items=[(f, os.path.join(self.image_path, f)) for f in self.image_filenames],
+                process_fn=self.image_loader(),
+                write_fn=save_to_shards(self.shard_store),
+                manifest_path=os.path.join(self.shard_folder, 'manifest.txt'),
+                done=self.shard_store.keys(),
+                commit_fn=self.shard_store.save_index, # publish the index every 32 chunks, not per chunk
+                commit_every=32,
+            )
+            return
+
+        # A finished folder from before manifests existed, nothing to resume
+        if self.tensor_folder is not None and os.path.exists(self.tensor_folder) \
+                and not os.path.exists(os.path.join(self.tensor_folder, 'manifest.txt')):
             return
 
-        self.tensor_folder = f"src/datasets/train-tensor-448-10k"
+        if self.tensor_folder is None:
+            self.tensor_folder = f"src/datasets/train-tensor-448-10k"
         os.makedirs(self.tensor_folder, exist_ok=True)
 
-        for i, image_file in enumerate(self.image_filenames):
-            self.process_and_save_image(image_file)
-            print(f"Processing {image_file} ({i+1}/{len(self.image_filenames)})", end='\r')
-                            
-        print(
-            f"{len(os.listdir(self.tensor_folder))}/{len(self.image_filenames)}"
-            " images processed and saved as tensors."
+        preprocess_images(
+            items=[(os.path.splitext(f)[0], os.path.join(self.image_path, f)) for f in self.image_filenames],
+            process_fn=self.image_loader(),
+            write_fn=save_tensor_files(self.tensor_folder),
+            manifest_path=os.path.join(self.tensor_folder, 'manifest.txt'),
         )
 
-    def get_image(self, idx):
-        """ Load tensorized image from disk. """
+    def load_image(self, idx, device=None):
+        """ Load tensorized image from disk, as stored (float32 or uint8). """
+        device = device or self.device
+        if self.shard_store is not None:
+            return self.shard_store.get_one(self.image_filenames[idx]).to(device)
         tensor_path = os.path.join(self.tensor_folder, os.path.splitext(self.image_filenames[idx])[0] + '.pt')
-        return torch.load(tensor_path, map_location=self.device)
+        return torch.load(tensor_path, map_location=device)
+
+    def get_image(self, idx):
+        """ Load tensorized image from disk as a float model input. """
+        return images_to_float(self.load_image(idx), self.normalization)
+
+    def load_batch(self, batch_indices, step=None):
+        """ One batch on the CPU: images as stored (or cached vision encoder outputs), captions and masks. """
+        filenames = [self.image_filenames[i] for i in batch_indices]
+        if self.feature_store is not None:
+            # Cached (B, N, D) vision encoder outputs instead of raw images
+            images = self.feature_store.get(filenames)
+        elif self.shard_store is not None:
+            # Single gather from the shard store
+            images = self.shard_store.get(filenames)
+        else:
+            images = torch.stack([self.load_image(i, device='cpu') for i in batch_indices])
+        captions = [self.get_text(i) for i in batch_indices]
+
+        # Generate masks for the current batch
+        context_masks, predict_masks = self.multiblock(len(captions), step=step)
+
+        return images, captions, context_masks, predict_masks
+
+    def to_device(self, batch, non_blocking=False):
+        """ Move a loaded batch to the device and turn stored images into float model inputs. """
+        images, captions, context_masks, predict_masks = batch
+        images = images.to(self.device, non_blocking=non_blocking)
+        if self.feature_store is None:
+            images = images_to_float(images, self.normalization)
+        return images, captions, context_masks, predict_masks
 
     def get_text(self, idx):
         """ Get a random caption for a given image. """
@@ -313,26 +383,61 @@ class ImageTextDatasetA100(Dataset):
         """ Number of batches in the dataset. """
         return (len(self.image_filenames) + self.batch_size - 1) // self.batch_size
 
+    def num_samples(self):
+        """ Number of images, the length of the map-style view. """
+        return len(self.image_filenames)
+
+    def __getitem__(self, idx):
+        """
+        One (image, caption) sample on the CPU for multi-worker DataLoaders,
+        batched by MultiBlockCollator; pass each batch through `to_device`.
+        Images are as stored (or cached vision encoder outputs).
+        """
+        filename = self.image_filenames[idx]
+        if self.feature_store is not None:
+            image = self.feature_store.get([filename])[0]
+        elif self.shard_store is not None:
+            image = self.shard_store.get_one(filename)
+        else:
+            image = self.load_image(idx, device='cpu')
+        return image, self.get_text(idx)
+
+    def text_lengths(self, token_store):
+        """ Mean token count of the captions of every image, for length-bucketed batching. """
+        return [token_store.lengths(self.caption_dict[f]).mean() for f in self.image_filenames]
+
     def __iter__(self):
         """ Iterator to yield batches of images and captions. """
-        if self.max is None:
-            print("Before shuffle: ", self.image_filenames[:3])
-            random.shuffle(self.image_filenames)
-            print("After shuffle: ", self.image_filenames[:3])
-            
-        self.current_idx = 0
-        while self.current_idx < len(self.image_filenames):
-            batch_indices = range(self.current_idx, min(self.current_idx + self.batch_size, len(self.image_filenames)))
-            images = [self.get_image(i) for i in batch_indices]
-            captions = [self.get_text(i) for i in batch_indices]
-
-            # Generate masks for the current batch
-            current_batch_size = len(captions)
-            context_masks, predict_masks = self.multiblock(current_batch_size)
+        if self.batch_sampler is not None:
+            # Indices of similar caption length, shuffled by the sampler itself
+            batches = self.batch_sampler.batches()
+        else:
+            if self.max is None:
+                print("Before shuffle: ", self.image_filenames[:3])
+                random.shuffle(self.image_filenames)
+                print("After shuffle: ", self.image_filenames[:3])
+
+            batches = [
+                range(start, min(start + self.batch_size, len(self.image_filenames)))
+                for start in range(0, len(self.image_filenames), self.batch_size)
+            ]
 
-            self.current_idx += self.batch_size
+        # Every batch carries its global step, so bank masks do not depend on thread scheduling
+        first_step = self.steps_done
+        self.steps_done += len(batches)
+        batches = list(enumerate(batches, start=first_step))
+        load_fn = lambda b: self.load_batch(b[1], step=b[0])
+
+        if self.prefetch_depth > 0:
+            # Load the next batches in background threads while the current step runs
+            yield from prefetch(
+                load_fn, batches, self.to_device,
+                depth=self.prefetch_depth, num_workers=self.prefetch_workers, pin_memory=True,
+            )
+            return
 
-            yield torch.stack(images), captions, context_masks, predict_masks
+        for b in batches:
+            yield self.to_device(load_fn(b))
             
 # collator = MaskCollator()
 # dataloader = DataLoader(dataset, batch_size=BATCH_SIZE, collate_fn=collator, num_workers=0)
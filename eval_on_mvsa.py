@@ -16,7 +16,23 @@ from tqdm import tqdm
 
 from metrics import calculate_metrics_from_logits
 
-class MVSA:
+from src.datasets.image_shards import ImageShardStore
+from src.datasets.preprocess import ImageLoaderMixin, preprocess_images, save_tensor_files, save_to_shards
+from src.transforms import images_to_float
+from src.datasets.token_store import TokenStore
+from src.datasets.samplers import LengthBucketBatchSampler
+
+from logging import getLogger
+
+logger = getLogger()
+
+
+def text_path(image_path):
+    """ Tweet text file of an MVSA image key ('/' stored as '='). """
+    return image_path.replace('image', 'text').replace('jpg', 'txt').replace('=', '/')
+
+
+class MVSA(ImageLoaderMixin):
     MVSA_SINGLE_PATH = "src/datasets/mvsa/mvsa_single"
     MVSA_MULTIPLE_PATH = "src/datasets/mvsa/mvsa_multiple"
 
@@ -26,7 +42,10 @@ class MVSA:
             img_size,
             device = 'cuda:0',
             transform = None,
-            tensor_folder=None
+            tensor_folder=None,
+            shard_folder=None,
+            storage_dtype='float32',
+            normalization=None,
         ):
         self.mvsa_dict = {
             'single': {
@@ -43,6 +62,11 @@ class MVSA:
         self.device = device
         self.transform = transform
         self.tensor_folder = tensor_folder
+        self.shard_folder = shard_folder # ImageShardStore folder, replaces the one-.pt-per-image tensor_folder
+        self.shard_store = None
+        self.storage_dtype = storage_dtype # 'uint8' stores raw pixels, converted to float per batch on device
+        self.normalization = normalization # Optional ((mean), (std)) applied after the float conversion
+        self.batch_sampler = None # Optional LengthBucketBatchSampler over self.dataset, replaces the sequential batches
 
         for cls in os.listdir(MVSA.MVSA_SINGLE_PATH):
             images_list = []
@@ -77,38 +101,44 @@ class MVSA:
         self.preload_images()
         
 
-    def process_and_save_image(self, image_file):
-        save_path = os.path.join(self.tensor_folder, os.path.splitext(image_file)[0] + '.pt')
-        
-        if os.path.exists(save_path):
-            print("skip")
-            return
-        
-        # Open and process the image
-        image = Image.open(image_file.replace('=', '/')).convert("RGB")
-        tensor = self.transform(image).unsqueeze(0)  # Apply transformations and add batch dimension
-        tensor = F.resize(tensor, (self.img_size, self.img_size))  # Resize
-        torch.save(tensor.squeeze(0), save_path)
+    def image_file_path(self, image_file):
+        return image_file.replace('=', '/')
+
+    @staticmethod
+    def read_text(image_path):
+        with open(text_path(image_path), 'r', encoding='unicode_escape') as file:
+            return file.read()
 
     def preload_images(self):
-        """ Preload images as tensors and save them to disk as .pt files (if not already done). """
-        if self.tensor_folder is not None and os.path.exists(self.tensor_folder):
+        """ Preload images as tensors and save them to disk as .pt files or into a shard store (if not already done). """
+        if self.shard_folder is not None:
+            self.shard_store = ImageShardStore(self.shard_folder, self.img_size, dtype=self.storage_dtype)
+            preprocess_images(
+                items=[(image_file, image_file.replace('=', '/')) for image_file, _ in self.dataset],
+                process_fn=self.image_loader(),
+                write_fn=save_to_shards(self.shard_store),
+                manifest_path=os.path.join(self.shard_folder, 'manifest.txt'),
+                done=self.shard_store.keys(),
+                commit_fn=self.shard_store.save_index, # publish the index every 32 chunks, not per chunk
+                commit_every=32,
+            )
             return
 
-        self.tensor_folder = f"src/datasets/mvsa-tensor-448"
+        # A finished folder from before manifests existed, nothing to resume
+        if self.tensor_folder is not None and os.path.exists(self.tensor_folder) \
+                and not os.path.exists(os.path.join(self.tensor_folder, 'manifest.txt')):
+            return
+
+        if self.tensor_folder is None:
+            self.tensor_folder = f"src/datasets/mvsa-tensor-448"
         os.makedirs(self.tensor_folder, exist_ok=True)
 
-        for i, (image_file, cls) in enumerate(self.dataset):
-            try:
-                self.process_and_save_image(image_file)
-            except Exception as e:
-                print(f"FAIL {image_file}: {e}")
-            print(f"Processing {image_file} ({i+1}/{len(self.dataset)})", end='\r')
-                            
-        print(
-            f"{len(os.listdir(self.tensor_folder))}/{len(self.dataset)}"
-            " images processed and saved as tensors."
-        ) 
+        preprocess_images(
+            items=[(os.path.splitext(image_file)[0], image_file.replace('=', '/')) for image_file, _ in self.dataset],
+            process_fn=self.image_loader(),
+            write_fn=save_tensor_files(self.tensor_folder),
+            manifest_path=os.path.join(self.tensor_folder, 'manifest.txt'),
+        )
 
     def shuffle(self, seed = 69):
         random.seed(seed)
@@ -128,6 +158,37 @@ class MVSA:
     def __len__(self): # length of the dataset
         return len(self.dataset) // self.batch_size + 1
 
+    def num_samples(self):
+        """ Number of (image, text) pairs, the length of the map-style view. """
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        """
+        One (image, text, image path) sample on the CPU, or None when a file
+        is missing; batch with `collate_skip_none` from src/datasets/loaders.py.
+        """
+        image_path, _ = self.dataset[idx]
+        try:
+            if self.shard_store is not None:
+                if image_path not in self.shard_store:
+                    logger.warning(f"Skipping {image_path}: not in the shard store")
+                    return None
+                image = self.shard_store.get_one(image_path)
+            else:
+                image = torch.load(os.path.join(self.tensor_folder, image_path.replace('jpg', 'pt')), map_location='cpu')
+
+            text = self.read_text(image_path)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Skipping {image_path}: {e}")
+            return None
+        return image, text, image_path
+
+    def to_device(self, batch, non_blocking=False):
+        """ Move a collated batch to the device and turn stored images into float model inputs. """
+        images, captions, images_paths = batch
+        images = images_to_float(images.to(self.device, non_blocking=non_blocking), self.normalization)
+        return images, captions, images_paths
+
     def upsampling(self):
         """
         Upsample the dataset to balance the number of samples across classes.
@@ -168,42 +229,73 @@ class MVSA:
         class_counts = Counter([cls for _, cls in self.train_set])
         print("After upsampling: ", class_counts)
     
-    def __iter__(self): # iter on the dataset
-        self.current_idx = 0
+    def texts(self):
+        """ Every readable tweet text of the dataset, e.g. to fill a TokenStore. """
+        texts = []
+        for image_path, _ in self.dataset:
+            try:
+                texts.append(self.read_text(image_path))
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"Skipping text of {image_path}: {e}")
+        return texts
+
+    def text_lengths(self, token_store):
+        """ Token count of every tweet (0 when unreadable), for length-bucketed batching. """
+        lengths = []
+        for image_path, _ in self.dataset:
+            try:
+                lengths.append(int(token_store.lengths([self.read_text(image_path)])[0]))
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"Unreadable text of {image_path}: {e}")
+                lengths.append(0)
+        return lengths
 
-        while self.current_idx < len(self.dataset):
+    def __iter__(self): # iter on the dataset
+        if self.batch_sampler is not None:
+            batches = self.batch_sampler.batches()
+        else:
+            batches = [
+                range(start, min(start + self.batch_size, len(self.dataset)))
+                for start in range(0, len(self.dataset), self.batch_size)
+            ]
+
+        for batch_indices in batches:
             images = []
             captions = []
             images_paths = []
 
             # Load a batch of data
-            for idx in range(self.current_idx, self.current_idx + self.batch_size):
-                if idx >= len(self.dataset):
-                    break
-
+            for idx in batch_indices:
                 try:
                     # Load image
                     image_path, _ = self.dataset[idx]
-                    text_path = image_path.replace('image', 'text').replace('jpg', 'txt')
                     
-                    image = torch.load(os.path.join(self.tensor_folder, image_path.replace('jpg', 'pt')))
+                    if self.shard_store is not None:
+                        if image_path not in self.shard_store:
+                            continue
+                        image = None  # gathered for the whole batch below
+                    else:
+                        image = torch.load(os.path.join(self.tensor_folder, image_path.replace('jpg', 'pt')))
                     
                     # Load text
-                    with open(text_path.replace('=', '/'), 'r', encoding='unicode_escape') as file:
-                        text = file.read()
+                    text = self.read_text(image_path)
 
-                except Exception as e: 
+                except (OSError, UnicodeDecodeError) as e: 
+                    logger.warning(f"Skipping {image_path}: {e}")
                     continue
 
                 images.append(image)
                 captions.append(text)
                 images_paths.append(image_path)
-            
-            self.current_idx += self.batch_size
+
+            if self.shard_store is not None:
+                images = self.shard_store.get(images_paths)
+            else:
+                images = torch.stack(images)
 
             # Stack images into a single tensor for the batch and move to the appropriate device
             yield (
-                torch.stack(images).to(self.device),  # Stack images into a batch tensor
+                images_to_float(images.to(self.device), self.normalization),  # Stack images into a batch tensor
                 captions,  # Captions can be processed later
                 images_paths,  # Image paths can be used for debugging
             )
@@ -270,9 +362,17 @@ def encode_dataset(
         save_path,
         crosser_type='target',
         tensor_folder=None,
+        shard_folder=None,
+        storage_dtype='float32',
+        token_store_folder=None,
+        merge_r=0,
+        quantize=None,
+        resolution=None,
     ):
-    # Load the models
-    text_encoder, vision_encoder, crosser = load_448(checkpoint_path, crosser_type)
+    # Load the models (quantize: int8 encoders for CPU, see load_448)
+    text_encoder, vision_encoder, crosser = load_448(checkpoint_path, crosser_type, device=device, quantize=quantize)
+    vision_encoder.set_token_merging(merge_r) # ToMe: patch tokens merged per ViT block, 0 keeps all 784
+    # resolution: 224 / 336 run the 448-trained encoders on resized images, see inference_448
 
     # Move the models to the device
     text_encoder = text_encoder.to(device)
@@ -297,21 +397,31 @@ def encode_dataset(
         img_size = 224,
         device = device,
         transform = transform,
-        tensor_folder=tensor_folder
+        tensor_folder=tensor_folder,
+        shard_folder=shard_folder,
+        storage_dtype=storage_dtype,
     )
 
+    if token_store_folder is not None:
+        # -- Tokenize all tweets up front, batches then only pad stored ids
+        text_encoder.token_store = TokenStore(token_store_folder, text_encoder.model_path, text_encoder.max_length)
+        text_encoder.token_store.add(ds.texts(), text_encoder.tokenize)
+        # -- Encode tweets sorted by length, the order does not matter when saving per-image embeddings
+        ds.batch_sampler = LengthBucketBatchSampler(ds.text_lengths(text_encoder.token_store), batch_size=batch_size, shuffle=False)
+        print(f"Text padding efficiency (real / padded tokens): {ds.batch_sampler.padding_efficiency():.3f}")
+
     with torch.no_grad():
         # Encode the dataset
         with tqdm(ds, desc=f"Embedding pairs.") as pbar:
             for images, captions, images_paths in pbar:
                 embeddings = inference_448(
-                    images, captions, text_encoder, vision_encoder, crosser
+                    images, captions, text_encoder, vision_encoder, crosser, resolution=resolution
                 )
                 for embedding, image_path in zip(embeddings, images_paths):
                     torch.save(embedding, os.path.join(save_path, image_path.replace('jpg', 'pt')))
 
             pbar.set_postfix({
-                'MEM': torch.cuda.max_memory_allocated() / 1024.**3,
+                'MEM': torch.cuda.max_memory_allocated() / 1024.**3 if torch.cuda.is_available() else 0.,
                 'len': len(images_paths),
             })
 
@@ -666,5 +776,7 @@ def train_simple_linear_module(
         }
         saver.save_checkpoint(save_dict, epoch=epoch+1)
 
+    return metrics
+
 
     
\ No newline at end of file
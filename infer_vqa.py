@@ -31,6 +31,7 @@ from metrics import calculate_metrics_from_logits, indices_to_one_hot
 
 DEVICE_0 = 'cuda:0'
 CHECKPOINT = "trains/VQA-1732161891/epoch-30.pt"
+MERGE_R = 0 # ToMe tokens merged per ViT block, see train_scripts/tome_table.py for the accuracy / latency trade-off
 
 ##################
 with open('configs/in1k_vith16-448_ep300.yaml', 'r') as y_file:
@@ -89,6 +90,7 @@ msg = vision_encoder.load_state_dict(encoder_dict)
 print(f'loaded pretrained encoder from with msg: {msg}')
 for p in vision_encoder.parameters():
     p.requires_grad = False
+vision_encoder.set_token_merging(MERGE_R)
 
 del checkpoint
 del encoder_dict
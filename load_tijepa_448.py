@@ -8,6 +8,7 @@ from dataclasses import dataclass, asdict
 
 from src.models import modules
 from src.models.modules import text_encoder_model, x_t2i_module, vit_predictor
+from src.models.quantization import quantize_int8
 
 DEVICE_0 = 'cuda:0'
 
@@ -58,11 +59,17 @@ MODEL_CONFIG = ModelConfig()
 
 from typing import Literal
 
-def load_448(checkpoint_path, crosser_type: Literal['target'] | Literal['context'] = 'target'):
+def load_448(checkpoint_path, crosser_type: Literal['target'] | Literal['context'] = 'target', device=DEVICE_0, quantize=None):
+    """
+    quantize: None, 'encoders' (int8 gte + ViT-H) or 'all' (the crosser too), for CPU inference
+    (device='cpu'), see src/models/quantization.py and train_scripts/bench_quantized.py.
+    """
+    assert quantize in (None, 'encoders', 'all'), f"Unknown quantize option {quantize}"
+    assert quantize is None or device == 'cpu', "Dynamically quantized models run on CPU"
     print(f"Init models...")
     # Text Encoder
     text_encoder = text_encoder_model(
-        device=DEVICE_0
+        device=device
     )
     text_encoder_total_params = sum(p.numel() for p in text_encoder.parameters())
     print(f"{text_encoder_total_params=}")
@@ -73,13 +80,13 @@ def load_448(checkpoint_path, crosser_type: Literal['target'] | Literal['context
     vision_encoder = modules.__dict__[params['meta']['model_name']](
         img_size=[MODEL_CONFIG.SIZE],
         patch_size=MODEL_CONFIG.PATCH_SIZE,
-    ).to(DEVICE_0)
+    ).to(device)
     context_vision_encoder_total_params = sum(p.numel() for p in vision_encoder.parameters())
     print(f"{context_vision_encoder_total_params=}")
 
     TAR_FILE = "IN1K-vit.h.16-448px-300e.pth.tar"
     print(f"Loading Vision Encoder {TAR_FILE}...")
-    checkpoint = torch.load(TAR_FILE, map_location=torch.device(DEVICE_0))
+    checkpoint = torch.load(TAR_FILE, map_location=torch.device(device))
     encoder_dict = checkpoint['target_encoder'] if 'target_encoder' in checkpoint else checkpoint['encoder']
     encoder_dict = {k.replace('module.', ''): v for k, v in encoder_dict.items()}
     msg = vision_encoder.load_state_dict(encoder_dict)
@@ -102,7 +109,7 @@ def load_448(checkpoint_path, crosser_type: Literal['target'] | Literal['context
         qk_scale=None,
         drop_rate=MODEL_CONFIG.DROP_RATE,
         attn_drop_rate=MODEL_CONFIG.ATTN_DROP_RATE,
-    ).to(DEVICE_0)
+    ).to(device)
     crosser_total_params = sum(p.numel() for p in crosser.parameters())
     print(f"{crosser_total_params=}")
 
@@ -123,12 +130,25 @@ def load_448(checkpoint_path, crosser_type: Literal['target'] | Literal['context
 
     del saved_dict
 
+    if quantize is not None:
+        # -- Frozen at inference: int8 Linear weights, fp32 activations quantized on the fly
+        print(f"Quantizing {quantize} to int8...")
+        text_encoder = quantize_int8(text_encoder)
+        vision_encoder = quantize_int8(vision_encoder)
+        if quantize == 'all':
+            crosser = quantize_int8(crosser)
+
     return text_encoder, vision_encoder, crosser
 
-def inference_448(images, captions, text_encoder, vision_encoder, crosser):
+def inference_448(images, captions, text_encoder, vision_encoder, crosser, resolution=None):
+    """ resolution: optional smaller input size (224 / 336) for cheaper requests, the positional table follows """
     # Encode the text
     encoded_text, text_attn_mask = text_encoder(captions)
     
+    # Resize the images
+    if resolution is not None and images.shape[-2:] != (resolution, resolution):
+        images = torch.nn.functional.interpolate(images, size=(resolution, resolution), mode='bicubic', align_corners=False, antialias=True)
+
     # Encode the context patches
     encoded_image_full = vision_encoder(images)
     
@@ -0,0 +1,217 @@
+import os
+import json
+import glob
+import hashlib
+
+import numpy as np
+import torch
+
+from tqdm import tqdm
+
+
+# numpy has no bfloat16, so bf16 rows are stored as their raw 16 bits and
+# reinterpreted with Tensor.view on the way out
+_STORAGE_DTYPES = {
+    'float16': (np.float16, torch.float16),
+    'bfloat16': (np.uint16, torch.bfloat16),
+}
+
+
+def checkpoint_hash(path, chunk_size=1 << 24, cache_path=None):
+    """
+    Content hash of an encoder checkpoint, used to invalidate cached features.
+    With `cache_path` (e.g. FeatureStore.HASH_FILE next to index.json) the hash
+    is kept with the checkpoint's (path, size, mtime) and the multi-GB file is
+    only read again when those change.
+    """
+    stat = os.stat(path)
+    signature = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('signature') == signature:
+            return cached['hash']
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    digest = h.hexdigest()[:16]
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': signature, 'hash': digest}, f)
+        os.replace(tmp_path, cache_path)
+    return digest
+
+
+class FeatureStore:
+    """
+    Sharded, memory-mapped store of frozen-encoder outputs.
+
+    Every image owns one (num_tokens, embed_dim) row inside a fixed-size shard
+    file `shard-XXXXX.bin`; `index.json` maps image filename -> global row and
+    records the hash of the encoder checkpoint that produced the rows. Opening
+    a store with a different `encoder_hash` wipes it.
+    """
+    INDEX_FILE = 'index.json'
+    HASH_FILE = 'encoder_hash.json'  # checkpoint_hash cache, kept by clear()
+
+    def __init__(
+        self,
+        folder,
+        num_tokens,
+        embed_dim,
+        dtype='bfloat16',
+        shard_size=1024,
+        encoder_hash=None,
+    ):
+        assert dtype in _STORAGE_DTYPES, f"dtype must be one of {list(_STORAGE_DTYPES)}, got {dtype}"
+        self.folder = folder
+        self.num_tokens = num_tokens
+        self.embed_dim = embed_dim
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.encoder_hash = encoder_hash
+        self.np_dtype, self.torch_dtype = _STORAGE_DTYPES[dtype]
+
+        self._shards = {}  # shard id -> np.memmap
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.index_path = os.path.join(self.folder, FeatureStore.INDEX_FILE)
+        self.index = self._load_index()
+
+    def _new_index(self):
+        return {
+            'encoder_hash': self.encoder_hash,
+            'num_tokens': self.num_tokens,
+            'embed_dim': self.embed_dim,
+            'dtype': self.dtype,
+            'shard_size': self.shard_size,
+            'rows': {},  # filename -> global row
+        }
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return self._new_index()
+
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+
+        layout = (index['num_tokens'], index['embed_dim'], index['dtype'], index['shard_size'])
+        stale = (
+            self.encoder_hash is not None and index['encoder_hash'] != self.encoder_hash
+        ) or layout != (self.num_tokens, self.embed_dim, self.dtype, self.shard_size)
+
+        if stale:
+            print(
+                f"Feature store {self.folder} was built with encoder {index['encoder_hash']} "
+                f"and layout {layout}, invalidating."
+            )
+            self.clear()
+            return self._new_index()
+
+        return index
+
+    def clear(self):
+        """ Delete the store's own shard files and index, leaving anything else in the folder alone. """
+        self._shards = {}
+        paths = glob.glob(os.path.join(self.folder, 'shard-[0-9][0-9][0-9][0-9][0-9].bin'))
+        for path in paths + [self.index_path, self.index_path + '.tmp']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save_index(self):
+        """ Flush the shards written so far, then atomically replace index.json. """
+        for shard in self._shards.values():
+            shard.flush()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.index['rows'])
+
+    def __contains__(self, filename):
+        return filename in self.index['rows']
+
+    def missing(self, filenames):
+        return [f for f in filenames if f not in self.index['rows']]
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            path = os.path.join(self.folder, f"shard-{shard_id:05d}.bin")
+            self._shards[shard_id] = np.memmap(
+                path,
+                dtype=self.np_dtype,
+                mode='r+' if os.path.exists(path) else 'w+',
+                shape=(self.shard_size, self.num_tokens, self.embed_dim),
+            )
+        return self._shards[shard_id]
+
+    def put(self, filenames, features):
+        """
+        Append (B, num_tokens, embed_dim) features for `filenames`, published
+        (shards flushed, index written) by the next `save_index()`.
+        """
+        assert features.shape[1:] == (self.num_tokens, self.embed_dim), \
+            f"Expected features of shape (B, {self.num_tokens}, {self.embed_dim}), got {tuple(features.shape)}"
+
+        features = features.detach().to('cpu', self.torch_dtype)
+        if self.torch_dtype == torch.bfloat16:
+            features = features.view(torch.int16)
+        features = features.numpy().view(self.np_dtype)
+
+        rows = self.index['rows']
+        for filename, feature in zip(filenames, features):
+            row = rows.get(filename, len(rows))
+            shard_id, offset = divmod(row, self.shard_size)
+            self._shard(shard_id)[offset] = feature
+            rows[filename] = row
+
+    def get(self, filenames):
+        """ Gather the cached features for `filenames` as one (B, num_tokens, embed_dim) tensor. """
+        rows = np.array([self.index['rows'][f] for f in filenames], dtype=np.int64)
+        out = np.empty((len(rows), self.num_tokens, self.embed_dim), dtype=self.np_dtype)
+
+        shard_ids, offsets = np.divmod(rows, self.shard_size)
+        for shard_id in np.unique(shard_ids):
+            sel = shard_ids == shard_id
+            out[sel] = self._shard(int(shard_id))[offsets[sel]]
+
+        out = torch.from_numpy(out)
+        if self.torch_dtype == torch.bfloat16:
+            out = out.view(torch.bfloat16)
+        return out
+
+
+@torch.no_grad()
+def extract_features(dataset, vision_encoder, store, batch_size=32, device='cuda:0', dtype=torch.bfloat16, save_every=32):
+    """
+    Fill `store` with `vision_encoder` outputs for every image of `dataset`.
+
+    Resumable: images already present in the store are skipped, and the index
+    is saved every `save_every` batches and at the end (shards are flushed
+    first, so a crash never indexes garbage).
+    """
+    vision_encoder.eval()
+    todo = [i for i, f in enumerate(dataset.image_filenames) if f not in store]
+    print(f"Extracting features for {len(todo)}/{len(dataset.image_filenames)} images into {store.folder}")
+
+    for n, start in enumerate(tqdm(range(0, len(todo), batch_size), desc="Extracting features")):
+        indices = todo[start:start + batch_size]
+        images = torch.stack([dataset.get_image(i) for i in indices]).to(device)
+        with torch.autocast(device_type=torch.device(device).type, dtype=dtype):
+            features = vision_encoder(images)
+        store.put([dataset.image_filenames[i] for i in indices], features)
+        if (n + 1) % save_every == 0:
+            store.save_index()
+    store.save_index()
+
+    return store
@@ -0,0 +1,136 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from src.transforms import images_to_uint8
+
+
+class ImageShardStore:
+    """
+    Fixed-size shards of preprocessed images plus a key -> row index.
+
+    Replaces one `torch.save` file per image: shard `shard-XXXXX.bin` is a raw
+    (shard_size, 3, H, W) array and `index.json` maps an image key (filename,
+    COCO image id, ...) to its global row. Single images and batches of
+    consecutive rows within a shard are zero-copy memmap views; other batches
+    are gathered (copied) with one fancy index per shard they touch.
+
+    With dtype='uint8', [0, 1] float images are quantized on write (4x less
+    disk and read bandwidth than float32); readers turn batches back into
+    floats with `src.transforms.images_to_float`.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, folder, img_size, channels=3, dtype='float32', shard_size=4096):
+        self.folder = folder
+        self.img_size = img_size
+        self.channels = channels
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.row_shape = (channels, img_size, img_size)
+
+        self._shards = {}  # shard id -> np.memmap
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.index_path = os.path.join(self.folder, ImageShardStore.INDEX_FILE)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+            layout = (self.index['img_size'], self.index['channels'], self.index['dtype'], self.index['shard_size'])
+            assert layout == (img_size, channels, dtype, shard_size), \
+                f"Shard store {self.folder} has layout {layout}, expected {(img_size, channels, dtype, shard_size)}"
+        else:
+            self.index = {
+                'img_size': img_size,
+                'channels': channels,
+                'dtype': dtype,
+                'shard_size': shard_size,
+                'rows': {},  # key -> global row
+            }
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, ImageShardStore.INDEX_FILE))
+
+    def __len__(self):
+        return len(self.index['rows'])
+
+    def __contains__(self, key):
+        return key in self.index['rows']
+
+    def keys(self):
+        return self.index['rows'].keys()
+
+    def _shard(self, shard_id, write=False):
+        shard = self._shards.get(shard_id)
+        if shard is None or (write and shard.mode == 'c'):
+            path = os.path.join(self.folder, f"shard-{shard_id:05d}.bin")
+            if write:
+                mode = 'r+' if os.path.exists(path) else 'w+'
+            else:
+                mode = 'c'  # copy-on-write keeps the mapping writable for torch.from_numpy without touching the file
+            shard = np.memmap(path, dtype=self.dtype, mode=mode, shape=(self.shard_size, *self.row_shape))
+            self._shards[shard_id] = shard
+        return shard
+
+    def put(self, keys, images):
+        """
+        Write a (B, C, H, W) batch of images under `keys`. They are published
+        (shards flushed, index written) by the next `save_index()` / `close()`.
+        """
+        images = torch.as_tensor(images)
+        if self.dtype == 'uint8':
+            images = images_to_uint8(images)
+        assert tuple(images.shape[1:]) == self.row_shape, \
+            f"Expected images of shape (B, {', '.join(map(str, self.row_shape))}), got {tuple(images.shape)}"
+        images = images.cpu().numpy().astype(self.dtype, copy=False)
+
+        rows = self.index['rows']
+        for key, image in zip(keys, images):
+            row = rows.get(key, len(rows))
+            shard_id, offset = divmod(row, self.shard_size)
+            self._shard(shard_id, write=True)[offset] = image
+            rows[key] = row
+
+    def save_index(self):
+        """ Flush the shards written so far, then atomically replace index.json. """
+        for shard in self._shards.values():
+            if shard.mode != 'c':
+                shard.flush()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        self.save_index()
+
+    def get_one(self, key):
+        """ Zero-copy view of a single image. """
+        shard_id, offset = divmod(self.index['rows'][key], self.shard_size)
+        return torch.from_numpy(self._shard(shard_id)[offset])
+
+    def get(self, keys):
+        """
+        (B, C, H, W) batch: a zero-copy view when the rows are consecutive in
+        one shard, otherwise a copy gathered with one fancy index per shard.
+        """
+        rows = np.array([self.index['rows'][k] for k in keys], dtype=np.int64)
+        shard_ids, offsets = np.divmod(rows, self.shard_size)
+
+        unique_shards = np.unique(shard_ids)
+        if len(unique_shards) == 1:
+            shard = self._shard(int(unique_shards[0]))
+            if len(offsets) and np.all(np.diff(offsets) == 1):
+                # -- contiguous run: basic slicing keeps the memmap view
+                return torch.from_numpy(shard[offsets[0]:offsets[-1] + 1])
+            return torch.from_numpy(shard[offsets])
+
+        out = np.empty((len(rows), *self.row_shape), dtype=self.dtype)
+        for shard_id in unique_shards:
+            sel = shard_ids == shard_id
+            out[sel] = self._shard(int(shard_id))[offsets[sel]]
+        return torch.from_numpy(out)
+
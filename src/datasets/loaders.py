@@ -0,0 +1,121 @@
+from logging import getLogger
+
+import torch
+
+logger = getLogger()
+
+
+def collate_skip_none(batch):
+    """ default_collate after dropping samples whose __getitem__ returned None (unreadable files). """
+    return torch.utils.data.default_collate([sample for sample in batch if sample is not None])
+
+
+class StepDataset(torch.utils.data.Dataset):
+    """ Map-style view returning `(step, dataset[index])` for `(step, index)` keys, see StepBatchSampler. """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return self.dataset.num_samples()
+
+    def __getitem__(self, item):
+        step, index = item
+        return step, self.dataset[index]
+
+
+class StepBatchSampler:
+    """
+    Tags every index of a batch with the global step of that batch,
+    `epoch * len(batch_sampler) + position`, so collators running in loader
+    workers know it regardless of worker count, restarts or resumes.
+    """
+
+    def __init__(self, batch_sampler, sampler=None):
+        self.batch_sampler = batch_sampler
+        self.sampler = sampler  # Epoch-aware sampler under a plain BatchSampler (DistributedSampler)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        for sampler in (self.batch_sampler, self.sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        start = self.epoch * len(self)
+        for position, batch in enumerate(self.batch_sampler):
+            yield [(start + position, index) for index in batch]
+
+
+def make_loader(
+    dataset,
+    batch_size,
+    collator=None,
+    pin_mem=True,
+    num_workers=8,
+    world_size=1,
+    rank=0,
+    shuffle=True,
+    drop_last=False,
+    persistent_workers=True,
+    batch_sampler=None,
+    with_steps=False,
+):
+    """
+    Multi-worker DataLoader over the map-style view (`__getitem__`) of the
+    COCO / VQA / MVSA datasets.
+
+    Their `__len__` counts batches of the hand-rolled `__iter__`, so the
+    sampler is built over `range(dataset.num_samples())` instead of the
+    dataset itself. A `batch_sampler` (e.g. LengthBucketBatchSampler) replaces
+    it and is returned in its place.
+
+    `with_steps=True` hands the collator `(step, sample)` pairs carrying the
+    global step of the batch (see StepBatchSampler); the returned sampler is
+    then the StepBatchSampler, whose `set_epoch` must be called every epoch.
+    """
+    if with_steps:
+        sampler = None
+        if batch_sampler is None:
+            sampler = torch.utils.data.distributed.DistributedSampler(
+                dataset=range(dataset.num_samples()),
+                num_replicas=world_size,
+                rank=rank,
+                shuffle=shuffle)
+            batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+        batch_sampler = StepBatchSampler(batch_sampler, sampler)
+        dataset = StepDataset(dataset)
+
+    if batch_sampler is not None:
+        data_loader = torch.utils.data.DataLoader(
+            dataset,
+            collate_fn=collator,
+            batch_sampler=batch_sampler,
+            pin_memory=pin_mem,
+            num_workers=num_workers,
+            persistent_workers=persistent_workers and num_workers > 0)
+        logger.info(f'{type(dataset).__name__} data loader created ({len(batch_sampler)} batches, {num_workers} workers)')
+        return data_loader, batch_sampler
+
+    samples = range(dataset.num_samples())
+    dist_sampler = torch.utils.data.distributed.DistributedSampler(
+        dataset=samples,
+        num_replicas=world_size,
+        rank=rank,
+        shuffle=shuffle)
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        collate_fn=collator,
+        sampler=dist_sampler,
+        batch_size=batch_size,
+        drop_last=drop_last,
+        pin_memory=pin_mem,
+        num_workers=num_workers,
+        persistent_workers=persistent_workers and num_workers > 0)
+    logger.info(f'{type(dataset).__name__} data loader created ({len(samples)} samples, {num_workers} workers)')
+
+    return data_loader, dist_sampler
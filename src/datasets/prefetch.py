@@ -0,0 +1,48 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def pin_batch(batch):
+    """ Page-lock every CPU tensor of a (nested) batch so host -> device copies can be asynchronous. """
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory() if batch.device.type == 'cpu' else batch
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(pin_batch(b) for b in batch)
+    return batch
+
+
+def prefetch(load_fn, batches, to_device_fn=None, depth=2, num_workers=1, pin_memory=True):
+    """
+    Yield `to_device_fn(load_fn(b))` for every `b` in `batches`, in order.
+
+    Up to `depth` batches are loaded ahead by `num_workers` background threads
+    (torch.load, memmap reads and PIL all release the GIL) while the consumer
+    runs its step. Loaded batches are pinned, and `to_device_fn(batch,
+    non_blocking=True)` issues the device copies so they overlap compute.
+    """
+    pin_memory = pin_memory and torch.cuda.is_available()
+
+    def load(b):
+        batch = load_fn(b)
+        return pin_batch(batch) if pin_memory else batch
+
+    batches = iter(batches)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        try:
+            for b in batches:
+                pending.append(pool.submit(load, b))
+                if len(pending) >= depth:
+                    break
+
+            while pending:
+                batch = pending.popleft().result()
+                b = next(batches, None)
+                if b is not None:
+                    pending.append(pool.submit(load, b))
+                yield batch if to_device_fn is None else to_device_fn(batch, non_blocking=pin_memory)
+        finally:
+            for future in pending:
+                future.cancel()
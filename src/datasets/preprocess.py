@@ -0,0 +1,182 @@
+import os
+import time
+import multiprocessing
+
+from functools import partial
+
+import torch
+import torchvision.transforms.functional as F
+from PIL import Image
+from PIL import ImageFile
+
+from src.transforms import images_to_uint8
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def load_image_tensor(image_path, transform, img_size, storage_dtype='float32'):
+    """ Open, transform and resize one image, as written by every tensorization path. """
+    image = Image.open(image_path).convert("RGB")
+    tensor = transform(image).unsqueeze(0)  # Apply transformations and add batch dimension
+    tensor = F.resize(tensor, (img_size, img_size))  # Resize
+    tensor = tensor.squeeze(0)
+    if storage_dtype == 'uint8':
+        tensor = images_to_uint8(tensor)
+    return tensor
+
+
+class ImageLoaderMixin:
+    """
+    `image_loader` / `process_image` of the datasets tensorized through
+    preprocess_images: they provide `transform`, `img_size`, `storage_dtype`
+    and `image_file_path(image_file)`.
+    """
+
+    def image_loader(self):
+        """ Picklable image_path -> tensor function for the preprocessing pool. """
+        return partial(load_image_tensor, transform=self.transform, img_size=self.img_size, storage_dtype=self.storage_dtype)
+
+    def process_image(self, image_file):
+        """ Open, transform and resize one image. """
+        return self.image_loader()(self.image_file_path(image_file))
+
+
+class PreprocessManifest:
+    """ Append-only file of completed keys, one per line, used to resume interrupted runs exactly. """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.done = set(line.rstrip('\n') for line in f if line.strip())
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, keys):
+        with open(self.path, 'a') as f:
+            for key in keys:
+                f.write(f"{key}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(keys)
+
+
+_worker_fn = None
+
+
+def _init_worker(process_fn):
+    global _worker_fn
+    _worker_fn = process_fn
+    torch.set_num_threads(1)  # one image per process, avoid oversubscribing the cores
+
+
+def _run(item):
+    key, path = item
+    try:
+        return key, _worker_fn(path), None
+    except Exception as e:
+        return key, None, str(e)
+
+
+def preprocess_images(
+    items,
+    process_fn,
+    write_fn,
+    manifest_path,
+    done=(),
+    num_workers=None,
+    chunk_size=64,
+    commit_fn=None,
+    commit_every=1,
+):
+    """
+    Decode/resize `items` = [(key, image_path), ...] in a process pool.
+
+    `process_fn(image_path)` runs in the workers and must be picklable (a module
+    level function or a `functools.partial` of one). `write_fn(keys, tensors)`
+    runs in the main process every `chunk_size` results, after which the keys
+    are appended to the manifest; keys already in the manifest or in `done`
+    are skipped, so an interrupted run resumes where it stopped.
+
+    With a `commit_fn` (e.g. `ImageShardStore.save_index`), written keys reach
+    the manifest only after it ran, every `commit_every` chunks and at the end,
+    so the manifest never lists keys the store has not published.
+    """
+    manifest = PreprocessManifest(manifest_path)
+    done = set(done)
+    todo = [(key, path) for key, path in items if key not in manifest and key not in done]
+    if not todo:
+        # -- nothing to do: do not fork a pool (e.g. after CUDA init in eval scripts)
+        return 0
+    num_workers = num_workers or os.cpu_count()
+    print(f"Preprocessing {len(todo)}/{len(items)} images with {num_workers} workers")
+
+    keys, tensors = [], []
+    written = []  # keys written since the last commit
+    n_done, n_failed, n_chunks = 0, 0, 0
+    start_time = time.time()
+
+    def commit():
+        if written:
+            if commit_fn is not None:
+                commit_fn()
+            manifest.add(written)
+            written.clear()
+
+    def flush():
+        nonlocal n_chunks
+        if keys:
+            write_fn(keys, tensors)
+            written.extend(keys)
+            keys.clear()
+            tensors.clear()
+            n_chunks += 1
+            if n_chunks % commit_every == 0:
+                commit()
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(process_fn,)) as pool:
+        for key, tensor, error in pool.imap_unordered(_run, todo, chunksize=4):
+            if error is not None:
+                n_failed += 1
+                print(f"\nFAIL {key}: {error}")
+                continue
+
+            keys.append(key)
+            tensors.append(tensor)
+            n_done += 1
+            if len(keys) >= chunk_size:
+                flush()
+                rate = n_done / (time.time() - start_time)
+                print(f"Processed {n_done}/{len(todo)} ({rate:.1f} images/s)", end='\r')
+        flush()
+        commit()
+
+    elapsed = time.time() - start_time
+    print(
+        f"\nProcessed {n_done}/{len(todo)} images ({n_failed} failed) in {elapsed:.1f}s, "
+        f"{n_done / max(elapsed, 1e-9):.1f} images/s"
+    )
+    return n_done
+
+
+def save_tensor_files(folder):
+    """ `write_fn` writing one `<key>.pt` file per image into `folder`. """
+    def write_fn(keys, tensors):
+        for key, tensor in zip(keys, tensors):
+            torch.save(tensor, os.path.join(folder, key + '.pt'))
+    return write_fn
+
+
+def save_to_shards(store):
+    """
+    `write_fn` writing a chunk of images into an `ImageShardStore`; pass
+    `commit_fn=store.save_index` to preprocess_images to publish them.
+    """
+    def write_fn(keys, tensors):
+        store.put(keys, torch.stack(tensors))
+    return write_fn
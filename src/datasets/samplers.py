@@ -0,0 +1,108 @@
+from logging import getLogger
+
+import numpy as np
+import torch
+
+logger = getLogger()
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of samples with similar text length.
+
+    Every epoch the indices are shuffled, cut into windows of
+    `window * batch_size` samples, and each window is sorted by length and
+    split into batches; the batch order is then shuffled again. Indices stay
+    sorted inside a batch, so consecutive mini-batches are tight as well,
+    while the window bounds how far the order drifts from a plain shuffle.
+    Keep the window to a few batches: once it covers the dataset every epoch
+    is one global length sort, with nearly the same batches each epoch.
+    `shuffle=False` sorts the whole dataset once, for inference.
+
+    Usable as a DataLoader `batch_sampler` or through the datasets'
+    `batch_sampler` attribute.
+    """
+
+    def __init__(self, lengths, batch_size, window=4, shuffle=True, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if shuffle and window * batch_size >= len(self.lengths):
+            logger.warning(
+                f"LengthBucketBatchSampler window of {window} x {batch_size} samples covers the whole dataset "
+                f"({len(self.lengths)} samples): batches are a global length sort, only their order is shuffled")
+        self.batch_size = batch_size
+        self.window = window
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """ List of index lists of the current epoch. """
+        n = len(self.lengths)
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            windows = [order]
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            perm = rng.permutation(n)
+            size = self.window * self.batch_size
+            windows = [
+                perm[start:start + size][np.argsort(self.lengths[perm[start:start + size]], kind='stable')]
+                for start in range(0, n, size)
+            ]
+
+        batches = []
+        for order in windows:
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def padding_efficiency(self, mini_batch_size=None):
+        """
+        Expected real / padded tokens of the current epoch when every batch is
+        encoded in chunks of `mini_batch_size` (default: the whole batch).
+        """
+        real, padded = 0, 0
+        for batch in self.batches():
+            step = mini_batch_size or len(batch)
+            for start in range(0, len(batch), step):
+                chunk = self.lengths[batch[start:start + step]]
+                real += int(chunk.sum())
+                padded += int(chunk.max()) * len(chunk)
+        return real / max(padded, 1)
+
+
+class PaddingMeter:
+    """ Measured real / padded text tokens, fed with the attention masks of the encoded batches. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.real = 0
+        self.padded = 0
+
+    def update(self, attention_mask):
+        self.real += int(attention_mask.sum())
+        self.padded += attention_mask.numel()
+
+    @property
+    def efficiency(self):
+        return self.real / max(self.padded, 1)
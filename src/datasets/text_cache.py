@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from tqdm import tqdm
+
+from src.models.modules import PackedText
+
+
+class TextFeatureCache:
+    """
+    Caption-keyed cache of `TextEncoder` outputs.
+
+    Rows of `last_hidden_state` (real tokens only) are kept in a packed ragged
+    layout: one flat (total_tokens, embed_dim) array plus per-caption
+    (offset, length) entries in `index.json`. Flushed rows live in a memory
+    mapped `tokens.bin`, fresh rows stay in RAM until `flush()`.
+
+    Called like the encoder, `cache(texts)` returns `(embeddings, attention_mask)`
+    re-padded to the longest text of the batch, or `(PackedText, None)` with
+    `packed=True`. Normalization runs over each
+    caption's real tokens only, i.e. every row equals encoding that caption on
+    its own. This is NOT what the live `TextEncoder` path does (it normalizes
+    over the padded batch, padding rows included), so cached features change
+    the crosser's input distribution: use it for runs trained on the cache
+    from the start, not to resume or evaluate models trained without it.
+    """
+    INDEX_FILE = 'index.json'
+    TOKENS_FILE = 'tokens.bin'
+
+    def __init__(self, text_encoder, folder=None, embed_dim=768, normalize=True, encode_batch_size=256):
+        self.text_encoder = text_encoder
+        self.folder = folder
+        self.embed_dim = embed_dim
+        self.normalize = normalize
+        self.encode_batch_size = encode_batch_size
+
+        self.entries = {}  # key -> (offset, length) into the flat token array on disk
+        self.total_tokens = 0
+        self.tokens = None  # np.memmap (total_tokens, embed_dim) float16
+        self.pending = {}  # key -> (length, embed_dim) cpu tensor not flushed yet
+
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.index_path = os.path.join(self.folder, TextFeatureCache.INDEX_FILE)
+            self.tokens_path = os.path.join(self.folder, TextFeatureCache.TOKENS_FILE)
+            self._load()
+
+    @property
+    def device(self):
+        return self.text_encoder.device
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        assert index['embed_dim'] == self.embed_dim and index['normalize'] == self.normalize, \
+            f"Text cache {self.folder} was built with embed_dim={index['embed_dim']}, normalize={index['normalize']}"
+        self.entries = {k: tuple(v) for k, v in index['entries'].items()}
+        self.total_tokens = index['total_tokens']
+        self._open_tokens()
+
+    def _open_tokens(self):
+        if self.total_tokens == 0:
+            self.tokens = None
+            return
+        self.tokens = np.memmap(
+            self.tokens_path, dtype=np.float16, mode='r', shape=(self.total_tokens, self.embed_dim)
+        )
+
+    def __len__(self):
+        return len(self.entries) + len(self.pending)
+
+    def __contains__(self, text):
+        key = self.key(text)
+        return key in self.entries or key in self.pending
+
+    @torch.no_grad()
+    def _encode(self, texts):
+        """ Run the encoder on `texts` and keep the real-token rows of each one in RAM. """
+        embeddings, attention_mask = self.text_encoder(texts, normalize=False)
+        lengths = attention_mask.sum(dim=1).tolist()
+        embeddings = embeddings.float().cpu()
+        for text, embedding, length in zip(texts, embeddings, lengths):
+            row = embedding[:length]
+            if self.normalize:
+                row = F.normalize(row, p=2, dim=0)
+            self.pending[self.key(text)] = row.half()
+
+    def warm(self, texts, flush_every=16):
+        """
+        Encode every text not cached yet, e.g. the whole caption corpus before
+        training, flushing to disk every `flush_every` batches to bound RAM.
+        """
+        missing = list({t for t in texts if t not in self})
+        for i, start in enumerate(tqdm(range(0, len(missing), self.encode_batch_size), desc="Caching text features")):
+            self._encode(missing[start:start + self.encode_batch_size])
+            if (i + 1) % flush_every == 0:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        """ Append RAM entries to the packed on-disk array. """
+        if self.folder is None or not self.pending:
+            return
+
+        # -- rows appended by an interrupted flush are not in the index: cut them before appending
+        size = self.total_tokens * self.embed_dim * np.dtype(np.float16).itemsize
+        with open(self.tokens_path, 'r+b' if os.path.exists(self.tokens_path) else 'wb') as f:
+            f.truncate(size)
+            f.seek(size)
+            for key, row in self.pending.items():
+                f.write(row.numpy().tobytes())
+                self.entries[key] = (self.total_tokens, len(row))
+                self.total_tokens += len(row)
+        self.pending = {}
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'embed_dim': self.embed_dim,
+                'normalize': self.normalize,
+                'total_tokens': self.total_tokens,
+                'entries': self.entries,
+            }, f)
+        os.replace(tmp_path, self.index_path)
+        self._open_tokens()
+
+    def _row(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        offset, length = self.entries[key]
+        return torch.from_numpy(np.array(self.tokens[offset:offset + length]))
+
+    def __call__(self, texts, packed=False):
+        missing = list({t for t in texts if t not in self})
+        if missing:
+            self._encode(missing)
+
+        rows = [self._row(self.key(t)) for t in texts]
+        lengths = torch.tensor([len(r) for r in rows])
+
+        if packed:
+            # Rows are stored unpadded already: concatenate them as a PackedText
+            cu_seqlens = F.pad(torch.cumsum(lengths, dim=0, dtype=torch.int32), (1, 0))
+            tokens = torch.cat(rows).to(self.device, non_blocking=True).float()
+            return PackedText(tokens, cu_seqlens.to(self.device, non_blocking=True), int(lengths.max())), None
+
+        embeddings = torch.nn.utils.rnn.pad_sequence(rows, batch_first=True)
+        attention_mask = (torch.arange(embeddings.size(1))[None, :] < lengths[:, None]).long()
+
+        return (
+            embeddings.to(self.device, non_blocking=True).float(),
+            attention_mask.to(self.device, non_blocking=True),
+        )
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+from tqdm import tqdm
+
+
+class TokenStore:
+    """
+    Text-keyed store of pre-tokenized captions / questions.
+
+    Token ids of every text are packed back to back into one flat int32
+    `tokens.bin`; `index.json` maps sha1(text) -> (offset, length) and records
+    the tokenizer and max_length used. `get(texts)` returns the flat ids of a
+    batch with their lengths, ready for `TextEncoder.forward_tokens`, and
+    `lengths(texts)` lets samplers bucket batches by length without touching
+    the ids.
+    """
+    INDEX_FILE = 'index.json'
+    TOKENS_FILE = 'tokens.bin'
+
+    def __init__(self, folder, tokenizer_name, max_length):
+        self.folder = folder
+        self.tokenizer_name = tokenizer_name
+        self.max_length = max_length
+
+        self.entries = {}  # key -> (offset, length) into the flat id array
+        self.total_tokens = 0
+        self.tokens = None  # np.memmap (total_tokens,) int32
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.index_path = os.path.join(self.folder, TokenStore.INDEX_FILE)
+        self.tokens_path = os.path.join(self.folder, TokenStore.TOKENS_FILE)
+        self._load()
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        assert index['tokenizer'] == self.tokenizer_name and index['max_length'] == self.max_length, \
+            f"Token store {self.folder} was built with tokenizer={index['tokenizer']}, max_length={index['max_length']}"
+        self.entries = {k: tuple(v) for k, v in index['entries'].items()}
+        self.total_tokens = index['total_tokens']
+        self._open_tokens()
+
+    def _open_tokens(self):
+        if self.total_tokens == 0:
+            self.tokens = None
+            return
+        self.tokens = np.memmap(self.tokens_path, dtype=np.int32, mode='r', shape=(self.total_tokens,))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, text):
+        return self.key(text) in self.entries
+
+    def add(self, texts, tokenize_fn, batch_size=4096):
+        """
+        Tokenize every text not stored yet with `tokenize_fn(texts) -> [ids, ...]`
+        (e.g. `TextEncoder.tokenize`) and append it to the store. Run once over
+        the whole corpus before training.
+        """
+        missing = list({self.key(t): t for t in texts if t not in self}.items())
+        if not missing:
+            return
+
+        # -- ids appended by an interrupted run are not in the index: cut them before appending
+        size = self.total_tokens * np.dtype(np.int32).itemsize
+        with open(self.tokens_path, 'r+b' if os.path.exists(self.tokens_path) else 'wb') as f:
+            f.truncate(size)
+            f.seek(size)
+            for start in tqdm(range(0, len(missing), batch_size), desc="Tokenizing texts"):
+                chunk = missing[start:start + batch_size]
+                for (key, _), ids in zip(chunk, tokenize_fn([t for _, t in chunk])):
+                    f.write(np.asarray(ids, dtype=np.int32).tobytes())
+                    self.entries[key] = (self.total_tokens, len(ids))
+                    self.total_tokens += len(ids)
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'tokenizer': self.tokenizer_name,
+                'max_length': self.max_length,
+                'total_tokens': self.total_tokens,
+                'entries': self.entries,
+            }, f)
+        os.replace(tmp_path, self.index_path)
+        self._open_tokens()
+
+    def lengths(self, texts):
+        """ Token count of every text, as an int64 numpy array. """
+        return np.array([self.entries[self.key(t)][1] for t in texts], dtype=np.int64)
+
+    def get(self, texts):
+        """ (flat int32 ids, int64 lengths) of `texts`, concatenated in order. """
+        spans = [self.entries[self.key(t)] for t in texts]
+        input_ids = np.concatenate([self.tokens[offset:offset + length] for offset, length in spans])
+        lengths = torch.tensor([length for _, length in spans], dtype=torch.long)
+        return torch.from_numpy(input_ids), lengths
@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class MaskBank:
+    """
+    Precomputed mask grids, stored as packed bitsets in one `.npz` file.
+
+    The bank holds `n_groups` groups of `group_size` entries, every entry being
+    `n_masks` boolean (H, W) grids (e.g. context + target for MultiBlock, the
+    npred + nenc blocks of one sample for MaskCollator). Entries of a group
+    were drawn together, so a batch takes its masks from a single group.
+
+    Step `s` uses group `perm_c[s % n_groups]`, where `perm_c` is a permutation
+    seeded by the bank seed and the cycle `c = s // n_groups`: masks of every
+    step are a pure function of (bank, step), identical across ranks and
+    resumes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as data:
+            self.bits = data['bits']  # (n_groups, group_size, n_masks, ceil(H*W / 8)) uint8
+            meta = json.loads(str(data['meta']))
+        self.height, self.width = meta['height'], meta['width']
+        self.seed = meta['seed']
+        self.config = meta['config']
+        self.n_groups, self.group_size, self.n_masks, _ = self.bits.shape
+        self._cycle_perm = (None, None)  # (cycle, permutation), swapped as one tuple: group() runs from prefetch threads
+
+    def __len__(self):
+        return self.n_groups
+
+    @staticmethod
+    def save(path, grids, seed, config):
+        """
+        Write a bank from a boolean (n_groups, group_size, n_masks, H, W) tensor.
+        `config` records the sampler parameters the grids were drawn with.
+        """
+        grids = torch.as_tensor(grids, dtype=torch.bool)
+        n_groups, group_size, n_masks, height, width = grids.shape
+        bits = np.packbits(grids.flatten(3).numpy(), axis=-1)
+        meta = {'height': height, 'width': width, 'seed': seed, 'config': config}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            np.savez(f, bits=bits, meta=np.array(json.dumps(meta)))
+        print(f"Saved mask bank {path}: {n_groups} groups x {group_size} entries x {n_masks} masks ({bits.nbytes / 1024**2:.1f} MB)")
+
+    def check(self, **config):
+        """ Assert the bank was drawn with the given sampler parameters. """
+        for k, v in config.items():
+            stored = self.config.get(k)
+            assert stored == (list(v) if isinstance(v, tuple) else v), \
+                f"Mask bank {self.path} was built with {k}={stored}, not {v}"
+
+    def group(self, step):
+        """ Index of the group used at `step`. """
+        cycle, position = divmod(step, self.n_groups)
+        cached_cycle, perm = self._cycle_perm
+        if cycle != cached_cycle:
+            perm = np.random.default_rng(self.seed + cycle).permutation(self.n_groups)
+            self._cycle_perm = (cycle, perm)
+        return int(perm[position])
+
+    def grids(self, step, batch_size=None):
+        """ Boolean (batch_size, n_masks, H * W) grids of `step` (default: the whole group). """
+        batch_size = batch_size or self.group_size
+        assert batch_size <= self.group_size, f"Mask bank groups hold {self.group_size} entries, asked for {batch_size}"
+        bits = self.bits[self.group(step), :batch_size]
+        grids = np.unpackbits(bits, axis=-1, count=self.height * self.width)
+        return torch.from_numpy(grids).bool()
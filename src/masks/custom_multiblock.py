@@ -1,7 +1,31 @@
 import random
+
+from logging import getLogger
+
 import torch
 
+from src.masks.bank import MaskBank
+
+logger = getLogger()
+
 class MultiBlock:
+    """
+    Context / target patch indices for T-JEPA.
+
+    Blocks are sampled with tensor RNG and rasterized into boolean (H, W)
+    grids, indices then come from `nonzero` (shared mode) or `argsort`
+    (`per_sample=True`, one draw per batch element, every row truncated to
+    the smallest count of the batch so the masks stay rectangular).
+    `vectorized=False` keeps the original python-loop sampler.
+
+    With a `mask_bank` (MaskBank or path, see `build_mask_bank`), masks of
+    step `s` are read from the bank instead, reproducible from the step alone.
+
+    `n_views > 1` draws that many context / target pairs per sample, returned
+    as (batch_size, n_views, K) indices: every view keeps all its patches and
+    shorter views are padded with -1 (see `flatten_views` for the validity
+    masks); view v of bank step `s` is bank step `s * n_views + v`.
+    """
     def __init__(
             self, 
             grid_size,
@@ -11,16 +35,35 @@ class MultiBlock:
             context_scale=(0.85, 1.0), 
             device_context_masks='cuda',
             device_predict_masks='cuda',
+            per_sample=False,
+            vectorized=True,
+            seed=None,
+            mask_bank=None,
+            n_views=1,
         ):
         self.block_scale = block_scale  # Portion of the image area the block should cover
         self.n_block = n_block
         self.block_aspect_ratio = block_aspect_ratio
         self.context_scale = context_scale  # Portion of the image area for context
         self.grid_size = grid_size  # 14x14 patches for a 224x224 image
-        print(f"{self.grid_size=}")
+        logger.debug(f"MultiBlock grid_size={self.grid_size}")
         self.total_patches = self.grid_size * self.grid_size  # 196 patches
         self.device_context_masks = device_context_masks
         self.device_predict_masks = device_predict_masks
+        self.per_sample = per_sample  # Different blocks for every batch element
+        self.vectorized = vectorized
+        self.n_views = n_views  # Context / target pairs per sample, one frozen forward for all of them
+        # Default RNG unless seeded, so DataLoader workers (reseeded per worker) draw different masks
+        self.generator = None if seed is None else torch.Generator().manual_seed(seed)
+        self._coords = torch.arange(self.grid_size)
+
+        self.mask_bank = MaskBank(mask_bank) if isinstance(mask_bank, str) else mask_bank
+        if self.mask_bank is not None:
+            self.mask_bank.check(
+                grid_size=grid_size, block_scale=block_scale, n_block=n_block,
+                block_aspect_ratio=block_aspect_ratio, context_scale=context_scale,
+            )
+        self._step = 0  # Bank step used when __call__ is not given one
 
     def _sample_block(self, scale_range, aspect_ratio_range):
         """Sample a random block (w, h) based on the area and aspect ratio ranges."""
@@ -58,7 +101,117 @@ class MultiBlock:
         # print(f"Block width: {block_width}, Block height: {block_height}")
         return indices
 
-    def __call__(self, batch_size):
+    def _uniform(self, shape, low, high):
+        return low + (high - low) * torch.rand(shape, generator=self.generator)
+
+    def _sample_blocks(self, shape, scale_range, aspect_ratio_range):
+        """
+        Rasterize `shape` = (S, n) random blocks into a (S, H, W) boolean grid,
+        the union of the n blocks of every row. Same size rule as _sample_block.
+        """
+        block_area = self._uniform(shape, *scale_range) * self.total_patches
+        aspect_ratio = self._uniform(shape, *aspect_ratio_range)
+
+        block_height = torch.round(torch.sqrt(block_area / aspect_ratio))
+        block_width = torch.round(block_height * aspect_ratio)
+        block_height = block_height.clamp(max=self.grid_size).long()
+        block_width = block_width.clamp(max=self.grid_size).long()
+
+        # Top-left corners, uniform over every position keeping the block inside the grid
+        start_y = (torch.rand(shape, generator=self.generator) * (self.grid_size - block_height + 1)).long()
+        start_x = (torch.rand(shape, generator=self.generator) * (self.grid_size - block_width + 1)).long()
+
+        ys = self._coords.view(1, 1, -1, 1)
+        xs = self._coords.view(1, 1, 1, -1)
+        inside = (
+            (ys >= start_y[..., None, None]) & (ys < (start_y + block_height)[..., None, None]) &
+            (xs >= start_x[..., None, None]) & (xs < (start_x + block_width)[..., None, None])
+        )  # (S, n, H, W)
+        return inside.any(dim=1)
+
+    def sample_grids(self, batch_size):
+        """ Boolean (S, H, W) context and target grids, S = (batch_size in per-sample mode, else 1) * n_views. """
+        S = (batch_size if self.per_sample else 1) * self.n_views
+        target = self._sample_blocks((S, self.n_block), self.block_scale, self.block_aspect_ratio)
+        context = self._sample_blocks((S, 1), self.context_scale, self.context_scale)
+        return context & ~target, target
+
+    def _grid_to_indices(self, grid, random_subset=True, pad=False):
+        """
+        (S, K) flat patch indices in raster order from a (S, H, W) boolean grid.
+        pad: every row keeps all its patches, padded with -1 to the largest count.
+        """
+        grid = grid.flatten(1)
+        if pad:
+            counts = grid.sum(dim=1)
+            indices = (~grid).int().argsort(dim=1, stable=True)[:, :int(counts.max())]
+            return indices.masked_fill(torch.arange(indices.size(1)) >= counts[:, None], -1)
+        if grid.size(0) == 1:
+            return grid[0].nonzero().squeeze(1).unsqueeze(0)
+
+        keep = int(grid.sum(dim=1).min())
+        if not random_subset:
+            # First min(count) patches of every row, deterministic for bank masks
+            return (~grid).int().argsort(dim=1, stable=True)[:, :keep]
+
+        # Keep a random subset of min(count) patches per row, then restore raster order
+        scores = torch.rand(grid.shape, generator=self.generator) - grid.float()
+        indices = scores.argsort(dim=1)[:, :keep]
+        return indices.sort(dim=1).values
+
+    def build_mask_bank(self, path, n_groups, group_size=1, seed=0, chunk_size=1024):
+        """
+        Draw `n_groups` groups of `group_size` (context, target) grid pairs and
+        save them as a MaskBank. group_size=1 gives masks shared across the
+        batch, group_size=batch_size per-sample masks.
+        """
+        generator, self.generator = self.generator, torch.Generator().manual_seed(seed)
+        grids = []
+        for start in range(0, n_groups, chunk_size):
+            S = min(chunk_size, n_groups - start) * group_size
+            target = self._sample_blocks((S, self.n_block), self.block_scale, self.block_aspect_ratio)
+            context = self._sample_blocks((S, 1), self.context_scale, self.context_scale) & ~target
+            grids.append(torch.stack([context, target], dim=1))
+        self.generator = generator
+
+        grids = torch.cat(grids).view(n_groups, group_size, 2, self.grid_size, self.grid_size)
+        MaskBank.save(path, grids, seed, config={
+            'grid_size': self.grid_size,
+            'block_scale': list(self.block_scale),
+            'n_block': self.n_block,
+            'block_aspect_ratio': list(self.block_aspect_ratio),
+            'context_scale': list(self.context_scale),
+        })
+        return MaskBank(path)
+
+    def __call__(self, batch_size, step=None):
+        if self.mask_bank is not None:
+            if step is None:
+                step, self._step = self._step, self._step + 1
+            S = batch_size if self.mask_bank.group_size > 1 else 1
+            grids = torch.cat([self.mask_bank.grids(step * self.n_views + v, S) for v in range(self.n_views)])
+            context, target = grids[:, 0], grids[:, 1]
+        elif not self.vectorized:
+            assert self.n_views == 1, "n_views > 1 needs the vectorized sampler"
+            return self._call_loops(batch_size)
+        else:
+            context, target = self.sample_grids(batch_size)
+
+        # Shared masks are moved once and broadcast over the batch without a copy
+        random_subset = self.mask_bank is None
+        pad = self.n_views > 1  # Views differ in size: pad them rather than cut their blocks
+        context_batch = self._expand(self._grid_to_indices(context, random_subset, pad).to(self.device_context_masks), batch_size)  # (batch_size, [n_views,] num_context_indices)
+        target_batch = self._expand(self._grid_to_indices(target, random_subset, pad).to(self.device_predict_masks), batch_size)    # (batch_size, [n_views,] num_target_indices)
+
+        return context_batch, target_batch
+
+    def _expand(self, indices, batch_size):
+        """ View-major (n_views * S, K) indices to (batch_size, K), or (batch_size, n_views, K) with several views. """
+        if self.n_views == 1:
+            return indices.expand(batch_size, -1)
+        return indices.view(self.n_views, -1, indices.size(-1)).transpose(0, 1).expand(batch_size, -1, -1)
+
+    def _call_loops(self, batch_size):
         # Step 1: Randomly sample target blocks (shared across the batch)
         target_indices = set()
         for _ in range(self.n_block):
@@ -84,3 +237,45 @@ class MultiBlock:
         target_batch = target_indices_tensor.unsqueeze(0).repeat(batch_size, 1).to(self.device_predict_masks)    # (batch_size, num_target_indices)
 
         return context_batch, target_batch
+
+
+class MultiBlockCollator:
+    """
+    DataLoader collate_fn for (image, caption) samples: stacks the images,
+    gathers the captions and draws the MultiBlock context/predict masks for
+    the batch, like MaskCollator does for the I-JEPA path. Masks are built on
+    the CPU since collation runs in the loader workers.
+
+    Samples come as `(step, (image, caption))` pairs from
+    `make_loader(with_steps=True)`: the global step of the batch picks the
+    bank masks, so they do not depend on worker scheduling, epochs or resumes.
+    """
+    def __init__(
+            self,
+            grid_size,
+            block_scale=(0.15, 0.2),
+            n_block=4,
+            block_aspect_ratio=(0.75, 1.5),
+            context_scale=(0.85, 1.0),
+            mask_bank=None,
+            n_views=1,
+        ):
+        self.multiblock = MultiBlock(
+            grid_size=grid_size,
+            block_scale=block_scale,
+            n_block=n_block,
+            block_aspect_ratio=block_aspect_ratio,
+            context_scale=context_scale,
+            device_context_masks='cpu',
+            device_predict_masks='cpu',
+            mask_bank=mask_bank,
+            n_views=n_views,
+        )
+
+    def __call__(self, batch):
+        step = batch[0][0]
+        images = torch.stack([image for _, (image, _) in batch])
+        captions = [caption for _, (_, caption) in batch]
+
+        context_masks, predict_masks = self.multiblock(len(batch), step=step)
+        return images, captions, context_masks, predict_masks
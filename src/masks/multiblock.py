@@ -13,6 +13,8 @@ from logging import getLogger
 
 import torch
 
+from src.masks.bank import MaskBank
+
 _GLOBAL_SEED = 0
 logger = getLogger()
 
@@ -29,7 +31,10 @@ class MaskCollator(object):
         nenc=1,
         npred=2,
         min_keep=4,
-        allow_overlap=False
+        allow_overlap=False,
+        mask_bank=None,
+        vectorized=True,
+        max_tries=20
     ):
         super(MaskCollator, self).__init__()
         if not isinstance(input_size, tuple):
@@ -44,6 +49,12 @@ class MaskCollator(object):
         self.min_keep = min_keep  # minimum number of patches to keep
         self.allow_overlap = allow_overlap  # whether to allow overlap b/w enc and pred masks
         self._itr_counter = Value('i', -1)  # collator is shared across worker processes
+        self.vectorized = vectorized  # batched rejection sampling instead of the per-mask python loop
+        self.max_tries = max_tries  # candidates per acceptable-region level, the `og_timeout` of _sample_block_mask
+        # -- optional MaskBank (or path): masks of step `itr` are read from the bank instead of sampled
+        self.mask_bank = MaskBank(mask_bank) if isinstance(mask_bank, str) else mask_bank
+        if self.mask_bank is not None:
+            self.mask_bank.check(**self._bank_config())
 
     def step(self):
         i = self._itr_counter
@@ -109,6 +120,144 @@ class MaskCollator(object):
         # --
         return mask, mask_complement
 
+    def _sample_masks(self, p_size, e_size):
+        """ npred target masks and nenc context masks (flat indices) of one image """
+        masks_p, masks_C = [], []
+        for _ in range(self.npred):
+            mask, mask_C = self._sample_block_mask(p_size)
+            masks_p.append(mask)
+            masks_C.append(mask_C)
+
+        acceptable_regions = masks_C
+        try:
+            if self.allow_overlap:
+                acceptable_regions= None
+        except Exception as e:
+            logger.warning(f'Encountered exception in mask-generator {e}')
+
+        masks_e = []
+        for _ in range(self.nenc):
+            mask, _ = self._sample_block_mask(e_size, acceptable_regions=acceptable_regions)
+            masks_e.append(mask)
+        return masks_p, masks_e
+
+    def _block_grids(self, top, left, b_size):
+        """ Flat boolean masks of (h, w) blocks at every (top, left), shape top.shape + (H*W,) """
+        h, w = b_size
+        rows = torch.arange(self.height)
+        cols = torch.arange(self.width)
+        in_rows = (rows >= top[..., None]) & (rows < top[..., None] + h)
+        in_cols = (cols >= left[..., None]) & (cols < left[..., None] + w)
+        return (in_rows[..., :, None] & in_cols[..., None, :]).flatten(-2)
+
+    def _sample_batch_masks(self, B, p_size, e_size):
+        """
+        Batched equivalent of calling _sample_masks for B images.
+
+        Every context block draws (npred + 1) * max_tries candidate corners at
+        once; candidate t is checked against the acceptable regions of retry
+        level t // max_tries (the last `level` target complements dropped, as
+        `tries` does in _sample_block_mask) and the first one keeping more than
+        min_keep patches is taken; blocks without one are redrawn unconstrained,
+        so no mask the loop would reject is ever returned. Returns (B, npred, H*W) and (B, nenc, H*W)
+        boolean masks.
+        """
+        (ph, pw), (eh, ew) = p_size, e_size
+        N = self.height * self.width
+
+        # -- target blocks never get constrained
+        top = torch.randint(0, self.height - ph, (B, self.npred))
+        left = torch.randint(0, self.width - pw, (B, self.npred))
+        masks_p = self._block_grids(top, left, p_size)
+
+        # -- acceptable regions of every retry level: AND of the first npred - level complements
+        n_levels = self.npred + 1
+        if self.allow_overlap:
+            regions = torch.ones((B, n_levels, N), dtype=torch.bool)
+        else:
+            complements = (~masks_p).long().cumprod(dim=1).bool()  # [:, k] = AND of the first k + 1 complements
+            regions = torch.cat([
+                complements.flip(1),
+                torch.ones((B, 1, N), dtype=torch.bool),
+            ], dim=1)
+
+        # -- all candidate context blocks at once
+        T = n_levels * self.max_tries
+        top = torch.randint(0, self.height - eh, (B, self.nenc, T))
+        left = torch.randint(0, self.width - ew, (B, self.nenc, T))
+        levels = torch.arange(T) // self.max_tries
+        candidates = self._block_grids(top, left, e_size) & regions[:, levels].unsqueeze(1)  # (B, nenc, T, N)
+
+        valid = candidates.sum(dim=-1) > self.min_keep
+        first = valid.int().argmax(dim=-1)  # index of the first valid candidate
+        missing = ~valid.any(dim=-1)  # (B, nenc) blocks without any valid candidate
+        level = n_levels if missing.any() else int(first.max()) // self.max_tries
+        if level > 0:
+            logger.warning(f'Mask generator says: "Valid mask not found, decreasing acceptable-regions [{level}]"')
+        masks_e = candidates.gather(2, first[..., None, None].expand(-1, -1, 1, N)).squeeze(2)
+
+        if missing.any():
+            # -- the loop keeps drawing at the last (unconstrained) level, where a block keeps all its patches
+            assert eh * ew > self.min_keep, \
+                f"Context blocks of {eh}x{ew} patches can never keep more than min_keep={self.min_keep} patches"
+            n = int(missing.sum())
+            top = torch.randint(0, self.height - eh, (n,))
+            left = torch.randint(0, self.width - ew, (n,))
+            masks_e[missing] = self._block_grids(top, left, e_size)
+
+        return masks_p, masks_e
+
+    @staticmethod
+    def _first_indices(masks, keep):
+        """ First `keep` patch indices (raster order) of every flat boolean mask, as nonzero()[:keep] """
+        return (~masks).int().argsort(dim=-1, stable=True)[..., :keep]
+
+    def _bank_config(self):
+        return {
+            'height': self.height,
+            'width': self.width,
+            'enc_mask_scale': list(self.enc_mask_scale),
+            'pred_mask_scale': list(self.pred_mask_scale),
+            'aspect_ratio': list(self.aspect_ratio),
+            'nenc': self.nenc,
+            'npred': self.npred,
+            'min_keep': self.min_keep,
+            'allow_overlap': self.allow_overlap,
+        }
+
+    def build_mask_bank(self, path, n_groups, group_size, seed=_GLOBAL_SEED):
+        """
+        Sample `n_groups` batches of `group_size` images exactly like __call__
+        (block sizes shared within a group) and save them as a MaskBank.
+        """
+        torch.manual_seed(seed)
+        N = self.height * self.width
+        grids = torch.zeros((n_groups, group_size, self.npred + self.nenc, N), dtype=torch.bool)
+        for group in range(n_groups):
+            g = torch.Generator()
+            g.manual_seed(seed + group)
+            p_size = self._sample_block_size(generator=g, scale=self.pred_mask_scale, aspect_ratio_scale=self.aspect_ratio)
+            e_size = self._sample_block_size(generator=g, scale=self.enc_mask_scale, aspect_ratio_scale=(1., 1.))
+            for i in range(group_size):
+                masks_p, masks_e = self._sample_masks(p_size, e_size)
+                for j, mask in enumerate(masks_p + masks_e):
+                    grids[group, i, j, mask] = True
+        grids = grids.view(n_groups, group_size, self.npred + self.nenc, self.height, self.width)
+        MaskBank.save(path, grids, seed, config=self._bank_config())
+        return MaskBank(path)
+
+    def _bank_masks(self, step, B):
+        """ (masks_enc, masks_pred) of `step` from the mask bank, truncated like sampled masks """
+        grids = self.mask_bank.grids(step, B)
+        masks = [[grid.nonzero().squeeze(1) for grid in entry] for entry in grids]
+        masks_pred = [m[:self.npred] for m in masks]
+        masks_enc = [m[self.npred:] for m in masks]
+        min_keep_pred = min(len(m) for ms in masks_pred for m in ms)
+        min_keep_enc = min(len(m) for ms in masks_enc for m in ms)
+        collated_masks_pred = torch.utils.data.default_collate([[cm[:min_keep_pred] for cm in ms] for ms in masks_pred])
+        collated_masks_enc = torch.utils.data.default_collate([[cm[:min_keep_enc] for cm in ms] for ms in masks_enc])
+        return collated_masks_enc, collated_masks_pred
+
     def __call__(self, batch):
         '''
         Create encoder and predictor masks when collating imgs into a batch
@@ -123,6 +272,9 @@ class MaskCollator(object):
         collated_batch = torch.utils.data.default_collate(batch)
 
         seed = self.step()
+        if self.mask_bank is not None:
+            return (collated_batch,) + self._bank_masks(seed, B)
+
         g = torch.Generator()
         g.manual_seed(seed)
         p_size = self._sample_block_size(
@@ -134,31 +286,24 @@ class MaskCollator(object):
             scale=self.enc_mask_scale,
             aspect_ratio_scale=(1., 1.))
 
+        if self.vectorized:
+            masks_p, masks_e = self._sample_batch_masks(B, p_size, e_size)
+            min_keep_pred = int(masks_p.sum(dim=-1).min())
+            min_keep_enc = int(masks_e.sum(dim=-1).min())
+            masks_p = self._first_indices(masks_p, min_keep_pred)
+            masks_e = self._first_indices(masks_e, min_keep_enc)
+            collated_masks_pred = [masks_p[:, j] for j in range(self.npred)]
+            collated_masks_enc = [masks_e[:, j] for j in range(self.nenc)]
+            return collated_batch, collated_masks_enc, collated_masks_pred
+
         collated_masks_pred, collated_masks_enc = [], []
         min_keep_pred = self.height * self.width
         min_keep_enc = self.height * self.width
         for _ in range(B):
-
-            masks_p, masks_C = [], []
-            for _ in range(self.npred):
-                mask, mask_C = self._sample_block_mask(p_size)
-                masks_p.append(mask)
-                masks_C.append(mask_C)
-                min_keep_pred = min(min_keep_pred, len(mask))
+            masks_p, masks_e = self._sample_masks(p_size, e_size)
+            min_keep_pred = min([min_keep_pred] + [len(m) for m in masks_p])
+            min_keep_enc = min([min_keep_enc] + [len(m) for m in masks_e])
             collated_masks_pred.append(masks_p)
-
-            acceptable_regions = masks_C
-            try:
-                if self.allow_overlap:
-                    acceptable_regions= None
-            except Exception as e:
-                logger.warning(f'Encountered exception in mask-generator {e}')
-
-            masks_e = []
-            for _ in range(self.nenc):
-                mask, _ = self._sample_block_mask(e_size, acceptable_regions=acceptable_regions)
-                masks_e.append(mask)
-                min_keep_enc = min(min_keep_enc, len(mask))
             collated_masks_enc.append(masks_e)
 
         collated_masks_pred = [[cm[:min_keep_pred] for cm in cm_list] for cm_list in collated_masks_pred]
@@ -6,12 +6,15 @@
 #
 
 import math
+import importlib.util
+from collections import OrderedDict
 from functools import partial
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 from src.utils.tensors import (
     trunc_normal_,
@@ -19,6 +22,7 @@ from src.utils.tensors import (
 )
 # from src.masks.utils import apply_masks
 from src.utils.tensors import apply_masks
+from src.models.tome import bipartite_soft_matching, merge_wavg, merge_schedule
 
 
 def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False):
@@ -84,6 +88,62 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     return emb
 
 
+def interpolate_pos_embed(pos_embed, grid_size, cls_token=False):
+    """
+    Resize a (1, [1 +] side * side, D) positional table to a (grid_h, grid_w)
+    patch grid with bicubic interpolation; the cls entry is kept as is.
+    """
+    n_cls = 1 if cls_token else 0
+    _, N, dim = pos_embed.shape
+    side = int(math.sqrt(N - n_cls))
+    if (side, side) == tuple(grid_size):
+        return pos_embed
+    cls_embed, pos_embed = pos_embed[:, :n_cls], pos_embed[:, n_cls:]
+    pos_embed = nn.functional.interpolate(
+        pos_embed.reshape(1, side, side, dim).permute(0, 3, 1, 2),
+        size=tuple(grid_size),
+        mode='bicubic',
+        align_corners=False,
+    )
+    pos_embed = pos_embed.permute(0, 2, 3, 1).reshape(1, -1, dim)
+    return torch.cat((cls_embed, pos_embed), dim=1)
+
+
+class PosEmbedCache:
+    """
+    Positional tables interpolated to other patch grids, kept per
+    (grid_h, grid_w) in a bounded LRU so every input resolution is resized
+    once. Entries are dropped whenever the source table changes (new values
+    from load_state_dict, or another device / dtype); trainable tables are
+    never cached, so gradients still flow through the interpolation.
+    """
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.tables = OrderedDict()
+        self.source = None
+
+    def __call__(self, pos_embed, grid_size, cls_token=False):
+        if pos_embed.requires_grad:
+            return interpolate_pos_embed(pos_embed, grid_size, cls_token)
+
+        source = (pos_embed.data_ptr(), pos_embed._version, pos_embed.dtype)
+        if source != self.source:
+            self.tables.clear()
+            self.source = source
+
+        grid_size = tuple(grid_size)
+        if grid_size in self.tables:
+            self.tables.move_to_end(grid_size)
+            return self.tables[grid_size]
+
+        table = interpolate_pos_embed(pos_embed, grid_size, cls_token)
+        self.tables[grid_size] = table
+        if len(self.tables) > self.max_size:
+            self.tables.popitem(last=False)
+        return table
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False):
     if drop_prob == 0. or not training:
         return x
@@ -106,6 +166,26 @@ class DropPath(nn.Module):
         return drop_path(x, self.drop_prob, self.training)
 
 
+def checkpointed_blocks(setting, depth):
+    """
+    Indices of the blocks whose activations are recomputed in backward:
+    None / 0 for none, an int k for every k-th block (1: all), or a list of indices.
+    """
+    if not setting:
+        return set()
+    if isinstance(setting, int):
+        return set(range(0, depth, setting))
+    assert all(0 <= i < depth for i in setting), f"Checkpointed block indices {setting} out of range for depth {depth}"
+    return set(setting)
+
+
+def run_block(block, checkpointed, *args, **kwargs):
+    """ block(*args, **kwargs), through torch.utils.checkpoint when checkpointed and building a graph. """
+    if checkpointed and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(block, *args, use_reentrant=False, **kwargs)
+    return block(*args, **kwargs)
+
+
 class MLP(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
         super().__init__()
@@ -125,113 +205,322 @@ class MLP(nn.Module):
         return x
 
 
+# -- attention backend: 'sdpa' (F.scaled_dot_product_attention, flash / memory-efficient kernels)
+#    or 'math' (explicit softmax(q k^T) v). Modules with backend=None follow this default.
+ATTENTION_BACKEND = 'sdpa'
+
+
+def set_attention_backend(backend):
+    global ATTENTION_BACKEND
+    assert backend in ('sdpa', 'math'), f"Unknown attention backend {backend}"
+    ATTENTION_BACKEND = backend
+
+
+def attention(q, k, v, scale, attn_masks=None, dropout_p=0., attn_drop=None, return_attention=False, backend=None, attn_bias=None):
+    """
+    softmax(q k^T * scale) v over (B, heads, N, head_dim) tensors.
+
+    attn_masks: (B, N_kv) key padding mask, 1 for tokens to attend to.
+    attn_bias: (B, N_kv) float added to the scores of every key instead,
+    e.g. log token sizes for proportional attention after token merging.
+    The (B, heads, N_q, N_kv) attention probabilities are only materialized
+    (math path) when return_attention is set, otherwise None is returned.
+    """
+    backend = backend or ATTENTION_BACKEND
+    assert attn_masks is None or attn_bias is None, "attn_masks and attn_bias are exclusive"
+    if backend == 'sdpa' and not return_attention:
+        mask = None if attn_masks is None else attn_masks.bool()[:, None, None, :]
+        if attn_bias is not None:
+            mask = attn_bias.to(q.dtype)[:, None, None, :]
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p, scale=scale), None
+
+    attn = (q @ k.transpose(-2, -1)) * scale
+    if attn_masks is not None:
+        # Add mask to attention scores (mask should broadcast to (B, num_heads, N_q, N_kv))
+        attn = attn.masked_fill(attn_masks.unsqueeze(1).unsqueeze(2) == 0, float('-inf'))
+    if attn_bias is not None:
+        attn = attn + attn_bias[:, None, None, :]
+    attn = attn.softmax(dim=-1)
+    if attn_drop is not None:
+        attn = attn_drop(attn)
+    return attn @ v, (attn if return_attention else None)
+
+
+class PackedText:
+    """
+    Variable-length text tokens without padding: the real tokens of every
+    text back to back in one (total_tokens, ...) tensor, plus (B + 1,) int32
+    cumulative sequence lengths. Token-wise layers run on `tokens` directly
+    (see `map`); CrossAttention keys / values stay packed down to attention.
+    """
+
+    def __init__(self, tokens, cu_seqlens, max_seqlen):
+        self.tokens = tokens
+        self.cu_seqlens = cu_seqlens
+        self.max_seqlen = max_seqlen
+        self._padding = None
+
+    @staticmethod
+    def from_padded(x, attn_masks):
+        """ Pack a padded (B, N, ...) batch with its (B, N) mask, 1 for real tokens (left-aligned). """
+        attn_masks = attn_masks.bool()
+        lengths = attn_masks.sum(dim=1, dtype=torch.int32)
+        cu_seqlens = F.pad(torch.cumsum(lengths, dim=0, dtype=torch.int32), (1, 0))
+        return PackedText(x[attn_masks], cu_seqlens, int(lengths.max()))
+
+    @property
+    def lengths(self):
+        return self.cu_seqlens[1:] - self.cu_seqlens[:-1]
+
+    @property
+    def batch_size(self):
+        return self.cu_seqlens.numel() - 1
+
+    def with_tokens(self, tokens):
+        """ Same sequences, other per-token values (e.g. projected keys). """
+        packed = PackedText(tokens, self.cu_seqlens, self.max_seqlen)
+        packed._padding = self._padding
+        return packed
+
+    def map(self, fn):
+        """ Apply a token-wise function (Linear, LayerNorm, MLP, ...) to the packed tokens. """
+        return self.with_tokens(fn(self.tokens))
+
+    def padding(self):
+        """ (B, max_seqlen) gather index into `tokens` and the matching padding mask. """
+        if self._padding is None:
+            positions = torch.arange(self.max_seqlen, device=self.tokens.device)
+            attn_masks = positions[None, :] < self.lengths[:, None]
+            index = (self.cu_seqlens[:-1, None] + positions[None, :]).clamp_(max=self.tokens.size(0) - 1)
+            self._padding = index, attn_masks
+        return self._padding
+
+    def to_padded(self):
+        """ (B, max_seqlen, ...) padded tokens (zeros at padding) and their long mask, as TextEncoder returns them. """
+        index, attn_masks = self.padding()
+        mask = attn_masks.view(*attn_masks.shape, *([1] * (self.tokens.dim() - 1)))
+        return self.tokens[index].masked_fill(~mask, 0), attn_masks.long()
+
+
+def packed_attention(q, k, v, scale, dropout_p=0., attn_drop=None, return_attention=False, backend=None):
+    """
+    `attention` of dense (B, heads, N_q, head_dim) queries over packed
+    (total_tokens, heads, head_dim) keys / values. With the sdpa backend on
+    CUDA the keys go to F.scaled_dot_product_attention as a jagged nested
+    tensor, so no padding is materialized; otherwise they are padded to the
+    longest text and masked.
+    """
+    backend = backend or ATTENTION_BACKEND
+    B, H, N_q, head_dim = q.shape
+    if (backend == 'sdpa' and not return_attention and q.is_cuda and k.batch_size == B
+            and hasattr(torch.nested, 'nested_tensor_from_jagged')):
+        q_offsets = torch.arange(0, (B + 1) * N_q, N_q, device=q.device)
+        kv_offsets = k.cu_seqlens.long()
+        q_nt = torch.nested.nested_tensor_from_jagged(q.transpose(1, 2).reshape(B * N_q, H, head_dim), q_offsets)
+        k_nt = torch.nested.nested_tensor_from_jagged(k.tokens, kv_offsets)
+        v_nt = torch.nested.nested_tensor_from_jagged(v.tokens, kv_offsets)
+        x = F.scaled_dot_product_attention(
+            q_nt.transpose(1, 2), k_nt.transpose(1, 2), v_nt.transpose(1, 2), dropout_p=dropout_p, scale=scale)
+        return x.transpose(1, 2).values().view(B, N_q, H, head_dim).transpose(1, 2), None
+
+    index, attn_masks = k.padding()
+    K, V = k.tokens[index].transpose(1, 2), v.tokens[index].transpose(1, 2)  # (B_text, heads, max_seqlen, head_dim)
+    if K.size(0) != B:
+        K, V, attn_masks = K.expand(B, -1, -1, -1), V.expand(B, -1, -1, -1), attn_masks.expand(B, -1)
+    return attention(
+        q, K, V, scale, attn_masks=attn_masks, dropout_p=dropout_p, attn_drop=attn_drop,
+        return_attention=return_attention, backend=backend)
+
+
+def project_kv(kv, num_heads, Z):
+    """
+    Keys and values of the tokens Z, (B, num_heads, N_kv, head_dim) each, or
+    (total_tokens, num_heads, head_dim) PackedText if Z is packed, from one
+    fused `kv` Linear (also when quantized by quantize_int8).
+    """
+    if isinstance(Z, PackedText):
+        # Packed text: (total_tokens, num_heads, head_dim) keys / values, no padding
+        K, V = kv(Z.tokens).unflatten(-1, (2, num_heads, -1)).unbind(1)
+        return Z.with_tokens(K), Z.with_tokens(V)
+    B, N_kv, _ = Z.shape
+    KV = kv(Z).reshape(B, N_kv, 2, num_heads, -1).permute(2, 0, 3, 1, 4)
+    return KV[0], KV[1]
+
+
+def fuse_kv_state_dict(state_dict, prefix):
+    """ Checkpoints from before the fused `kv` Linear store `key` / `value` apart: concatenate them in place. """
+    for name in ('weight', 'bias'):
+        key, value = prefix + 'key.' + name, prefix + 'value.' + name
+        if key in state_dict and value in state_dict:
+            state_dict[prefix + 'kv.' + name] = torch.cat([state_dict.pop(key), state_dict.pop(value)])
+
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., backend=None):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.backend = backend
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, return_attention=False, attn_masks=None):
+        """ attn_masks: optional (B, N) key mask, 0 for padding tokens no token attends to """
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        x, attn = attention(
+            q, k, v, self.scale, attn_masks,
+            dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+            return_attention=return_attention, backend=self.backend)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, attn
 
+    def forward_merging(self, x, size=None):
+        """
+        Forward for token merging: attention weighted by the (B, N, 1) token
+        sizes (proportional attention), also returning the head-averaged keys
+        used as similarity metric.
+        """
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        x, _ = attention(
+            q, k, v, self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+            backend=self.backend, attn_bias=None if size is None else size.log()[..., 0])
+
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x, k.mean(dim=1)
+
 class CrossAttentionSameDim(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., backend=None):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.backend = backend
 
         # Linear layers for queries, keys, and values
         self.query = nn.Linear(dim, dim, bias=qkv_bias)
-        self.key = nn.Linear(dim, dim, bias=qkv_bias)
-        self.value = nn.Linear(dim, dim, bias=qkv_bias)
+        self.kv = nn.Linear(dim, 2 * dim, bias=qkv_bias)  # keys and values in one matmul
         
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, X, Z, attn_masks=None):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_kv_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_kv(self, Z):
+        """ Keys and values of Z, (B, num_heads, N_kv, head_dim) each (packed if Z is PackedText) """
+        return project_kv(self.kv, self.num_heads, Z)
+
+    def forward(self, X, Z, attn_masks=None, return_attention=False, kv=None):
+        """ kv: optional (K, V) from project_kv, e.g. of one text broadcast over a batch of images; Z is then unused """
         B, N_q, C = X.shape  # B: batch size, N_q: number of query tokens, C: embedding dimension
-        _, N_kv, _ = Z.shape  # N_kv: number of key-value tokens
 
         # Compute Q, K, V
         Q = self.query(X).reshape(B, N_q, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_q, head_dim)
-        K = self.key(Z).reshape(B, N_kv, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_kv, head_dim)
-        V = self.value(Z).reshape(B, N_kv, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_kv, head_dim)
-
-        # Compute attention scores
-        attn = (Q @ K.transpose(-2, -1)) * self.scale  # (B, num_heads, N_q, N_kv)
-        
-        # Apply mask if provided
-        if attn_masks is not None:
-            # Add mask to attention scores (mask should broadcast to (B, num_heads, N_q, N_kv))
-            attn = attn.masked_fill(attn_masks.unsqueeze(1).unsqueeze(2) == 0, float('-inf'))
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        K, V = kv if kv is not None else self.project_kv(Z)  # (B, num_heads, N_kv, head_dim)
+        if isinstance(K, PackedText):
+            # Padding-free keys / values, attn_masks is implied by the sequence lengths
+            x, attn = packed_attention(
+                Q, K, V, self.scale,
+                dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+                return_attention=return_attention, backend=self.backend)
+            x = x.transpose(1, 2).reshape(B, N_q, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, attn
+
+        if K.size(0) != B:
+            # Cached keys / values of a single text, shared by every query without a copy
+            K, V = K.expand(B, -1, -1, -1), V.expand(B, -1, -1, -1)
+            if attn_masks is not None:
+                attn_masks = attn_masks.expand(B, -1)
+
+        # Attention over the unmasked keys
+        x, attn = attention(
+            Q, K, V, self.scale, attn_masks,
+            dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+            return_attention=return_attention, backend=self.backend)
 
         # Compute output
-        x = (attn @ V).transpose(1, 2).reshape(B, N_q, C)  # (B, N_q, C)
+        x = x.transpose(1, 2).reshape(B, N_q, C)  # (B, N_q, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, attn
 
 class CrossAttention(nn.Module):
-    def __init__(self, dim_x, dim_z, dim_out, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim_x, dim_z, dim_out, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., backend=None):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim_out // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.backend = backend
 
         # Linear layers for queries, keys, and values
         self.query = nn.Linear(dim_x, dim_out, bias=qkv_bias)
-        self.key = nn.Linear(dim_z, dim_out, bias=qkv_bias)
-        self.value = nn.Linear(dim_z, dim_out, bias=qkv_bias)
+        self.kv = nn.Linear(dim_z, 2 * dim_out, bias=qkv_bias)  # keys and values in one matmul
         
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim_out, dim_out)
         self.proj_drop = nn.Dropout(proj_drop)
         
     
-    def forward(self, X, Z, attn_masks=None):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_kv_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_kv(self, Z):
+        """ Keys and values of Z, (B, num_heads, N_kv, head_dim) each (packed if Z is PackedText) """
+        return project_kv(self.kv, self.num_heads, Z)
+
+    def forward(self, X, Z, attn_masks=None, return_attention=False, kv=None):
+        """ kv: optional (K, V) from project_kv, e.g. of one text broadcast over a batch of images; Z is then unused """
         B, N_q, C = X.shape  # B: batch size, N_q: number of query tokens, C: embedding dimension
-        _, N_kv, _ = Z.shape  # N_kv: number of key-value tokens
 
         # Compute Q, K, V
         Q = self.query(X).reshape(B, N_q, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_q, head_dim)
-        K = self.key(Z).reshape(B, N_kv, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_kv, head_dim)
-        V = self.value(Z).reshape(B, N_kv, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)  # (B, num_heads, N_kv, head_dim)
-
-        # Compute attention scores
-        attn = (Q @ K.transpose(-2, -1)) * self.scale  # (B, num_heads, N_q, N_kv)
-        
-        # Apply mask if provided
-        if attn_masks is not None:
-            # Add mask to attention scores (mask should broadcast to (B, num_heads, N_q, N_kv))
-            attn = attn.masked_fill(attn_masks.unsqueeze(1).unsqueeze(2) == 0, float('-inf'))
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        K, V = kv if kv is not None else self.project_kv(Z)  # (B, num_heads, N_kv, head_dim)
+        if isinstance(K, PackedText):
+            # Padding-free keys / values, attn_masks is implied by the sequence lengths
+            x, attn = packed_attention(
+                Q, K, V, self.scale,
+                dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+                return_attention=return_attention, backend=self.backend)
+            x = x.transpose(1, 2).reshape(B, N_q, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, attn
+
+        if K.size(0) != B:
+            # Cached keys / values of a single text, shared by every query without a copy
+            K, V = K.expand(B, -1, -1, -1), V.expand(B, -1, -1, -1)
+            if attn_masks is not None:
+                attn_masks = attn_masks.expand(B, -1)
+
+        # Attention over the unmasked keys
+        x, attn = attention(
+            Q, K, V, self.scale, attn_masks,
+            dropout_p=self.attn_drop.p if self.training else 0., attn_drop=self.attn_drop,
+            return_attention=return_attention, backend=self.backend)
 
         # Compute output
-        x = (attn @ V).transpose(1, 2).reshape(B, N_q, C)  # (B, N_q, C)
+        x = x.transpose(1, 2).reshape(B, N_q, C)  # (B, N_q, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, attn
@@ -249,14 +538,25 @@ class Block(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = MLP(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
+    def forward(self, x, return_attention=False, attn_masks=None):
+        y, attn = self.attn(self.norm1(x), return_attention=return_attention, attn_masks=attn_masks)
         if return_attention:
             return attn
         x = x + self.drop_path(y)
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
+    def forward_merging(self, x, r, size=None):
+        """ forward, merging r tokens between attention and MLP (ToMe); returns x and the merged token sizes """
+        y, metric = self.attn.forward_merging(self.norm1(x), size)
+        x = x + self.drop_path(y)
+        if r > 0:
+            if size is None:
+                size = torch.ones_like(x[..., :1])
+            x, size = merge_wavg(bipartite_soft_matching(metric, r), x, size)
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x, size
+
 class CrossBlock(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
                  drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
@@ -269,9 +569,15 @@ class CrossBlock(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = MLP(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, X, Z, attn_masks=None, return_attention=False):
-        # Apply cross-attention between X and Z
-        y, attn = self.cross_attn(self.norm1(X), self.norm1(Z), attn_masks)
+    def text_kv(self, Z):
+        """ Projected keys / values of the text tokens Z, reusable across calls with kv= """
+        return self.cross_attn.project_kv(Z.map(self.norm1) if isinstance(Z, PackedText) else self.norm1(Z))
+
+    def forward(self, X, Z, attn_masks=None, return_attention=False, kv=None, x_masks=None):
+        # Apply cross-attention between X and Z (x_masks unused: queries never attend to each other)
+        if kv is None:
+            Z = Z.map(self.norm1) if isinstance(Z, PackedText) else self.norm1(Z)
+        y, attn = self.cross_attn(self.norm1(X), Z, attn_masks, return_attention=return_attention, kv=kv)
         if return_attention:
             return attn
         
@@ -300,14 +606,18 @@ class SelfThenCrossBlock(nn.Module):
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         
-    def forward(self, X, Z, attn_masks=None):
-        # Apply self-attention
-        y, _ = self.attn(X)
+    def text_kv(self, Z):
+        """ Projected keys / values of the text tokens Z, reusable across calls with kv= """
+        return self.cross_attn.project_kv(Z)
+
+    def forward(self, X, Z, attn_masks=None, kv=None, x_masks=None):
+        # Apply self-attention, over the valid X tokens if x_masks is given
+        y, _ = self.attn(X, attn_masks=x_masks)
         X = X + self.drop_path(y)
         X = self.norm_after_self_attn(X)
         
         # Apply cross-attention between X and Z
-        y, _ = self.cross_attn(X, Z, attn_masks)
+        y, _ = self.cross_attn(X, Z, attn_masks, kv=kv)
         X = X + self.drop_path(y)
         
         # Apply feed-forward network
@@ -340,6 +650,10 @@ class PatchEmbed(nn.Module):
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
+    def grid_size(self, x):
+        """ (grid_h, grid_w) patch grid of an image batch, any resolution divisible by the patch size. """
+        return x.shape[-2] // self.patch_size, x.shape[-1] // self.patch_size
+
 
 class ConvEmbed(nn.Module):
     """
@@ -406,6 +720,7 @@ class VisionTransformerPredictor(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
             for i in range(depth)])
         self.predictor_norm = norm_layer(predictor_embed_dim)
+        self.checkpointed = set()  # block indices recomputed in backward, see set_activation_checkpointing
         self.predictor_proj = nn.Linear(predictor_embed_dim, embed_dim, bias=True)
         # ------
         self.init_std = init_std
@@ -413,6 +728,10 @@ class VisionTransformerPredictor(nn.Module):
         self.apply(self._init_weights)
         self.fix_init_weight()
 
+    def set_activation_checkpointing(self, setting):
+        """ Recompute the activations of some blocks in backward, see checkpointed_blocks. """
+        self.checkpointed = checkpointed_blocks(setting, len(self.predictor_blocks))
+
     def fix_init_weight(self):
         def rescale(param, layer_id):
             param.div_(math.sqrt(2.0 * layer_id))
@@ -448,62 +767,66 @@ class VisionTransformerPredictor(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
 
-    def forward(self, x, masks_x, masks):
+    def _masked_pos_embed(self, masks, B):
+        """
+        Positional embeddings of the kept patches, read straight from the (1, N, D)
+        table: (K, D) when every sample shares its mask (broadcasts over the
+        batch), (B, K, D) otherwise.
+        """
+        if isinstance(masks, (list, tuple)):
+            masks = torch.cat([m.view(-1, m.size(-1)) for m in masks])
+        masks = masks.to(self.predictor_pos_embed.device, non_blocking=True)
+        pos_embed = self.predictor_pos_embed[0]
+        if masks.dtype == torch.bool:
+            return apply_masks(self.predictor_pos_embed.expand(B, -1, -1), masks)
+        if masks.size(0) == 1 or masks.stride(0) == 0:
+            return pos_embed.index_select(0, masks[0])
+        return pos_embed[masks]
+
+    def forward(self, x, masks_x, masks, masks_x_valid=None, masks_valid=None):
+        """
+        masks_x_valid / masks_valid: optional (B, K) validity of the context /
+        target indices when they are padded to fixed lengths (pad_masks);
+        padded tokens are then masked out as attention keys.
+        """
         assert (masks is not None) and (masks_x is not None), 'Cannot run predictor without mask indices'
 
-        # if not isinstance(masks_x, list):
-        #     masks_x = [masks_x]
-
-        # if not isinstance(masks, list):
-        #     masks = [masks]
-
         # -- Batch Size
-        B = len(x) # // len(masks_x)
-        # print(f"{B=}")
+        B = len(x)
 
         # -- map from encoder-dim to pedictor-dim
         x = self.predictor_embed(x)
-        # print(x.shape)
-
-        # -- add positional embedding to x tokens
-        x_pos_embed = self.predictor_pos_embed.repeat(B, 1, 1)
-        x += apply_masks(x_pos_embed, masks_x)
-
         _, N_ctxt, D = x.shape
 
-        # -- concat mask tokens to x
-        pos_embs = self.predictor_pos_embed.repeat(B, 1, 1)
-        pos_embs = apply_masks(pos_embs, masks)
-        # print(f"{pos_embs=}")
-        # print(f"{pos_embs.shape=}")
-        # pos_embs = repeat_interleave_batch(pos_embs, B, repeat=len(masks_x))
-        # --
-        pred_tokens = self.mask_token.repeat(pos_embs.size(0), pos_embs.size(1), 1)
-        # print(f"{pred_tokens=}")
-        # print(f"{pred_tokens.shape=}")
-        # --
-        
-        pred_tokens += pos_embs
-        # print(f"{pred_tokens=}")
-        # print(f"{pred_tokens.shape=}")
-
-        # x = x.repeat(len(masks), 1, 1)
-        x = torch.cat([x, pred_tokens], dim=1)
+        # -- positional embeddings of context and target patches, gathered once
+        ctxt_pos = self._masked_pos_embed(masks_x, B)
+        pred_pos = self._masked_pos_embed(masks, B)
+        N_pred = pred_pos.size(-2)
+
+        # -- context tokens and mask tokens (broadcast, never repeated) written into one buffer
+        tokens = x.new_empty((B, N_ctxt + N_pred, D), dtype=torch.result_type(x, self.mask_token))
+        tokens[:, :N_ctxt] = x + ctxt_pos
+        tokens[:, N_ctxt:] = self.mask_token + pred_pos
+        x = tokens
+
+        # -- key mask over context + target tokens, if any of them is padding
+        attn_masks = None
+        if masks_x_valid is not None or masks_valid is not None:
+            attn_masks = torch.ones(B, N_ctxt + N_pred, dtype=torch.bool, device=x.device)
+            if masks_x_valid is not None:
+                attn_masks[:, :N_ctxt] = masks_x_valid
+            if masks_valid is not None:
+                attn_masks[:, N_ctxt:] = masks_valid
 
         # -- fwd prop
-        for blk in self.predictor_blocks:
-            x = blk(x)
+        for i, blk in enumerate(self.predictor_blocks):
+            x = run_block(blk, i in self.checkpointed, x, attn_masks=attn_masks)
         x = self.predictor_norm(x)
-        # print(f"{x.shape=}")
 
         # -- return preds for mask tokens
         x = x[:, N_ctxt:]
-        # print(f"{x.shape=}")
-        # print(f"BRFORE PROJECT: {x=}")
 
         x = self.predictor_proj(x)
-        # print(f"{x.shape=}")
-        # print(x)
 
         return x
 
@@ -553,11 +876,22 @@ class VisionTransformer(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
+        self.merge_r = 0  # token merging schedule, see set_token_merging
+        self.pos_embed_cache = PosEmbedCache()  # pos_embed resized per input resolution
         # ------
         self.init_std = init_std
         self.apply(self._init_weights)
         self.fix_init_weight()
 
+    def set_token_merging(self, r):
+        """
+        Merge similar patch tokens between blocks at inference (ToMe): `r`
+        tokens after every block, or a per-block list; 0 disables it. At 448px
+        (784 tokens, 32 blocks) r=16 ends with 272 tokens. The output stays a
+        (B, N', D) token sequence, N' < N, which X_T2I takes as vision input.
+        """
+        self.merge_r = r
+
     def fix_init_weight(self):
         def rescale(param, layer_id):
             param.div_(math.sqrt(2.0 * layer_id))
@@ -599,11 +933,12 @@ class VisionTransformer(nn.Module):
                 masks = [masks]
 
         # -- patchify x
+        grid_size = self.patch_embed.grid_size(x)
         x = self.patch_embed(x)
         B, N, D = x.shape
 
-        # -- add positional embedding to x
-        pos_embed = self.interpolate_pos_encoding(x, self.pos_embed)
+        # -- add positional embedding to x (resized once per resolution, e.g. 224 / 336 inputs of a 448 model)
+        pos_embed = self.interpolate_pos_encoding(x, self.pos_embed, grid_size)
         x = x + pos_embed
 
         # -- mask x
@@ -611,29 +946,25 @@ class VisionTransformer(nn.Module):
             x = apply_masks(x, masks)
 
         # -- fwd prop
-        for i, blk in enumerate(self.blocks):
-            x = blk(x)
+        if self.merge_r and masks is None and not self.training:
+            size = None
+            for blk, r in zip(self.blocks, merge_schedule(self.merge_r, len(self.blocks))):
+                x, size = blk.forward_merging(x, r, size)
+        else:
+            for i, blk in enumerate(self.blocks):
+                x = blk(x)
 
         if self.norm is not None:
             x = self.norm(x)
 
         return x
 
-    def interpolate_pos_encoding(self, x, pos_embed):
-        npatch = x.shape[1] - 1
-        N = pos_embed.shape[1] - 1
-        if npatch == N:
-            return pos_embed
-        class_emb = pos_embed[:, 0]
-        pos_embed = pos_embed[:, 1:]
-        dim = x.shape[-1]
-        pos_embed = nn.functional.interpolate(
-            pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(0, 3, 1, 2),
-            scale_factor=math.sqrt(npatch / N),
-            mode='bicubic',
-        )
-        pos_embed = pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
-        return torch.cat((class_emb.unsqueeze(0), pos_embed), dim=1)
+    def interpolate_pos_encoding(self, x, pos_embed, grid_size=None):
+        """ pos_embed (no cls entry) for the patch grid of x, square if grid_size is not given """
+        if grid_size is None:
+            side = int(math.sqrt(x.shape[1]))
+            grid_size = (side, side)
+        return self.pos_embed_cache(pos_embed, grid_size)
 
 
 class Crosser(nn.Module):
@@ -675,11 +1006,16 @@ class Crosser(nn.Module):
         )
         self.norm_text = norm_layer(hidden_dim)
         self.norm_vision = norm_layer(hidden_dim)
+        self.checkpointed = set()  # layer indices recomputed in backward, see set_activation_checkpointing
         # ------
         self.init_std = init_std
         self.apply(self._init_weights)
         self.fix_init_weight()
     
+    def set_activation_checkpointing(self, setting):
+        """ Recompute the activations of some blocks in backward, see checkpointed_blocks. """
+        self.checkpointed = checkpointed_blocks(setting, len(self.t2i_blocks))
+
     def fix_init_weight(self):
         def rescale(param, layer_id):
             param.div_(math.sqrt(2.0 * layer_id))
@@ -718,14 +1054,18 @@ class Crosser(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
     def forward(self, T, V, text_masks=None):
+        if isinstance(T, PackedText):
+            # Text tokens are queries of the t2i blocks, which run padded
+            T, text_masks = T.to_padded()
+
         # Project inputs to hidden dimension
         T = self.text_proj(T)  # (B, N_text, hidden_dim)
         V = self.vision_proj(V)  # (B, N_vision, hidden_dim)
 
         # Apply cross-attention blocks
-        for t2i_block, i2t_block in zip(self.t2i_blocks, self.i2t_blocks):
-            T_new = t2i_block(T, V)  # Apply cross-attention from vision to text
-            V_new = i2t_block(V, T, attn_masks=text_masks)  # Apply cross-attention from text to vision with text mask
+        for i, (t2i_block, i2t_block) in enumerate(zip(self.t2i_blocks, self.i2t_blocks)):
+            T_new = run_block(t2i_block, i in self.checkpointed, T, V)  # Apply cross-attention from vision to text
+            V_new = run_block(i2t_block, i in self.checkpointed, V, T, attn_masks=text_masks)  # Apply cross-attention from text to vision with text mask
             if self.residual:
                 T = T + T_new  # Residual connection
                 V = V + V_new  # Residual connection
@@ -768,6 +1108,7 @@ class X_T2I(nn.Module): # Cross Attention from Text to Image
         super().__init__()
         self.vision_proj = nn.Linear(vision_embed_dim, hidden_dim, bias=True)
         self.vision_norm = norm_layer(hidden_dim)
+        self.checkpointed = set()  # block indices recomputed in backward, see set_activation_checkpointing
         # --
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
         self.blocks = nn.ModuleList(
@@ -790,6 +1131,10 @@ class X_T2I(nn.Module): # Cross Attention from Text to Image
         self.apply(self._init_weights)
         self.fix_init_weight()
     
+    def set_activation_checkpointing(self, setting):
+        """ Recompute the activations of some blocks in backward, see checkpointed_blocks. """
+        self.checkpointed = checkpointed_blocks(setting, len(self.blocks))
+
     def fix_init_weight(self):
         def rescale(param, layer_id):
             param.div_(math.sqrt(2.0 * layer_id))
@@ -828,14 +1173,27 @@ class X_T2I(nn.Module): # Cross Attention from Text to Image
             if hasattr(m, 'bias') and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
-    def forward(self, T, V, text_masks=None):
+    def encode_text_kv(self, T):
+        """
+        Per-block projected keys / values of the text tokens T. Pass them as
+        `text_kv` to score the same text(s) against many image batches: with a
+        single text (batch 1) they are broadcast over the image batch.
+
+        T (here and in forward) may be a PackedText, text_masks is then unused.
+        """
+        return [block.text_kv(T) for block in self.blocks]
+
+    def forward(self, T, V, text_masks=None, text_kv=None, vision_masks=None):
+        """ vision_masks: optional (B, N_vision) validity of V tokens, when padded to a fixed length """
         # Project inputs to hidden dimension
         V = self.vision_proj(V)
         V = self.vision_norm(V)
 
         # Apply cross-attention blocks
-        for block in self.blocks:
-            V = block(V, T, attn_masks=text_masks)
+        for i, block in enumerate(self.blocks):
+            V = run_block(
+                block, i in self.checkpointed, V, T,
+                attn_masks=text_masks, kv=None if text_kv is None else text_kv[i], x_masks=vision_masks)
         
         return V
     
@@ -894,6 +1252,7 @@ class VisionEncoder(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
+        self.pos_embed_cache = PosEmbedCache()  # pos_embed resized per input resolution
         # ------
         self.init_std = init_std
         self.apply(self._init_weights)
@@ -940,6 +1299,7 @@ class VisionEncoder(nn.Module):
                 masks = [masks]
 
         # -- patchify x
+        grid_size = self.patch_embed.grid_size(x)
         x = self.patch_embed(x)
         B, N, D = x.shape
         
@@ -948,7 +1308,7 @@ class VisionEncoder(nn.Module):
         x = torch.cat((cls_tokens, x), dim=1)  # (B, N+1, D)
 
         # -- add positional embedding to x
-        pos_embed = self.pos_embed
+        pos_embed = self.interpolate_pos_encoding(x, self.pos_embed, grid_size)
         x = x + pos_embed
 
         # -- mask x
@@ -965,23 +1325,12 @@ class VisionEncoder(nn.Module):
 
         return x
 
-    def interpolate_pos_encoding(self, x, pos_embed):
-        npatch = x.shape[1] - 1  # Exclude CLS token for patches
-        N = pos_embed.shape[1] - 1
-        
-        if npatch == N:
-            return pos_embed
-        
-        class_emb = pos_embed[:, 0]  # CLS token positional embedding
-        pos_embed = pos_embed[:, 1:]  # Positional embeddings for patches
-        dim = x.shape[-1]
-        pos_embed = nn.functional.interpolate(
-            pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(0, 3, 1, 2),
-            scale_factor=math.sqrt(npatch / N),
-            mode='bicubic',
-        )
-        pos_embed = pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
-        return torch.cat((class_emb.unsqueeze(0), pos_embed), dim=1)
+    def interpolate_pos_encoding(self, x, pos_embed, grid_size=None):
+        """ pos_embed (cls entry first) for the patch grid of x, square if grid_size is not given """
+        if grid_size is None:
+            side = int(math.sqrt(x.shape[1] - 1))  # Exclude CLS token for patches
+            grid_size = (side, side)
+        return self.pos_embed_cache(pos_embed, grid_size, cls_token=True)
 
 def vision_encoder(**kwargs):
     model = VisionEncoder(
@@ -991,18 +1340,72 @@ def vision_encoder(**kwargs):
 from transformers import AutoModel, AutoTokenizer
 
 class TextEncoder(nn.Module):
-    def __init__(self, model_path='Alibaba-NLP/gte-base-en-v1.5', max_length=8192, device='cuda:0'):
+    def __init__(self, model_path='Alibaba-NLP/gte-base-en-v1.5', max_length=8192, device='cuda:0', unpad_inputs=False):
+        """
+        unpad_inputs: run gte on the real tokens only (its variable-length path,
+        with xformers' memory-efficient attention when installed). Padded rows of
+        last_hidden_state then come back as zeros, so `normalize` matches encoding
+        every text on its own, as TextFeatureCache does.
+        """
         super(TextEncoder, self).__init__()
         self.device = device
         self.model_path = model_path
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True).to(self.device)
+        model_kwargs = {}
+        if unpad_inputs:
+            model_kwargs = {
+                'unpad_inputs': True,
+                'use_memory_efficient_attention': importlib.util.find_spec('xformers') is not None,
+            }
+        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True, **model_kwargs).to(self.device)
         self.max_length = max_length
+        self.token_store = None  # TokenStore of pre-tokenized texts, see src/datasets/token_store.py
+
+    def tokenize(self, input_texts):
+        """ Unpadded token ids of every text, as stored by TokenStore. """
+        return self.tokenizer(input_texts, max_length=self.max_length, truncation=True)['input_ids']
+
+    def pad_tokens(self, input_ids, lengths):
+        """
+        Padded batch from flat token ids and per-text lengths, built with one
+        gather on the device instead of the tokenizer's python padding.
+        """
+        lengths = lengths.to(self.device, non_blocking=True)
+        input_ids = input_ids.to(self.device, non_blocking=True).long()
+
+        offsets = torch.cumsum(lengths, dim=0) - lengths
+        positions = torch.arange(int(lengths.max()), device=self.device)
+        attention_mask = positions[None, :] < lengths[:, None]
+        index = (offsets[:, None] + positions[None, :]).clamp_(max=input_ids.numel() - 1)
+        input_ids = input_ids[index].masked_fill_(~attention_mask, self.tokenizer.pad_token_id)
+
+        return {
+            'input_ids': input_ids,
+            'token_type_ids': torch.zeros_like(input_ids),
+            'attention_mask': attention_mask.long(),
+        }
+
+    def forward(self, input_texts, normalize=True, verbose=False, packed=False):
+        """
+        (embeddings, attention_mask) of the texts, padded to the longest one.
+        With `packed`, (PackedText, None) holding the real tokens only, which
+        X_T2I consumes without padding.
+        """
+        if self.token_store is not None and all(t in self.token_store for t in input_texts):
+            return self.forward_tokens(*self.token_store.get(input_texts), normalize=normalize, verbose=verbose, packed=packed)
 
-    def forward(self, input_texts, normalize=True, verbose=False):
         # Tokenize input texts
         batch_dict = self.tokenizer(input_texts, max_length=self.max_length, padding=True, truncation=True, return_tensors='pt').to(self.device)
 
+        return self._encode(batch_dict, normalize=normalize, verbose=verbose, packed=packed)
+
+    def forward_tokens(self, input_ids, lengths, normalize=True, verbose=False, packed=False):
+        """ Same as forward, for flat pre-tokenized ids (e.g. from TokenStore.get) and their lengths. """
+        batch_dict = self.pad_tokens(input_ids, lengths)
+
+        return self._encode(batch_dict, normalize=normalize, verbose=verbose, packed=packed)
+
+    def _encode(self, batch_dict, normalize=True, verbose=False, packed=False):
         if verbose:
             print(batch_dict)
             
@@ -1017,6 +1420,9 @@ class TextEncoder(nn.Module):
         # (Optional) Normalize embeddings
         if normalize:
             embeddings = F.normalize(embeddings, p=2, dim=1)
+
+        if packed:
+            return PackedText.from_padded(embeddings, attention_mask), None
         
         return embeddings, attention_mask
 
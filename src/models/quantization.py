@@ -0,0 +1,22 @@
+import io
+
+import torch
+import torch.nn as nn
+
+
+def quantize_int8(model):
+    """
+    Dynamic int8 quantization of a frozen model for CPU inference: every
+    nn.Linear keeps int8 weights and quantizes its input per batch on the
+    fly; convolutions, norms and embeddings stay fp32. Quantizes in place
+    (the fp32 weights are dropped) and returns the model in eval mode.
+    """
+    model = model.to('cpu').eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def serialized_size(model):
+    """ Bytes of the model's state_dict once saved, e.g. to compare fp32 and int8 footprints. """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
@@ -0,0 +1,55 @@
+import torch
+
+
+def merge_schedule(r, depth):
+    """
+    Tokens merged after each of `depth` blocks: `r` as is if it is a list,
+    an int merges `r` tokens after every block.
+    """
+    if isinstance(r, (list, tuple)):
+        assert len(r) == depth, f"Token merging schedule has {len(r)} entries for {depth} blocks"
+        return list(r)
+    return [r] * depth
+
+
+def bipartite_soft_matching(metric, r):
+    """
+    Token Merging (Bolya et al., 2023) bipartite matching on a (B, N, C) metric.
+
+    Tokens are split alternately into sets A and B, every token of A is
+    matched to its most similar (cosine) token of B, and the `r` most similar
+    pairs are merged. Returns `merge(x, mode)` reducing any (B, N, ...) tensor
+    to (B, N - r, ...), with merged A tokens reduced into their B token.
+    """
+    N = metric.shape[1]
+    r = min(r, N // 2)
+    if r <= 0:
+        return lambda x, mode='sum': x
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:]  # A tokens kept
+        src_idx = edge_idx[:, :r]  # A tokens merged
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)  # their B tokens
+
+    def merge(x, mode='sum'):
+        src, dst = x[:, ::2], x[:, 1::2]
+        B, N_a, C = src.shape
+        unm = src.gather(dim=1, index=unm_idx.expand(B, N_a - r, C))
+        src = src.gather(dim=1, index=src_idx.expand(B, r, C))
+        dst = dst.scatter_reduce(1, dst_idx.expand(B, r, C), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+
+def merge_wavg(merge, x, size):
+    """ Merge (B, N, D) tokens as averages weighted by `size`, the (B, N, 1) patches each token covers. """
+    x = merge(x * size, mode='sum')
+    size = merge(size, mode='sum')
+    return x / size, size
@@ -108,6 +108,7 @@ def main(args, resume_preempt=False):
     num_pred_masks = args['mask']['num_pred_masks']  # number of target blocks
     pred_mask_scale = args['mask']['pred_mask_scale']  # scale of target blocks
     aspect_ratio = args['mask']['aspect_ratio']  # aspect ratio of target blocks
+    mask_bank = args['mask'].get('bank_path')  # optional precomputed masks, see train_scripts/build_mask_bank.py
     # --
 
     # -- OPTIMIZATION
@@ -178,7 +179,8 @@ def main(args, resume_preempt=False):
         nenc=num_enc_masks,
         npred=num_pred_masks,
         allow_overlap=allow_overlap,
-        min_keep=min_keep)
+        min_keep=min_keep,
+        mask_bank=mask_bank)
 
     transform = make_transforms(
         crop_size=crop_size,
@@ -65,3 +65,25 @@ class GaussianBlur(object):
 
         radius = self.radius_min + torch.rand(1) * (self.radius_max - self.radius_min)
         return img.filter(ImageFilter.GaussianBlur(radius=radius))
+
+
+def images_to_uint8(images):
+    """ Quantize [0, 1] float images (ToTensor output) to uint8 pixels for storage. """
+    if images.dtype == torch.uint8:
+        return images
+    return images.mul(255.).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def images_to_float(images, normalization=None):
+    """
+    Turn stored images back into model inputs: uint8 -> float in [0, 1], then
+    optional (mean, std) normalization. Meant to run once on a stacked batch,
+    after it has been moved to its device.
+    """
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.)
+    if normalization is not None:
+        mean = torch.as_tensor(normalization[0], dtype=images.dtype, device=images.device).view(-1, 1, 1)
+        std = torch.as_tensor(normalization[1], dtype=images.dtype, device=images.device).view(-1, 1, 1)
+        images = (images - mean) / std
+    return images
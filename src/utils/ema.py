@@ -0,0 +1,88 @@
+import torch
+
+
+class EMA(object):
+    """
+    Momentum update of a target model from its online counterpart,
+    target = m * target + (1 - m) * online, with m following the same linear
+    schedule as the momentum generator of the train scripts
+    (start -> final over T_max steps).
+
+    Parameters are grouped by (device, dtype) once at construction, so build
+    it after the models are on their devices; each group is then updated with
+    a single multi-tensor (foreach) lerp instead of a Python loop with a
+    temporary per parameter.
+
+    every > 1 updates the target every `every` steps only, with the product
+    of the skipped momenta, which matches `every` consecutive updates as long
+    as the online model does not change in between.
+    """
+
+    def __init__(
+        self,
+        model,
+        target,
+        momentum=(0.996, 1.0),
+        T_max=1,
+        every=1,
+    ):
+        self.start_momentum, self.final_momentum = momentum
+        self.T_max = T_max
+        self.every = every
+        self._step = 0
+        self._decay = 1.  # product of the momenta since the last update
+
+        self.groups = {}
+        for param_q, param_k in zip(model.parameters(), target.parameters()):
+            sources, targets = self.groups.setdefault((param_k.device, param_k.dtype), ([], []))
+            sources.append(param_q)
+            targets.append(param_k)
+        # -- groups whose online parameters live on another device / dtype are copied over on each update
+        self.copied = {
+            key for key, (sources, _) in self.groups.items()
+            if any(p.device != key[0] or p.dtype != key[1] for p in sources)
+        }
+
+    @property
+    def momentum(self):
+        """ Momentum of the next step. """
+        progress = min(1., self._step / max(1, self.T_max))
+        return self.start_momentum + progress * (self.final_momentum - self.start_momentum)
+
+    @torch.no_grad()
+    def update(self, weight):
+        """ target += weight * (online - target) over every parameter group. """
+        for (device, dtype), (sources, targets) in self.groups.items():
+            if (device, dtype) in self.copied:
+                sources = [p.to(device, dtype, non_blocking=True) for p in sources]
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(targets, sources, weight)
+            else:
+                torch._foreach_mul_(targets, 1. - weight)
+                torch._foreach_add_(targets, sources, alpha=weight)
+
+    def step(self):
+        """ Advance the schedule, update the target when due; returns the momentum used. """
+        m = self.advance()
+        self._decay *= m
+        if self._step % self.every == 0:
+            self.update(1. - self._decay)
+            self._decay = 1.
+        return m
+
+    def advance(self):
+        """ Advance the schedule without touching the target (resuming from checkpoints without EMA state). """
+        m = self.momentum
+        self._step += 1
+        return m
+
+    def state_dict(self):
+        return {
+            'step': self._step,
+            'decay': self._decay,
+        }
+
+    def load_state_dict(self, state_dict):
+        """ Restores the progress only: momentum range and T_max follow the constructor, like lr / wd on resume. """
+        self._step = state_dict['step']
+        self._decay = state_dict['decay']
@@ -50,21 +50,76 @@ def trunc_normal_(tensor, mean=0., std=1., a=-2., b=2.):
     return _no_grad_trunc_normal_(tensor, mean, std, a, b)
 
 
-def apply_masks(x, masks):
+def apply_masks(x, masks, index=None):
     """
     :param x: tensor of shape [B (batch-size), N (num-patches), D (feature-dim)]
-    :param masks: list of tensors containing indices of patches in [N] to keep
+    :param masks: per-sample patch indices to keep, [B, K] (or a list of B [K]
+        tensors), or a boolean [B, N] mask with K True entries per row
+    :param index: optional [B'] row of x read by every row of [B', K] index
+        masks, several masks per sample without repeating x (see flatten_views)
+    :return: tensor of shape [B, K, D], row i gathered from x[i] with masks[i]
     """
-    # all_x = []
-    # for m in masks:
-    #     mask_keep = m.unsqueeze(-1).repeat(1, 1, x.size(-1))
-    #     all_x += [torch.gather(x, dim=1, index=mask_keep)]
-    # return torch.cat(all_x, dim=0)
-    all_x = [
-        torch.gather(x[i:i+1], dim=1, index=m.unsqueeze(-1).repeat(1, 1, x.size(-1)))
-        for i, m in enumerate(masks)
-    ]
-    return torch.cat(all_x, dim=0)
+    if isinstance(masks, (list, tuple)):
+        masks = torch.cat([m.view(-1, m.size(-1)) for m in masks])
+    masks = masks.to(x.device, non_blocking=True)
+
+    if masks.dtype == torch.bool:
+        counts = masks.sum(dim=1)
+        assert bool((counts == counts[0]).all()), \
+            f"Boolean masks need the same number of True entries per row, got {counts.min().item()} to {counts.max().item()}"
+        return x[masks].view(x.size(0), -1, x.size(-1))
+
+    if index is not None:
+        return x[index.to(x.device, non_blocking=True)[:, None], masks]
+
+    # -- same indices for every sample (MultiBlock's expanded masks): one index_select
+    if masks.size(0) > 1 and masks.stride(0) == 0:
+        return x[:masks.size(0)].index_select(1, masks[0])
+
+    return torch.gather(x, dim=1, index=masks.unsqueeze(-1).expand(-1, -1, x.size(-1)))
+
+
+def flatten_views(masks):
+    """
+    [B, M, K] patch indices of M mask views per sample, -1 padded (MultiBlock
+    with n_views), to [B * M, K] indices, view m of sample b in row b * M + m
+    and padding gathering patch 0, the [B * M] sample of every row (the
+    `index` of apply_masks) and the [B * M, K] boolean validity of the indices.
+    """
+    B, M, K = masks.shape
+    index = torch.arange(B, device=masks.device).repeat_interleave(M)
+    masks = masks.reshape(B * M, K)
+    valid = masks >= 0
+    return masks.clamp(min=0), index, valid
+
+
+def pad_masks(masks, bucket, max_len=None, valid=None):
+    """
+    Pad [B, K] patch indices along K to the next multiple of `bucket` (at
+    most `max_len`), so varying mask sizes fall into a bounded set of shapes
+    (e.g. under torch.compile). Padding gathers patch 0.
+    :param valid: optional [B, K] validity of masks already padded (flatten_views)
+    :return: padded [B, L] indices and their [B, L] boolean validity mask
+    """
+    B, K = masks.shape
+    L = -(-K // bucket) * bucket
+    if max_len is not None:
+        L = max(K, min(L, max_len))
+    if valid is None:
+        valid = (torch.arange(L, device=masks.device) < K).expand(B, L)
+    else:
+        valid = torch.cat([valid, valid.new_zeros(B, L - K)], dim=1)
+    if masks.size(0) > 1 and masks.stride(0) == 0:
+        # -- keep shared masks expanded for the index_select path of apply_masks
+        return torch.nn.functional.pad(masks[:1], (0, L - K)).expand(B, L), valid
+    return torch.nn.functional.pad(masks, (0, L - K)), valid
+
+
+def pad_tokens(x, attn_masks, bucket):
+    """ Pad [B, N, D] tokens and their [B, N] attention mask along N to the next multiple of `bucket`. """
+    N = x.size(1)
+    L = -(-N // bucket) * bucket
+    return torch.nn.functional.pad(x, (0, 0, 0, L - N)), torch.nn.functional.pad(attn_masks, (0, L - N))
 
 
 def repeat_interleave_batch(x, B, repeat):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# -- the repo is not installed: make `src` importable like the train scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,99 @@
+import copy
+
+import torch
+
+from src.utils.ema import EMA
+
+MOMENTUM = (0.9, 1.0)
+T_MAX = 10
+
+
+def models(dtype=torch.float32):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+    target = copy.deepcopy(model).to(dtype)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p))
+    return model, target
+
+
+def momentum(step):
+    start, final = MOMENTUM
+    return start + min(1., step / T_MAX) * (final - start)
+
+
+@torch.no_grad()
+def reference_step(model, target, step):
+    """ Original per-parameter update: target = m * target + (1 - m) * online. """
+    m = momentum(step)
+    for param_q, param_k in zip(model.parameters(), target.parameters()):
+        param_k.mul_(m).add_((1. - m) * param_q.detach().to(param_k.dtype))
+    return m
+
+
+def assert_same(a, b, atol=1e-6):
+    for p, q in zip(a.parameters(), b.parameters()):
+        assert torch.allclose(p, q, atol=atol)
+
+
+@torch.no_grad()
+def perturb(model):
+    for p in model.parameters():
+        p.add_(0.1 * torch.randn_like(p))
+
+
+def test_matches_per_parameter_update():
+    model, target = models()
+    expected = copy.deepcopy(target)
+    ema = EMA(model, target, momentum=MOMENTUM, T_max=T_MAX)
+    for step in range(15):  # past T_max: the schedule stays at the final momentum
+        assert ema.step() == reference_step(model, expected, step)
+        assert_same(target, expected)
+        perturb(model)
+
+
+def test_every_k_matches_k_updates():
+    model, target = models()
+    expected = copy.deepcopy(target)
+    initial = copy.deepcopy(target)
+    ema = EMA(model, target, momentum=MOMENTUM, T_max=T_MAX, every=3)
+    for step in range(9):
+        ema.step()
+        reference_step(model, expected, step)
+        if step % 3 == 2:
+            assert_same(target, expected)
+        elif step < 2:
+            assert_same(target, initial, atol=0.)
+
+
+def test_state_dict_round_trip():
+    model, target = models()
+    expected = copy.deepcopy(target)
+    ema = EMA(model, expected, momentum=MOMENTUM, T_max=T_MAX, every=2)
+    for _ in range(7):
+        ema.step()
+
+    ema = EMA(model, target, momentum=MOMENTUM, T_max=T_MAX, every=2)
+    for _ in range(3):  # stop between two updates: the pending decay must survive
+        ema.step()
+    state = ema.state_dict()
+    assert set(state) == {'step', 'decay'}
+
+    resumed = EMA(model, target, momentum=MOMENTUM, T_max=T_MAX, every=2)
+    resumed.load_state_dict(state)
+    assert resumed.momentum == ema.momentum
+    for _ in range(4):
+        resumed.step()
+    assert_same(target, expected)
+
+
+def test_mixed_dtype_groups():
+    model, target = models(dtype=torch.float64)
+    expected = copy.deepcopy(target)
+    ema = EMA(model, target, momentum=MOMENTUM, T_max=T_MAX)
+    assert ema.copied == {(torch.device('cpu'), torch.float64)}
+    for step in range(5):
+        ema.step()
+        reference_step(model, expected, step)
+    assert_same(target, expected)
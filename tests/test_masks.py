@@ -0,0 +1,168 @@
+import random
+
+import torch
+
+from src.masks.bank import MaskBank
+from src.masks.custom_multiblock import MultiBlock, MultiBlockCollator
+from src.masks.multiblock import MaskCollator
+
+GRID = 14
+N = GRID * GRID
+# -- I-JEPA config (configs/in1k_vith16-448_ep300.yaml) on a 14x14 grid
+COLLATOR_CONFIG = dict(
+    input_size=224,
+    patch_size=16,
+    enc_mask_scale=(0.85, 1.0),
+    pred_mask_scale=(0.15, 0.2),
+    aspect_ratio=(0.75, 1.5),
+    nenc=1,
+    npred=4,
+    min_keep=10,
+    allow_overlap=False,
+)
+
+
+def multiblock(**kwargs):
+    return MultiBlock(GRID, device_context_masks='cpu', device_predict_masks='cpu', **kwargs)
+
+
+def equal_lists(a, b):
+    return len(a) == len(b) and all(torch.equal(x, y) for x, y in zip(a, b))
+
+
+def assert_close_means(a, b, rel):
+    a, b = sum(a) / len(a), sum(b) / len(b)
+    assert abs(a - b) <= rel * max(a, b), f"mean {a:.1f} vs {b:.1f}"
+
+
+# -- MultiBlock
+
+def test_multiblock_vectorized_masks_are_valid():
+    mb = multiblock(seed=0)
+    for _ in range(50):
+        context, target = mb(4)
+        assert context.shape[0] == target.shape[0] == 4
+        for masks in (context, target):
+            assert masks.dtype == torch.int64
+            assert int(masks.min()) >= 0 and int(masks.max()) < N
+            assert torch.equal(masks, masks[:1].expand_as(masks))  # shared across the batch
+        assert not set(context[0].tolist()) & set(target[0].tolist())
+
+
+def test_multiblock_vectorized_matches_loop_sizes():
+    random.seed(0)
+    vectorized, loops = multiblock(seed=0), multiblock(vectorized=False)
+    sizes = {'vectorized': ([], []), 'loops': ([], [])}
+    for _ in range(400):
+        for name, mb in (('vectorized', vectorized), ('loops', loops)):
+            context, target = mb(2)
+            sizes[name][0].append(context.size(1))
+            sizes[name][1].append(target.size(1))
+    for i in range(2):
+        assert_close_means(sizes['vectorized'][i], sizes['loops'][i], rel=0.08)
+
+
+def test_multiblock_per_sample_rows():
+    mb = multiblock(seed=0, per_sample=True)
+    context, target = mb(8)
+    for masks in (context, target):
+        assert masks.shape[0] == 8
+        assert int(masks.min()) >= 0 and int(masks.max()) < N
+        assert torch.equal(masks, masks.sort(dim=1).values)  # raster order
+        assert all(len(set(row.tolist())) == masks.size(1) for row in masks)
+    for c, t in zip(context, target):
+        assert not set(c.tolist()) & set(t.tolist())
+
+
+def test_multiblock_views_are_padded_at_the_end():
+    mb = multiblock(seed=0, n_views=3)
+    context, target = mb(4)
+    for masks in (context, target):
+        assert masks.shape[:2] == (4, 3)
+        valid = (masks >= 0).int()
+        assert torch.equal(valid, valid.sort(dim=-1, descending=True).values)
+        assert int(masks.max()) < N
+        assert bool(valid.any(dim=-1).all())
+
+
+# -- MaskCollator
+
+def test_mask_collator_vectorized_matches_loop():
+    torch.manual_seed(0)
+    vectorized = MaskCollator(**COLLATOR_CONFIG)
+    loops = MaskCollator(vectorized=False, **COLLATOR_CONFIG)
+    batch = [torch.zeros(3) for _ in range(8)]
+    enc_sizes = {'vectorized': [], 'loops': []}
+    for _ in range(100):
+        pred_sizes = []
+        for name, collator in (('vectorized', vectorized), ('loops', loops)):
+            images, masks_enc, masks_pred = collator(batch)
+            assert images.shape == (8, 3)
+            assert len(masks_enc) == COLLATOR_CONFIG['nenc'] and len(masks_pred) == COLLATOR_CONFIG['npred']
+            for m in masks_enc + masks_pred:
+                assert m.dtype == torch.int64 and m.size(0) == 8
+                assert int(m.min()) >= 0 and int(m.max()) < N
+            assert masks_enc[0].size(1) > COLLATOR_CONFIG['min_keep']
+            enc_sizes[name].append(masks_enc[0].size(1))
+            pred_sizes.append(masks_pred[0].size(1))
+        # -- same step, same block sizes: target blocks are never constrained
+        assert pred_sizes[0] == pred_sizes[1]
+    assert_close_means(enc_sizes['vectorized'], enc_sizes['loops'], rel=0.1)
+
+
+# -- MaskBank
+
+def test_multiblock_bank_is_a_function_of_the_step(tmp_path):
+    path = str(tmp_path / 'bank.npz')
+    multiblock(seed=0).build_mask_bank(path, n_groups=8)
+
+    # -- one sampler per worker, the first one stepping through two bank cycles
+    first, second = multiblock(mask_bank=path), multiblock(mask_bank=path)
+    sequence = [first(4) for _ in range(12)]
+    for step in (0, 3, 9, 11):
+        context, target = second(4, step=step)
+        assert torch.equal(context, sequence[step][0])
+        assert torch.equal(target, sequence[step][1])
+
+    # -- a resumed run reloads the bank
+    resumed = multiblock(mask_bank=MaskBank(path))
+    for step in reversed(range(12)):
+        assert torch.equal(resumed(4, step=step)[0], sequence[step][0])
+
+
+def test_mask_bank_cycles_are_permutations(tmp_path):
+    path = str(tmp_path / 'bank.npz')
+    multiblock(seed=0).build_mask_bank(path, n_groups=8)
+    bank = MaskBank(path)
+    for cycle in range(3):
+        assert sorted(bank.group(cycle * 8 + i) for i in range(8)) == list(range(8))
+
+
+def test_multiblock_collator_uses_the_batch_step(tmp_path):
+    path = str(tmp_path / 'bank.npz')
+    multiblock(seed=0).build_mask_bank(path, n_groups=8)
+    collator = MultiBlockCollator(GRID, mask_bank=path)
+    batch = [(5, (torch.zeros(3, 4, 4), f"caption {i}")) for i in range(4)]
+
+    images, captions, context, target = collator(batch)
+    assert images.shape == (4, 3, 4, 4)
+    assert captions == [f"caption {i}" for i in range(4)]
+    expected_context, expected_target = multiblock(mask_bank=path)(4, step=5)
+    assert torch.equal(context, expected_context)
+    assert torch.equal(target, expected_target)
+
+
+def test_mask_collator_bank_is_a_function_of_the_step(tmp_path):
+    path = str(tmp_path / 'bank.npz')
+    torch.manual_seed(0)
+    MaskCollator(**COLLATOR_CONFIG).build_mask_bank(path, n_groups=4, group_size=4)
+
+    first, second = MaskCollator(mask_bank=path, **COLLATOR_CONFIG), MaskCollator(mask_bank=path, **COLLATOR_CONFIG)
+    batch = [torch.zeros(3) for _ in range(4)]
+    _, enc_a, pred_a = first(batch)
+    _, enc_b, pred_b = second(batch)
+    assert equal_lists(enc_a, enc_b) and equal_lists(pred_a, pred_b)
+    for step in (2, 6):
+        enc_a, pred_a = first._bank_masks(step, 4)
+        enc_b, pred_b = second._bank_masks(step, 4)
+        assert equal_lists(enc_a, enc_b) and equal_lists(pred_a, pred_b)
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from src.utils.tensors import apply_masks, flatten_views, pad_masks
+
+B, N, D, K = 4, 16, 8, 5
+
+
+def reference(x, masks, index=None):
+    """ Per-sample loop of the original apply_masks: row i gathered from x[index[i]] with masks[i]. """
+    index = range(len(masks)) if index is None else index.tolist()
+    return torch.stack([x[i][m] for i, m in zip(index, masks)])
+
+
+@pytest.fixture
+def x():
+    return torch.randn(B, N, D, generator=torch.Generator().manual_seed(0))
+
+
+def test_index_masks(x):
+    masks = torch.stack([torch.randperm(N)[:K] for _ in range(B)])
+    assert torch.equal(apply_masks(x, masks), reference(x, masks))
+    assert torch.equal(apply_masks(x, list(masks)), reference(x, masks))
+
+
+def test_shared_masks(x):
+    masks = torch.randperm(N)[:K].expand(B, -1)
+    assert masks.stride(0) == 0
+    assert torch.equal(apply_masks(x, masks), reference(x, masks))
+
+
+def test_bool_masks(x):
+    masks = torch.zeros(B, N, dtype=torch.bool)
+    for row in masks:
+        row[torch.randperm(N)[:K]] = True
+    out = apply_masks(x, masks)
+    assert out.shape == (B, K, D)
+    assert torch.equal(out, reference(x, masks))
+
+
+def test_bool_masks_need_equal_counts(x):
+    masks = torch.zeros(B, N, dtype=torch.bool)
+    masks[:, :K] = True
+    masks[0, K] = True
+    with pytest.raises(AssertionError):
+        apply_masks(x, masks)
+
+
+def test_indexed_views(x):
+    M = 3
+    masks = torch.stack([torch.stack([torch.randperm(N)[:K] for _ in range(M)]) for _ in range(B)])
+    masks[0, 1, -2:] = -1  # shorter view, -1 padded like MultiBlock(n_views=...)
+
+    flat, index, valid = flatten_views(masks)
+    assert flat.shape == valid.shape == (B * M, K)
+    assert torch.equal(index, torch.arange(B).repeat_interleave(M))
+    assert torch.equal(valid, masks.view(B * M, K) >= 0)
+    assert int(flat.min()) >= 0
+
+    assert torch.equal(apply_masks(x, flat, index=index), reference(x, flat, index))
+
+
+def test_pad_masks_keeps_shared_masks_expanded():
+    masks = torch.randperm(N)[:K].expand(B, -1)
+    padded, valid = pad_masks(masks, bucket=4)
+    assert padded.shape == valid.shape == (B, 8)
+    assert padded.stride(0) == 0
+    assert torch.equal(padded[:, :K], masks)
+    assert torch.equal(valid, (torch.arange(8) < K).expand(B, -1))
+
+    padded, valid = pad_masks(masks.contiguous(), bucket=4, max_len=6)
+    assert padded.shape == (B, 6)
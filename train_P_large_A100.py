@@ -1,4 +1,5 @@
 # import torch
+import os
 import random
 import yaml
 import pprint
@@ -9,11 +10,17 @@ from dataclasses import dataclass, asdict
 
 from src.models import modules
 from src.models.modules import text_encoder_model, x_t2i_module, vit_predictor
-from src.utils.tensors import apply_masks, repeat_interleave_batch
+from src.utils.tensors import apply_masks, repeat_interleave_batch, pad_masks, pad_tokens, flatten_views
 from src.helper import init_opt
 from src.utils.losses import cosine_similarity_matrix, contrastive_loss, clip_loss, max_margin_loss, max_margin_loss_negative_only, weighted_max_margin_loss
 
 from create_dataset import ImageTextDatasetA100
+from src.datasets.feature_store import FeatureStore, checkpoint_hash, extract_features
+from src.datasets.text_cache import TextFeatureCache
+from src.datasets.token_store import TokenStore
+from src.datasets.loaders import make_loader
+from src.datasets.samplers import LengthBucketBatchSampler, PaddingMeter
+from src.masks.custom_multiblock import MultiBlockCollator
 from src.masks.multiblock import MaskCollator
 # import torch.nn.functional as F
 # import torch.optim as optim
@@ -24,6 +31,7 @@ from src.masks.multiblock import MaskCollator
 
 from src.utils.visualizer import visualize_rectangle, print_tensor_with_precision, print_sample_of_tensor
 from src.utils.saving import Saver
+from src.utils.ema import EMA
 from eval_on_mvsa import train_simple_linear_module
 
 DEVICE_0 = 'cpu'
@@ -156,7 +164,14 @@ def inference(images, captions, text_encoder, vision_encoder, target_crosser, de
     
     return cross_encoded_target
 
-def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=10, learning_rate=0.01, save_interval=1, resume_from=None):
+def train(
+        num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=10, learning_rate=0.01, save_interval=1, resume_from=None,
+        feature_store_folder=None, encoder_checkpoint="IN1K-vit.h.16-448px-300e.pth.tar", text_cache_folder=None,
+        token_store_folder=None, loader_workers=0, bucket_by_length=False, mask_bank=None,
+        crosser_checkpointing=None, predictor_checkpointing=None,
+        compile_step=False, mask_bucket=32, text_bucket=16, compile_cache_size=64,
+        ema_every=1, n_views=1,
+    ):
 
     # Optimizer
     # optimizer = optim.Adam(
@@ -182,7 +197,63 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         device=DEVICE_0,
         shuffle=False,
         tensor_folder="src/datasets/train-tensor-448-10k",
+        prefetch_depth=2, # Prepare the next 2 batches while the current step runs
+        prefetch_workers=2,
+        mask_bank=mask_bank, # Precomputed masks from train_scripts/build_mask_bank.py, reproducible per step
+        n_views=n_views, # Context / target pairs per image
     )
+
+    if feature_store_folder is not None:
+        # -- The vision encoder is frozen, so encode every image once and read the features back each epoch
+        feature_store = FeatureStore(
+            folder=feature_store_folder,
+            num_tokens=NUM_PATCHES,
+            embed_dim=MODEL_CONFIG.V_EMBED_DIM,
+            dtype='bfloat16',
+            encoder_hash=checkpoint_hash(encoder_checkpoint, cache_path=os.path.join(feature_store_folder, FeatureStore.HASH_FILE)),
+        )
+        if feature_store.missing(dataset.image_filenames):
+            extract_features(dataset, vision_encoder, feature_store, batch_size=mini_batch_size, device=DEVICE_0)
+        dataset.feature_store = feature_store
+
+    captions = [caption for f in dataset.image_filenames for caption in dataset.caption_dict[f]]
+
+    if token_store_folder is not None:
+        # -- Tokenize every caption once, the step loop only pads stored ids
+        text_encoder.token_store = TokenStore(token_store_folder, text_encoder.model_path, text_encoder.max_length)
+        text_encoder.token_store.add(captions, text_encoder.tokenize)
+
+    if bucket_by_length:
+        # -- Batch images with captions of similar length, so text padding stays small
+        assert token_store_folder is not None, "bucket_by_length needs the caption lengths of a token store"
+        dataset.batch_sampler = LengthBucketBatchSampler(
+            dataset.text_lengths(text_encoder.token_store), batch_size=batch_size, window=4,
+        )
+
+    data_loader, dist_sampler = None, None
+    if loader_workers > 0:
+        # -- Load and mask samples in worker processes instead of the dataset's own prefetch threads
+        data_loader, dist_sampler = make_loader(
+            dataset,
+            batch_size=batch_size,
+            collator=MultiBlockCollator(
+                grid_size=MODEL_CONFIG.SIZE // MODEL_CONFIG.PATCH_SIZE,
+                block_scale=(0.15, 0.2),
+                block_aspect_ratio=(0.75, 1.5),
+                mask_bank=dataset.multiblock.mask_bank,
+                n_views=n_views,
+            ),
+            num_workers=loader_workers,
+            shuffle=False,
+            batch_sampler=dataset.batch_sampler,
+            with_steps=True, # Batches carry their global step for the mask bank
+        )
+
+    encode_text = text_encoder
+    if text_cache_folder is not None:
+        # -- Every caption is drawn from a fixed set, so encode each one once
+        encode_text = TextFeatureCache(text_encoder, folder=text_cache_folder, embed_dim=MODEL_CONFIG.T_EMBED_DIM)
+        encode_text.warm(captions)
     
     # -- OPTIMIZATION
     ipe_scale = params['optimization']['ipe_scale']  # scheduler scale factor (def: 1.0)
@@ -218,10 +289,8 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
 
     # ema = (0.999, 1.0)
     ema = (0.996, 1.0)
-    momentum_scheduler = (
-        ema[0] + i*(ema[1]-ema[0])/(ipe*num_epochs*ipe_scale)
-        for i in range(int(ipe*num_epochs*ipe_scale)+1)
-    )
+    # -- Fused (foreach) momentum update of target_crosser, every ema_every optimizer steps
+    target_ema = EMA(context_crosser, target_crosser, momentum=ema, T_max=ipe*num_epochs*ipe_scale, every=ema_every)
 
     previous_metrics = None
     if resume_from is not None:
@@ -236,10 +305,16 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         start_epoch = saved_dict['epoch']
         print(f"Resumed from epoch {start_epoch}")
 
+        # Mask bank steps continue where the run stopped
+        dataset.steps_done = start_epoch * ipe
+
         for _ in range(start_epoch*ipe):
             scheduler.step()
             wd_scheduler.step()
-            _m = next(momentum_scheduler)
+            _m = target_ema.advance()
+        if 'ema' in saved_dict:
+            target_ema.load_state_dict(saved_dict['ema'])
+            _m = target_ema.momentum
         
         print(f"Momemtum: {_m}")
 
@@ -261,6 +336,50 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
 
     last_time = time.time()
 
+    # -- Activation checkpointing (every k blocks or block indices): recompute in backward, fit larger mini batches
+    context_crosser.set_activation_checkpointing(crosser_checkpointing)
+    predictor.set_activation_checkpointing(predictor_checkpointing)
+    print(f"Checkpointed blocks: crosser {sorted(context_crosser.checkpointed)}, predictor {sorted(predictor.checkpointed)}")
+
+    # -- torch.compile: mask indices and text are padded to multiples of mask_bucket / text_bucket, so the
+    #    compiled crossers and predictor only ever see a bounded set of shapes (no dynamic shapes, no graph breaks)
+    run_context_crosser, run_target_crosser, run_predictor = context_crosser, target_crosser, predictor
+    if compile_step:
+        import torch._dynamo
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, compile_cache_size)
+        run_context_crosser = torch.compile(context_crosser, dynamic=False)
+        run_target_crosser = torch.compile(target_crosser, dynamic=False)
+        run_predictor = torch.compile(predictor, dynamic=False)
+
+    def jepa_step(encoded_text, text_attn_mask, encoded_image_full, context_masks, predict_masks, context_valid=None, predict_valid=None, view_index=None):
+        """
+        Predicted and target tokens of the masked patches and their smooth L1 loss, over valid tokens only.
+        view_index: image of every mask row with several mask views per image (see flatten_views), the text,
+        frozen features and target_crosser output are then computed once per image and gathered per view.
+        """
+        with torch.no_grad():
+            encoded_image_masked = apply_masks(encoded_image_full, context_masks, index=view_index) # Apply context mask
+
+        context_text, context_text_mask = encoded_text, text_attn_mask
+        if view_index is not None:
+            context_text, context_text_mask = encoded_text[view_index], text_attn_mask[view_index]
+        cross_encoded_context = run_context_crosser(context_text, encoded_image_masked, context_text_mask, vision_masks=context_valid)  # Cross encode the text and context
+        predicted = run_predictor(cross_encoded_context, context_masks, predict_masks, context_valid, predict_valid)  # Generate predictions based on context
+
+        with torch.no_grad():
+            cross_encoded_target = run_target_crosser(encoded_text, encoded_image_full, text_attn_mask)  # Cross encode the text and context
+            target = F.layer_norm(cross_encoded_target, (cross_encoded_target.size(-1),))  # Normalize the target
+            target = apply_masks(target, predict_masks, index=view_index)  # Apply predict mask
+
+        # Calculate loss (L1 loss here)
+        if predict_valid is None:
+            p_loss = F.smooth_l1_loss(predicted, target)
+        else:
+            # -- padded targets are left out, same value as the unpadded loss
+            p_loss = F.smooth_l1_loss(predicted, target, reduction='none') * predict_valid[..., None]
+            p_loss = p_loss.sum() / (predict_valid.sum() * p_loss.size(-1))
+        return p_loss, predicted, target
+
     # start from start_epoch
     for epoch in range(start_epoch, num_epochs):
 
@@ -268,16 +387,28 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         context_crosser.train()
         predictor.train()
 
+        if dataset.batch_sampler is not None:
+            dataset.batch_sampler.set_epoch(epoch)
+            print(f"Expected text padding efficiency: {dataset.batch_sampler.padding_efficiency(mini_batch_size):.3f}")
+        padding_meter = PaddingMeter()
+
+        batches = dataset
+        if data_loader is not None:
+            dist_sampler.set_epoch(epoch)
+            batches = (dataset.to_device(batch, non_blocking=True) for batch in data_loader)
+
         # Initialize tqdm for the dataset
-        with tqdm(dataset, desc=f"Epoch {epoch+1}/{num_epochs}") as pbar:
+        with tqdm(batches, total=len(dataset), desc=f"Epoch {epoch+1}/{num_epochs}") as pbar:
             for images, captions, context_masks, predict_masks in pbar:
 
                 start_time = time.time()
                 print(f"Load 1 iter dataset in {start_time-last_time} secs")
 
+                # First mask row, without the -1 padding of n_views > 1
+                vis_context, vis_predict = context_masks.flatten(0, -2)[0], predict_masks.flatten(0, -2)[0]
                 visualize_rectangle(
-                    context_masks[0].tolist(), 
-                    predict_masks[0].tolist(),
+                    vis_context[vis_context >= 0].tolist(), 
+                    vis_predict[vis_predict >= 0].tolist(),
                     p=MODEL_CONFIG.SIZE // MODEL_CONFIG.PATCH_SIZE
                 )
                 # print(images)
@@ -312,104 +443,41 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                     
                         # print(f"Encoding {len(mini_images)} images and {len(mini_captions)} captions...")
                         with torch.no_grad():
-                            encoded_text, text_attn_mask = text_encoder(mini_captions)  # Encode the text
+                            encoded_text, text_attn_mask = encode_text(mini_captions)  # Encode the text
+                            padding_meter.update(text_attn_mask)
                             # print(f"{encoded_text.shape=}")
                             # print(f"{encoded_text=}")
                             # print(f"{text_attn_mask.shape=}")
                             # print(f"{text_attn_mask=}")
-                            encoded_image_full = vision_encoder(mini_images)  # Encode the context patches
+                            if dataset.feature_store is not None:
+                                encoded_image_full = mini_images  # Cached vision encoder outputs
+                            else:
+                                encoded_image_full = vision_encoder(mini_images)  # Encode the context patches
                             # print(f"{encoded_image_full.shape=}")
                             # print(f"{encoded_image_full=}")
 
                             # start_time = time.time()
                             # for idx, record in enumerate(encoded_image_full):
                             #     print(idx, record[0][:3], record.shape)
-                            encoded_image_masked = apply_masks(encoded_image_full, mini_context_masks) # Apply context mask
-                            # print(f"{encoded_image_masked.shape=}")
-                            # print(f"{encoded_image_masked=}")
-                            # for idx, record in enumerate(encoded_image_masked):
-                            #     print(idx, record[0][:3], record.shape)
-                            # print(f"\tDone in {time.time() - start_time} seconds")  
-
-                            # print(f"{encoded_image_full.shape=}")
-                            # print(f"{encoded_image_masked.shape=}")
-                            # print(f"{encoded_text.shape=}")
-                            # print(f"{text_attn_mask.shape=}")
-
-                        # start_time = time.time()
-                        # print(f"Cross encoding context...")
-                        cross_encoded_context = context_crosser(encoded_text, encoded_image_masked, text_attn_mask)  # Cross encode the text and context
-                        # print(f"{cross_encoded_context.shape=}")
-                        # print(f"{cross_encoded_context=}")
-                        # print(f"{cross_encoded.shape=}")
-                        # print(f"\tDone in {time.time() - start_time} seconds")
-
-                        # start_time = time.time()
-                        # print(f"Predicting...")
-                        predicted = predictor(cross_encoded_context, mini_context_masks, mini_predict_masks)  # Generate predictions based on context
-                        # print(f"{predicted.shape=}")
-                        # print(f"{predicted=}")
-                        # print(f"{predicted.shape=}")
-                        # print(f"\tDone in {time.time() - start_time} seconds")
-
-                        # start_time = time.time()
-                        # print(f"Moving predictions to {DEVICE_0}...")   
-                        # print(f"\tDone in {time.time() - start_time} seconds")
-
-                        # start_time = time.time()   
-                        # print(f"Moving masks and encoded texts to {DEVICE_0}...")
-                        # print(f"\tDone in {time.time() - start_time} seconds")
-                        
-                        # start_time = time.time()
-                        # print(f"Cross encoding target...")
-
-                        with torch.no_grad():
-                            cross_encoded_target = target_crosser(encoded_text, encoded_image_full, text_attn_mask)  # Cross encode the text and context
-                            # print(f"{cross_encoded_target.shape=}")
-                            # print(f"{cross_encoded_target=}")
-                            # print(f"\tDone in {time.time() - start_time} seconds")
-                            
-                            # start_time = time.time()
-                            # print(f"Normalizing target...")
-                            target = F.layer_norm(cross_encoded_target, (cross_encoded_target.size(-1),))  # Normalize the target
-                            # print(f"{target.shape=}")
-                            # print(f"{target=}")
-                            
-    
-                            # print(mini_predict_masks[0])
-                            # print(len(mini_predict_masks[0]))
-                            # print(f"{target.shape=}")
-                            # for idx, patch in enumerate(target[0]):
-                            #     print(idx, patch[:3])
-                            # for idx, record in enumerate(target):
-                            #     print(idx, record[0][:3])
-                            
-                            # print(mini_predict_masks)
-                            target = apply_masks(target, mini_predict_masks)  # Apply predict mask
-                            # print(f"{target.shape=}")
-                            # print_tensor_with_precision(target[0][0][:10])
-                            # print_tensor_with_precision(target[0][1][:10])
-                            # print_tensor_with_precision(target[0][2][:10])
-                            # print_tensor_with_precision(target[0][3][:10])
-                            # print_tensor_with_precision(target[0][4][:10])
-                            # print_tensor_with_precision(target[0][5][:10])
-                            
-                            # print_tensor_with_precision(target[1][0][:10])
-                            # print_tensor_with_precision(target[1][1][:10])
-                            # print_tensor_with_precision(target[1][2][:10])
-                            # print_tensor_with_precision(target[1][3][:10])
-                            # print_tensor_with_precision(target[1][4][:10])
-                            # print_tensor_with_precision(target[1][5][:10])
-                            # print()
-    
-                            # for idx, record in enumerate(target):
-                            #     print(idx, record[0][:3])
-    
-                            # print(f"After mask: {target.shape=}")
-                            # print(f"\tDone in {time.time() - start_time} seconds")
-                            
-                            # Calculate loss (L1 loss here)
-                        p_loss = F.smooth_l1_loss(predicted, target)
+                        n_predict = mini_predict_masks.size(-1)
+                        view_index, context_valid, predict_valid = None, None, None
+                        if n_views > 1:
+                            # -- n_views mask pairs per image: context crosser + predictor run over B * n_views rows,
+                            #    views of different sizes are -1 padded and left out through the validity masks
+                            mini_context_masks, view_index, context_valid = flatten_views(mini_context_masks)
+                            mini_predict_masks, _, predict_valid = flatten_views(mini_predict_masks)
+                        if compile_step:
+                            # -- Fixed shape buckets: padded text / mask indices plus validity masks
+                            encoded_text, text_attn_mask = pad_tokens(encoded_text, text_attn_mask, text_bucket)
+                            mini_context_masks, context_valid = pad_masks(mini_context_masks, mask_bucket, NUM_PATCHES, context_valid)
+                            mini_predict_masks, predict_valid = pad_masks(mini_predict_masks, mask_bucket, NUM_PATCHES, predict_valid)
+
+                        # Context crosser + predictor, target crosser and loss (compiled modules with compile_step)
+                        p_loss, predicted, target = jepa_step(
+                            encoded_text, text_attn_mask, encoded_image_full,
+                            mini_context_masks, mini_predict_masks, context_valid, predict_valid, view_index,
+                        )
+                        predicted, target = predicted[:, :n_predict], target[:, :n_predict]  # Logs below only see real target tokens
 
                         saver.log(target[0][0][:10])
                         saver.log(predicted[0][0][:10])
@@ -462,11 +530,8 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                 # start_time = time.time()
                 # print(f"Updating target encoder...")
                 # Step 3. momentum update of target encoder
-                with torch.no_grad():
-                    m = next(momentum_scheduler)
-                    saver.log(f"Momentum: {m}")
-                    for param_q, param_k in zip(context_crosser.parameters(), target_crosser.parameters()):
-                        param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
+                m = target_ema.step()
+                saver.log(f"Momentum: {m}")
                 # print(f"\tDone in {time.time() - start_time} seconds")
 
                 loss = loss / n_mini_iter
@@ -483,6 +548,11 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                         'loss': loss
                     }
                 )
+
+        print(f"Text padding efficiency (real / padded tokens): {padding_meter.efficiency:.3f}")
+        saver.log(f"Text padding efficiency: {padding_meter.efficiency:.3f}")
+        if compile_step:
+            print(f"Compiled graphs so far (one per shape bucket): {torch._dynamo.utils.counters['stats']['unique_graphs']}")
         
         saver.save_epoch()
 
@@ -493,6 +563,7 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                 'target_crosser': target_crosser.state_dict(),
                 'opt': optimizer.state_dict(),
                 'scaler': None if scaler is None else scaler.state_dict(),
+                'ema': target_ema.state_dict(),
                 'epoch': epoch + 1,
                 'loss': loss
             }
@@ -513,6 +584,14 @@ def main():
         learning_rate=0.001,
         save_interval=20,
         resume_from="trains/SMALL-A100-448-10k-OBS-SCHEDULER/epoch-300.pt",
+        feature_store_folder=None, # "src/datasets/train-features-448-10k" to read cached ViT-H outputs (new runs)
+        text_cache_folder=None, # "src/datasets/train-text-features" (per-caption normalization differs from the padded live path, see TextFeatureCache)
+        token_store_folder=None, # "src/datasets/train-caption-tokens" to tokenize captions once (new runs)
+        bucket_by_length=False, # True (needs token_store_folder) batches captions by length, changes batch composition
+        crosser_checkpointing=None, # e.g. 1 (every block) to raise mini_batch_size, see train_scripts/bench_checkpointing.py
+        predictor_checkpointing=None,
+        ema_every=1, # >1 updates target_crosser less often, see train_scripts/bench_ema.py
+        n_views=1, # >1 reuses each frozen forward for several mask pairs, lower mini_batch_size accordingly
     )
 
 if __name__ == "__main__":
@@ -14,6 +14,9 @@ from src.helper import init_opt_fine_tune
 from src.utils.losses import cosine_similarity_matrix, contrastive_loss, clip_loss, max_margin_loss, max_margin_loss_negative_only, weighted_max_margin_loss
 
 from vqa_dataset import VQADataset
+from src.datasets.text_cache import TextFeatureCache
+from src.datasets.token_store import TokenStore
+from src.datasets.samplers import LengthBucketBatchSampler, PaddingMeter
 from src.masks.multiblock import MaskCollator
 import torch.nn.functional as F
 import torch.optim as optim
@@ -126,7 +129,14 @@ mlp_head = MLP(
 
 NUM_PATCHES = vision_encoder.patch_embed.num_patches
 
-def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=10, learning_rate=0.01, save_interval=1, resume_from=None):
+def encode_images(images, image_index=None):
+    """ Vision encoder outputs per question; with an image_index, ViT-H runs once per distinct image. """
+    if image_index is None:
+        return vision_encoder(images)
+    unique_index, inverse = torch.unique(image_index, return_inverse=True)
+    return vision_encoder(images[unique_index])[inverse]
+
+def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=10, learning_rate=0.01, save_interval=1, resume_from=None, text_cache_folder=None, token_store_folder=None, bucket_by_length=False, group_images=False, packed_text=False):
 
     start_epoch = 0
     
@@ -135,7 +145,29 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         img_size=MODEL_CONFIG.SIZE,
         shuffle=False,
         max=max_images_per_epoch,
+        group_images=group_images, # Questions of an image share one vision encoder pass
     )
+
+    questions = [row['questions'] for row in dataset.train_dict] + [row['questions'] for row in dataset.val_dict[:dataset.max_val]]
+
+    if token_store_folder is not None:
+        # -- Tokenize every question once, the step loop only pads stored ids
+        text_encoder.token_store = TokenStore(token_store_folder, text_encoder.model_path, text_encoder.max_length)
+        text_encoder.token_store.add(questions, text_encoder.tokenize)
+
+    if bucket_by_length:
+        # -- Batch questions of similar length, so text padding stays small
+        assert token_store_folder is not None, "bucket_by_length needs the question lengths of a token store"
+        assert not group_images, "bucket_by_length and group_images both decide the batch order"
+        dataset.batch_sampler = LengthBucketBatchSampler(
+            dataset.text_lengths(text_encoder.token_store), batch_size=batch_size, window=4,
+        )
+
+    encode_text = text_encoder
+    if text_cache_folder is not None:
+        # -- Questions never change between epochs, encode each one once
+        encode_text = TextFeatureCache(text_encoder, folder=text_cache_folder, embed_dim=MODEL_CONFIG.T_EMBED_DIM)
+        encode_text.warm(questions)
     
     # -- OPTIMIZATION
     ipe_scale = params['optimization']['ipe_scale']  # scheduler scale factor (def: 1.0)
@@ -217,9 +249,16 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         crosser.train()
         mlp_head.train()
 
+        if dataset.batch_sampler is not None:
+            dataset.batch_sampler.set_epoch(epoch)
+            print(f"Expected text padding efficiency: {dataset.batch_sampler.padding_efficiency(mini_batch_size):.3f}")
+        padding_meter = PaddingMeter()
+
         # Initialize tqdm for the dataset
         with tqdm(dataset, desc=f"Epoch {epoch+1}/{num_epochs}") as pbar:
-            for images, questions, answers in pbar:
+            for batch in pbar:
+                images, questions, answers = batch[:3]
+                image_index = batch[3] if group_images else None  # question -> row of images
 
                 start_time = time.time()
                 print(f"Load 1 iter dataset in {start_time-last_time} secs")
@@ -227,7 +266,7 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                 # Zero the gradients
                 loss = 0
 
-                n_mini_iter = len(images) // mini_batch_size
+                n_mini_iter = len(questions) // mini_batch_size
 
                 optimizer.zero_grad()
                 _new_lr = scheduler.step()
@@ -236,20 +275,23 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                 saver.log(f"{_new_wd=}")
 
                 # Loop through mini-batches
-                for i in range(0, len(images), mini_batch_size):
-                    mini_images = images[i:i+mini_batch_size]
+                for i in range(0, len(questions), mini_batch_size):
+                    mini_images = images if group_images else images[i:i+mini_batch_size]
+                    mini_image_index = image_index[i:i+mini_batch_size] if group_images else None
                     mini_questions = questions[i:i+mini_batch_size]
                     mini_answers = answers[i:i+mini_batch_size]
 
                     with torch.cuda.amp.autocast(dtype=torch.bfloat16, enabled=True):
                     
                         with torch.no_grad():
-                            encoded_text, text_attn_mask = text_encoder(mini_questions)  # Encode the text
+                            encoded_text, text_attn_mask = encode_text(mini_questions, packed=packed_text)  # Encode the text
+                            if text_attn_mask is not None:
+                                padding_meter.update(text_attn_mask)
                             # print(f"{encoded_text.shape=}")
                             # print(f"{encoded_text=}")
                             # print(f"{text_attn_mask.shape=}")
                             # print(f"{text_attn_mask=}")
-                            encoded_image_full = vision_encoder(mini_images)  # Encode the context patches
+                            encoded_image_full = encode_images(mini_images, mini_image_index)  # Encode the context patches
                             # print(f"{encoded_image_full.shape=}")
                             # print(f"{encoded_image_full=}")
 
@@ -310,6 +352,10 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
                         'loss': loss
                     }
                 )
+
+        if not packed_text:
+            print(f"Text padding efficiency (real / padded tokens): {padding_meter.efficiency:.3f}")
+            saver.log(f"Text padding efficiency: {padding_meter.efficiency:.3f}")
         
         saver.save_epoch()
 
@@ -324,10 +370,12 @@ def train(num_epochs=1, max_images_per_epoch=10, batch_size=10, mini_batch_size=
         
         with torch.no_grad():
             with tqdm(dataset.iter_val(), desc=f"Validation") as pbar:
-                for images, questions, answers in pbar:
+                for batch in pbar:
+                    images, questions, answers = batch[:3]
+                    image_index = batch[3] if group_images else None
     
-                    encoded_text, text_attn_mask = text_encoder(questions)
-                    encoded_image_full = vision_encoder(images)  # Encode the context patches
+                    encoded_text, text_attn_mask = encode_text(questions, packed=packed_text)
+                    encoded_image_full = encode_images(images, image_index)  # Encode the context patches
                     cross_encoded = crosser(encoded_text, encoded_image_full, text_attn_mask)  
                     pooled_encoded = cross_encoded.mean(dim=1)
                     
@@ -378,6 +426,10 @@ def main():
         learning_rate=1e-5,
         save_interval=2,
         resume_from="trains/VQA-1731977774/epoch-15.pt",
+        text_cache_folder=None, # "vqa_dataset/question-features" (per-caption normalization differs from the padded live path, see TextFeatureCache)
+        token_store_folder="vqa_dataset/question-tokens",
+        group_images=False, # True batches the questions of an image together (one ViT-H pass each); changes batch composition, for new runs
+        packed_text=False, # True: questions reach the crosser without padding (PackedText)
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+import time
+
+import torch
+
+from src.utils.tensors import apply_masks
+
+DEVICE = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+B, N, D = 26, 784, 1280  # mini-batch of ViT-H/16 features at 448px
+K = 392
+N_ITERS = 100
+
+
+def apply_masks_loop(x, masks):
+    """ Previous per-sample implementation, kept as the reference """
+    all_x = [
+        torch.gather(x[i:i+1], dim=1, index=m.unsqueeze(-1).repeat(1, 1, x.size(-1)))
+        for i, m in enumerate(masks)
+    ]
+    return torch.cat(all_x, dim=0)
+
+
+def sync():
+    if DEVICE.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def bench(fn, *args):
+    fn(*args)  # warmup
+    sync()
+    start = time.perf_counter()
+    for _ in range(N_ITERS):
+        fn(*args)
+    sync()
+    return (time.perf_counter() - start) / N_ITERS * 1000
+
+
+def main():
+    x = torch.randn(B, N, D, device=DEVICE, dtype=torch.bfloat16)
+
+    shared = torch.randperm(N, device=DEVICE)[:K].sort().values.unsqueeze(0).expand(B, -1)
+    per_sample = torch.stack([torch.randperm(N, device=DEVICE)[:K].sort().values for _ in range(B)])
+    boolean = torch.zeros(B, N, dtype=torch.bool, device=DEVICE).scatter_(1, per_sample, True)
+
+    cases = [
+        ('per-sample indices', per_sample),
+        ('shared indices', shared),
+        ('boolean mask', boolean),
+    ]
+    print(f"{DEVICE}: x={tuple(x.shape)}, K={K}")
+    print(f"{'masks':<20} | {'loop ms':>8} | {'batched ms':>10} | {'speedup':>7} | match")
+    for name, masks in cases:
+        index_masks = per_sample if masks.dtype == torch.bool else masks
+        reference = apply_masks_loop(x, index_masks)
+        match = torch.equal(reference, apply_masks(x, masks))
+        loop_ms = bench(apply_masks_loop, x, index_masks)
+        batched_ms = bench(apply_masks, x, masks)
+        print(f"{name:<20} | {loop_ms:>8.3f} | {batched_ms:>10.3f} | {loop_ms / batched_ms:>6.1f}x | {match}")
+
+
+if __name__ == "__main__":
+    main()
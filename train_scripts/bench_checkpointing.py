@@ -0,0 +1,94 @@
+import time
+
+import torch
+
+from src.models.modules import x_t2i_module, vit_predictor
+from src.utils.tensors import apply_masks
+from src.masks.custom_multiblock import MultiBlock
+
+# Peak memory and time per sample of the trainable context_crosser + predictor step
+# of train_P_large_A100.py, for several activation-checkpointing settings and mini-batch sizes
+DEVICE = 'cuda:0'
+GRID = 28  # 448px / 16
+V_EMBED_DIM = 1280
+T_EMBED_DIM = 768
+H_EMBED_DIM = 768
+PRED_EMBED_DIM = 384
+CROSS_ATTN_DEPTH = 4
+PRED_DEPTH = 12
+N_TEXT = 32
+N_ITERS = 10
+
+MINI_BATCH_SIZES = [26, 52, 78, 130]
+SETTINGS = {  # name: (crosser, predictor)
+    'none': (None, None),
+    'predictor every 2': (None, 2),
+    'predictor all': (None, 1),
+    'crosser + predictor every 2': (2, 2),
+    'crosser + predictor all': (1, 1),
+}
+
+
+def bench(crosser, predictor, multiblock, B):
+    masks_x, masks = multiblock(B)
+    V = torch.randn(B, GRID * GRID, V_EMBED_DIM, device=DEVICE)
+    T = torch.randn(B, N_TEXT, T_EMBED_DIM, device=DEVICE)
+    text_masks = torch.ones(B, N_TEXT, dtype=torch.long, device=DEVICE)
+
+    def step():
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            context = crosser(T, apply_masks(V, masks_x), text_masks)
+            predicted = predictor(context, masks_x, masks)
+        predicted.float().mean().backward()
+
+    try:
+        step()  # warmup
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(N_ITERS):
+            step()
+        torch.cuda.synchronize()
+    except torch.cuda.OutOfMemoryError:
+        crosser.zero_grad(set_to_none=True)
+        predictor.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+        return None, None
+    ms_per_sample = (time.perf_counter() - start) / N_ITERS / B * 1000
+    return ms_per_sample, (torch.cuda.max_memory_allocated() - base) / 1024**3
+
+
+def main():
+    crosser = x_t2i_module(
+        text_embed_dim=T_EMBED_DIM,
+        vision_embed_dim=V_EMBED_DIM,
+        hidden_dim=H_EMBED_DIM,
+        depth=CROSS_ATTN_DEPTH,
+        num_heads=8,
+        qkv_bias=True,
+    ).to(DEVICE)
+    predictor = vit_predictor(
+        embed_dim=H_EMBED_DIM,
+        depth=PRED_DEPTH,
+        num_heads=12,
+        predictor_embed_dim=PRED_EMBED_DIM,
+        num_patches=GRID * GRID,
+    ).to(DEVICE)
+    multiblock = MultiBlock(grid_size=GRID, device_context_masks=DEVICE, device_predict_masks=DEVICE, seed=0)
+
+    print(f"crosser depth={CROSS_ATTN_DEPTH}, predictor depth={PRED_DEPTH}, grid={GRID}x{GRID}")
+    print(f"{'checkpointing':<28} | {'mini batch':>10} | {'ms / sample':>11} | {'peak GB':>7}")
+    for name, (crosser_setting, predictor_setting) in SETTINGS.items():
+        crosser.set_activation_checkpointing(crosser_setting)
+        predictor.set_activation_checkpointing(predictor_setting)
+        for B in MINI_BATCH_SIZES:
+            ms, peak = bench(crosser, predictor, multiblock, B)
+            if ms is None:
+                print(f"{name:<28} | {B:>10} | {'OOM':>11} | {'-':>7}")
+                continue
+            print(f"{name:<28} | {B:>10} | {ms:>11.3f} | {peak:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import time
+
+import numpy as np
+import torch
+import torch._dynamo
+import torch.nn.functional as F
+
+from src.models.modules import x_t2i_module, vit_predictor
+from src.utils.tensors import apply_masks, pad_masks, pad_tokens
+from src.masks.custom_multiblock import MultiBlock
+
+# Compile time, graph count and steady-state speedup of the bucketed (static shape) crosser + predictor
+# step of train_P_large_A100.py (compile_step=True) against the eager unpadded step, on CPU
+DEVICE = 'cpu'
+B = 8
+GRID = 14  # 224px / 16, kept small for CPU
+V_EMBED_DIM = 1280
+T_EMBED_DIM = 768
+H_EMBED_DIM = 768
+PRED_EMBED_DIM = 384
+CROSS_ATTN_DEPTH = 2
+PRED_DEPTH = 4
+TEXT_LENGTHS = (8, 40)  # caption token counts drawn per step
+MASK_BUCKET = 32
+TEXT_BUCKET = 16
+N_STEPS = 60
+
+
+def make_batches(multiblock, rng):
+    batches = []
+    for _ in range(N_STEPS):
+        masks_x, masks = multiblock(B)
+        n_text = int(rng.integers(*TEXT_LENGTHS))
+        T = torch.randn(B, n_text, T_EMBED_DIM)
+        text_masks = torch.ones(B, n_text, dtype=torch.long)
+        V = torch.randn(B, GRID * GRID, V_EMBED_DIM)
+        batches.append((T, text_masks, V, masks_x, masks))
+    return batches
+
+
+def step(crosser, predictor, T, text_masks, V, masks_x, masks, masks_x_valid=None, masks_valid=None):
+    context = crosser(T, apply_masks(V, masks_x), text_masks, vision_masks=masks_x_valid)
+    predicted = predictor(context, masks_x, masks, masks_x_valid, masks_valid)
+    target = apply_masks(V[..., :H_EMBED_DIM], masks)
+    loss = F.smooth_l1_loss(predicted, target, reduction='none')
+    if masks_valid is not None:
+        loss = loss * masks_valid[..., None]
+        return loss.sum() / (masks_valid.sum() * loss.size(-1))
+    return loss.mean()
+
+
+def run(batches, crosser, predictor, padded):
+    """ Per-step times and whether each step compiled a new graph. """
+    times, compiled = [], []
+    for T, text_masks, V, masks_x, masks in batches:
+        masks_x_valid, masks_valid = None, None
+        if padded:
+            T, text_masks = pad_tokens(T, text_masks, TEXT_BUCKET)
+            masks_x, masks_x_valid = pad_masks(masks_x, MASK_BUCKET, GRID * GRID)
+            masks, masks_valid = pad_masks(masks, MASK_BUCKET, GRID * GRID)
+        graphs = torch._dynamo.utils.counters['stats']['unique_graphs']
+        start = time.perf_counter()
+        step(crosser, predictor, T, text_masks, V, masks_x, masks, masks_x_valid, masks_valid).backward()
+        times.append(time.perf_counter() - start)
+        compiled.append(torch._dynamo.utils.counters['stats']['unique_graphs'] > graphs)
+    return np.array(times), np.array(compiled)
+
+
+def main():
+    torch.manual_seed(0)
+    crosser = x_t2i_module(
+        text_embed_dim=T_EMBED_DIM,
+        vision_embed_dim=V_EMBED_DIM,
+        hidden_dim=H_EMBED_DIM,
+        depth=CROSS_ATTN_DEPTH,
+        num_heads=8,
+        qkv_bias=True,
+    ).to(DEVICE)
+    predictor = vit_predictor(
+        embed_dim=H_EMBED_DIM,
+        depth=PRED_DEPTH,
+        num_heads=12,
+        predictor_embed_dim=PRED_EMBED_DIM,
+        num_patches=GRID * GRID,
+    ).to(DEVICE)
+    multiblock = MultiBlock(grid_size=GRID, device_context_masks=DEVICE, device_predict_masks=DEVICE, seed=0)
+    batches = make_batches(multiblock, np.random.default_rng(0))
+
+    shapes = {(T.size(1), masks_x.size(1), masks.size(1)) for T, _, _, masks_x, masks in batches}
+    print(f"{N_STEPS} steps, {len(shapes)} distinct (text, context, target) lengths unpadded")
+
+    eager_times, _ = run(batches, crosser, predictor, padded=False)
+    eager_ms = eager_times[1:].mean() * 1000
+
+    torch._dynamo.reset()
+    torch._dynamo.config.cache_size_limit = 64
+    compiled_times, compiled = run(
+        batches, torch.compile(crosser, dynamic=False), torch.compile(predictor, dynamic=False), padded=True)
+    steady_ms = compiled_times[~compiled].mean() * 1000 if (~compiled).any() else float('nan')
+    compile_s = (compiled_times[compiled] - steady_ms / 1000).sum()
+
+    print(f"{'eager ms / step (unpadded)':<34} {eager_ms:>8.1f}")
+    print(f"{'compiled ms / step (steady state)':<34} {steady_ms:>8.1f}")
+    print(f"{'speedup':<34} {eager_ms / steady_ms:>7.2f}x")
+    print(f"{'compile time (s)':<34} {compile_s:>8.1f}")
+    print(f"{'steps that compiled':<34} {int(compiled.sum()):>8}")
+    print(f"{'graphs compiled':<34} {torch._dynamo.utils.counters['stats']['unique_graphs']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import copy
+import time
+
+import torch
+
+from src.models.modules import x_t2i_module
+from src.utils.ema import EMA
+
+# Per-step time of the target_crosser momentum update of train_P_large_A100.py:
+# the per-parameter Python loop against the fused (foreach) EMA, plus the drift between the two
+DEVICE = 'cuda:0'
+V_EMBED_DIM = 1280
+T_EMBED_DIM = 768
+H_EMBED_DIM = 768
+CROSS_ATTN_DEPTH = 4
+EMA_RANGE = (0.996, 1.0)
+T_MAX = 10000
+EVERY = [1, 2, 4]
+N_STEPS = 200
+
+
+def loop_step(context_crosser, target_crosser, momentum_scheduler):
+    """ The update as written in the train scripts. """
+    with torch.no_grad():
+        m = next(momentum_scheduler)
+        for param_q, param_k in zip(context_crosser.parameters(), target_crosser.parameters()):
+            param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
+
+
+def timed(step):
+    step()  # warmup
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(N_STEPS):
+        step()
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / N_STEPS * 1000
+
+
+def main():
+    context_crosser = x_t2i_module(
+        text_embed_dim=T_EMBED_DIM,
+        vision_embed_dim=V_EMBED_DIM,
+        hidden_dim=H_EMBED_DIM,
+        depth=CROSS_ATTN_DEPTH,
+        num_heads=8,
+        qkv_bias=True,
+    ).to(DEVICE)
+    n_params = sum(p.numel() for p in context_crosser.parameters())
+    n_tensors = len(list(context_crosser.parameters()))
+    print(f"context_crosser: {n_tensors} parameter tensors, {n_params / 1e6:.1f}M parameters")
+
+    target_crosser = copy.deepcopy(context_crosser)
+    momentum_scheduler = (
+        EMA_RANGE[0] + i*(EMA_RANGE[1]-EMA_RANGE[0])/T_MAX
+        for i in range(T_MAX+1)
+    )
+    loop_ms = timed(lambda: loop_step(context_crosser, target_crosser, momentum_scheduler))
+
+    print(f"{'update':<16} | {'ms / step':>9} | {'speedup':>7}")
+    print(f"{'python loop':<16} | {loop_ms:>9.3f} | {1.:>6.2f}x")
+    for every in EVERY:
+        ema = EMA(context_crosser, copy.deepcopy(context_crosser), momentum=EMA_RANGE, T_max=T_MAX, every=every)
+        ms = timed(ema.step)
+        print(f"{f'foreach every {every}':<16} | {ms:>9.3f} | {loop_ms / ms:>6.2f}x")
+
+    # -- Same schedule, moving online weights: the fused update should match the loop up to rounding
+    torch.manual_seed(0)
+    reference, fused = copy.deepcopy(context_crosser), copy.deepcopy(context_crosser)
+    ema = EMA(context_crosser, fused, momentum=EMA_RANGE, T_max=T_MAX)
+    momentum_scheduler = (
+        EMA_RANGE[0] + i*(EMA_RANGE[1]-EMA_RANGE[0])/T_MAX
+        for i in range(T_MAX+1)
+    )
+    for _ in range(N_STEPS):
+        with torch.no_grad():
+            for p in context_crosser.parameters():
+                p.add_(torch.randn_like(p), alpha=1e-3)
+        loop_step(context_crosser, reference, momentum_scheduler)
+        ema.step()
+    drift = max((p - q).abs().max().item() for p, q in zip(reference.parameters(), fused.parameters()))
+    print(f"\nmax |loop - foreach| after {N_STEPS} steps: {drift:.2e}")
+
+
+if __name__ == "__main__":
+    main()
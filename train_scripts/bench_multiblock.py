@@ -0,0 +1,41 @@
+import time
+
+from src.masks.custom_multiblock import MultiBlock
+
+BATCH_SIZE = 26 * 15
+N_ITERS = 200
+
+
+def bench(multiblock, n_iters=N_ITERS):
+    multiblock(BATCH_SIZE)  # warmup
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        multiblock(BATCH_SIZE)
+    return (time.perf_counter() - start) / n_iters * 1000
+
+
+def main():
+    print(f"{'grid':>6} | {'mode':<20} | {'ms / batch':>10} | {'speedup':>7}")
+    for grid_size in (28, 32):
+        modes = {
+            'loops (original)': dict(vectorized=False),
+            'vectorized shared': dict(),
+            'vectorized per-sample': dict(per_sample=True),
+        }
+        baseline = None
+        for name, kwargs in modes.items():
+            multiblock = MultiBlock(
+                grid_size=grid_size,
+                block_scale=(0.15, 0.2),
+                block_aspect_ratio=(0.75, 1.5),
+                device_context_masks='cpu',
+                device_predict_masks='cpu',
+                **kwargs,
+            )
+            ms = bench(multiblock)
+            baseline = baseline or ms
+            print(f"{grid_size:>3}x{grid_size:<2} | {name:<20} | {ms:>10.3f} | {baseline / ms:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from src.models.modules import x_t2i_module, PackedText
+from src.datasets.token_store import TokenStore
+
+DEVICE = 'cuda:0'
+B = 100  # mini batch of the VQA / COCO training loops
+N_VISION = 28 * 28  # 448px / 16
+V_EMBED_DIM = 1280
+T_EMBED_DIM = 768
+H_EMBED_DIM = 768
+CROSS_ATTN_DEPTH = 4
+CROSS_NUM_HEADS = 8
+N_BATCHES = 20
+
+# -- Real caption / question length distributions, from the training token stores
+TOKEN_STORES = {
+    'coco captions': 'src/datasets/train-caption-tokens',
+    'vqa questions': 'vqa_dataset/question-tokens',
+}
+
+
+def store_lengths(folder):
+    with open(os.path.join(folder, TokenStore.INDEX_FILE), 'r') as f:
+        entries = json.load(f)['entries']
+    return np.array([length for _, length in entries.values()], dtype=np.int64)
+
+
+def make_batches(lengths, rng):
+    """ Random text features of N_BATCHES batches with lengths drawn from the store, padded and packed. """
+    batches = []
+    for _ in range(N_BATCHES):
+        batch_lengths = torch.from_numpy(rng.choice(lengths, size=B))
+        T = torch.randn(B, int(batch_lengths.max()), T_EMBED_DIM, device=DEVICE)
+        attn_masks = (torch.arange(T.size(1))[None, :] < batch_lengths[:, None]).long().to(DEVICE)
+        T = T * attn_masks[..., None]
+        batches.append((T, attn_masks, PackedText.from_padded(T, attn_masks)))
+    return batches
+
+
+def bench(fn, batches):
+    def step(batch):
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            out = fn(batch)
+        out.float().mean().backward()
+
+    step(batches[0])  # warmup
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for batch in batches:
+        step(batch)
+    torch.cuda.synchronize()
+    ms = (time.perf_counter() - start) / len(batches) * 1000
+    return ms, (torch.cuda.max_memory_allocated() - base) / 1024**2
+
+
+def main():
+    crosser = x_t2i_module(
+        text_embed_dim=T_EMBED_DIM,
+        vision_embed_dim=V_EMBED_DIM,
+        hidden_dim=H_EMBED_DIM,
+        depth=CROSS_ATTN_DEPTH,
+        num_heads=CROSS_NUM_HEADS,
+        qkv_bias=True,
+    ).to(DEVICE)
+    V = torch.randn(B, N_VISION, V_EMBED_DIM, device=DEVICE)
+    rng = np.random.default_rng(0)
+
+    print(f"X_T2I depth={CROSS_ATTN_DEPTH}, batch={B}, {N_VISION} image tokens")
+    print(f"{'texts':<14} | {'path':<7} | {'real / padded':>13} | {'ms / step':>9} | {'peak MB':>8} | {'max |diff|':>10}")
+    for name, folder in TOKEN_STORES.items():
+        if not os.path.exists(os.path.join(folder, TokenStore.INDEX_FILE)):
+            print(f"{name:<14} | no token store at {folder}, skipped")
+            continue
+        batches = make_batches(store_lengths(folder), rng)
+        real = sum(int(attn_masks.sum()) for _, attn_masks, _ in batches)
+        padded = sum(attn_masks.numel() for _, attn_masks, _ in batches)
+
+        # -- Equivalence of the two paths, in fp32
+        T, attn_masks, packed = batches[0]
+        with torch.no_grad():
+            diff = (crosser(T, V, attn_masks) - crosser(packed, V)).abs().max().item()
+
+        for path, fn in (
+            ('padded', lambda batch: crosser(batch[0], V, batch[1])),
+            ('packed', lambda batch: crosser(batch[2], V)),
+        ):
+            ms, peak = bench(fn, batches)
+            efficiency = real / padded if path == 'padded' else 1.0
+            print(f"{name:<14} | {path:<7} | {efficiency:>13.3f} | {ms:>9.2f} | {peak:>8.1f} | {diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import time
+
+import torch
+
+from src.models.modules import vit_predictor
+from src.utils.tensors import apply_masks
+from src.masks.custom_multiblock import MultiBlock
+
+DEVICE = 'cuda:0'
+B = 26
+GRID = 28  # 448px / 16
+EMBED_DIM = 768
+PRED_EMBED_DIM = 384
+DEPTH = 12
+N_ITERS = 20
+
+
+def forward_repeat(predictor, x, masks_x, masks):
+    """ Previous forward: repeated positional tables, repeated mask tokens and a cat """
+    B = len(x)
+    x = predictor.predictor_embed(x)
+    x_pos_embed = predictor.predictor_pos_embed.repeat(B, 1, 1)
+    x += apply_masks(x_pos_embed, masks_x)
+    _, N_ctxt, D = x.shape
+    pos_embs = predictor.predictor_pos_embed.repeat(B, 1, 1)
+    pos_embs = apply_masks(pos_embs, masks)
+    pred_tokens = predictor.mask_token.repeat(pos_embs.size(0), pos_embs.size(1), 1)
+    pred_tokens += pos_embs
+    x = torch.cat([x, pred_tokens], dim=1)
+    for blk in predictor.predictor_blocks:
+        x = blk(x)
+    x = predictor.predictor_norm(x)
+    x = x[:, N_ctxt:]
+    return predictor.predictor_proj(x)
+
+
+def bench(fn, predictor, x, masks_x, masks):
+    def step():
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            out = fn(predictor, x, masks_x, masks)
+        out.float().mean().backward()
+
+    step()  # warmup
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(N_ITERS):
+        step()
+    torch.cuda.synchronize()
+    ms = (time.perf_counter() - start) / N_ITERS * 1000
+    return ms, (torch.cuda.max_memory_allocated() - base) / 1024**2
+
+
+def main():
+    predictor = vit_predictor(
+        embed_dim=EMBED_DIM,
+        depth=DEPTH,
+        num_heads=12,
+        predictor_embed_dim=PRED_EMBED_DIM,
+        num_patches=GRID * GRID,
+    ).to(DEVICE)
+
+    cases = {
+        'shared': MultiBlock(grid_size=GRID, device_context_masks=DEVICE, device_predict_masks=DEVICE, seed=0),
+        'per-sample': MultiBlock(grid_size=GRID, device_context_masks=DEVICE, device_predict_masks=DEVICE, seed=0, per_sample=True),
+    }
+    print(f"predictor depth={DEPTH}, batch={B}, grid={GRID}x{GRID}")
+    print(f"{'masks':<10} | {'forward':<8} | {'ms / step':>9} | {'peak MB':>8}")
+    for name, multiblock in cases.items():
+        masks_x, masks = multiblock(B)
+        x = torch.randn(B, masks_x.size(1), EMBED_DIM, device=DEVICE, requires_grad=True)
+        for label, fn in (('repeat', forward_repeat), ('buffer', type(predictor).forward)):
+            ms, peak = bench(fn, predictor, x, masks_x, masks)
+            print(f"{name:<10} | {label:<8} | {ms:>9.2f} | {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
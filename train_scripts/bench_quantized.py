@@ -0,0 +1,70 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+from load_tijepa_448 import load_448, inference_448
+from eval_on_mvsa import MVSA
+from src.models.quantization import serialized_size
+
+# Embedding drift and CPU latency / throughput of int8 dynamically quantized encoders against fp32
+CHECKPOINT = "trains/SMALL-A100-448-10k-OBS-SCHEDULER/epoch-300.pt"
+QUANTIZE = 'encoders'  # or 'all' to quantize the crosser too
+MVSA_TENSOR_FOLDER = "src/datasets/mvsa-tensor"
+DRIFT_BATCH_SIZE = 16
+N_DRIFT_BATCHES = 8
+BATCH_SIZES = [1, 8]
+N_ITERS = 5
+
+
+@torch.no_grad()
+def drift(reference, quantized):
+    """ Pooled embeddings of fp32 vs int8 models on MVSA image / tweet pairs. """
+    ds = MVSA(batch_size=DRIFT_BATCH_SIZE, img_size=224, device='cpu', tensor_folder=MVSA_TENSOR_FOLDER)
+    cos, rel = [], []
+    for i, (images, captions, _) in enumerate(ds):
+        if i == N_DRIFT_BATCHES:
+            break
+        expected = inference_448(images, captions, *reference)
+        actual = inference_448(images, captions, *quantized)
+        cos.append(F.cosine_similarity(actual, expected, dim=-1))
+        rel.append((actual - expected).norm(dim=-1) / expected.norm(dim=-1))
+    return torch.cat(cos), torch.cat(rel), images[:1], captions[:1]
+
+
+@torch.no_grad()
+def latency(models, image, caption, batch_size):
+    images, captions = image.expand(batch_size, -1, -1, -1).contiguous(), caption * batch_size
+    inference_448(images, captions, *models)  # warmup
+    start = time.perf_counter()
+    for _ in range(N_ITERS):
+        inference_448(images, captions, *models)
+    return (time.perf_counter() - start) / N_ITERS
+
+
+def main():
+    reference = load_448(CHECKPOINT, device='cpu')
+    for model in reference:
+        model.eval()
+    quantized = load_448(CHECKPOINT, device='cpu', quantize=QUANTIZE)
+    quantized[2].eval()
+
+    print(f"{torch.get_num_threads()} CPU threads, quantize={QUANTIZE}")
+    print(f"{'model':<14} | {'fp32 MB':>8} | {'int8 MB':>8}")
+    for name, fp32, int8 in zip(('text encoder', 'vision encoder', 'crosser'), reference, quantized):
+        print(f"{name:<14} | {serialized_size(fp32) / 1024**2:>8.0f} | {serialized_size(int8) / 1024**2:>8.0f}")
+
+    cos, rel, image, caption = drift(reference, quantized)
+    print(f"\nPooled embedding drift over {len(cos)} MVSA pairs")
+    print(f"cosine similarity: mean {cos.mean():.5f}, min {cos.min():.5f}")
+    print(f"relative L2 error: mean {rel.mean():.4f}, max {rel.max():.4f}")
+
+    print(f"\n{'batch':>5} | {'fp32 ms':>9} | {'int8 ms':>9} | {'fp32 pairs / s':>14} | {'int8 pairs / s':>14} | {'speedup':>7}")
+    for batch_size in BATCH_SIZES:
+        fp32 = latency(reference, image, caption, batch_size)
+        int8 = latency(quantized, image, caption, batch_size)
+        print(f"{batch_size:>5} | {fp32 * 1000:>9.0f} | {int8 * 1000:>9.0f} | {batch_size / fp32:>14.2f} | {batch_size / int8:>14.2f} | {fp32 / int8:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import time
+
+import torch
+
+from load_tijepa_448 import load_448, inference_448, MODEL_CONFIG
+from eval_on_mvsa import encode_dataset, train_simple_linear_module
+
+# Latency vs quality of the 448-trained encoders served at lower input resolutions,
+# with the interpolated positional tables cached per grid size
+DEVICE = 'cuda:0'
+RESOLUTIONS = [224, 336, 448]
+
+TIJEPA_CHECKPOINT = "trains/SMALL-A100-448-10k-OBS-SCHEDULER/epoch-300.pt"
+MVSA_TENSOR_FOLDER = "src/datasets/mvsa-tensor"
+MVSA_SAVE_PATH = "src/datasets/mvsa-resolution"  # per-resolution embeddings
+MVSA_EPOCHS = 5
+
+THROUGHPUT_BATCH = 32
+N_ITERS = 10
+
+
+@torch.no_grad()
+def throughput(models, resolution):
+    """ Pairs / s of the full text + vision + crosser pipeline on a 448px batch resized to resolution. """
+    images = torch.randn(THROUGHPUT_BATCH, 3, MODEL_CONFIG.SIZE, MODEL_CONFIG.SIZE, device=DEVICE)
+    captions = ["a photo of a dog playing in the park"] * THROUGHPUT_BATCH
+    with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+        inference_448(images, captions, *models, resolution=resolution)  # warmup, fills the positional cache
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(N_ITERS):
+            inference_448(images, captions, *models, resolution=resolution)
+        torch.cuda.synchronize()
+    return THROUGHPUT_BATCH * N_ITERS / (time.perf_counter() - start)
+
+
+def mvsa_accuracy(resolution):
+    """ Encode MVSA at the given resolution, then fit the linear probe; validation accuracy. """
+    save_path = os.path.join(MVSA_SAVE_PATH, f"res{resolution}")
+    os.makedirs(save_path, exist_ok=True)
+    encode_dataset(TIJEPA_CHECKPOINT, batch_size=64, device=DEVICE, save_path=save_path, tensor_folder=MVSA_TENSOR_FOLDER, resolution=resolution)
+    metrics = train_simple_linear_module(save_path, hidden_size=MODEL_CONFIG.H_EMBED_DIM, device=DEVICE, epochs=MVSA_EPOCHS)
+    return metrics['accuracy']
+
+
+def main():
+    models = load_448(TIJEPA_CHECKPOINT)
+    for model in models:
+        model.eval()
+
+    rows = []
+    for resolution in RESOLUTIONS:
+        pairs_per_s = throughput(models, resolution)
+        mvsa = mvsa_accuracy(resolution)
+        rows.append((resolution, (resolution // 16) ** 2, pairs_per_s, mvsa))
+
+    base = rows[-1][2]
+    print(f"{'resolution':>10} | {'patches':>7} | {'pairs / s':>9} | {'speedup':>7} | {'MVSA val acc':>12}")
+    for resolution, n_patches, pairs_per_s, mvsa in rows:
+        print(f"{resolution:>10} | {n_patches:>7} | {pairs_per_s:>9.1f} | {pairs_per_s / base:>6.2f}x | {mvsa:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+
+from src.models.modules import vit_huge, x_t2i_module, vit_predictor
+from src.utils.tensors import apply_masks, flatten_views
+from src.masks.custom_multiblock import MultiBlock
+
+# Time per image and per mask pair of the train_P_large_A100.py step with n_views context / target
+# pairs per image: the frozen ViT-H and target_crosser run once per image, the context crosser and
+# predictor over every view
+DEVICE = 'cuda:0'
+GRID = 28  # 448px / 16
+V_EMBED_DIM = 1280
+T_EMBED_DIM = 768
+H_EMBED_DIM = 768
+PRED_EMBED_DIM = 384
+CROSS_ATTN_DEPTH = 4
+PRED_DEPTH = 12
+N_TEXT = 32
+N_ITERS = 10
+
+N_IMAGES = 16
+N_VIEWS = [1, 2, 4, 8]
+
+
+def bench(vision_encoder, context_crosser, target_crosser, predictor, n_views):
+    multiblock = MultiBlock(grid_size=GRID, device_context_masks=DEVICE, device_predict_masks=DEVICE, seed=0, n_views=n_views)
+    images = torch.randn(N_IMAGES, 3, GRID * 16, GRID * 16, device=DEVICE)
+    T = torch.randn(N_IMAGES, N_TEXT, T_EMBED_DIM, device=DEVICE)
+    text_masks = torch.ones(N_IMAGES, N_TEXT, dtype=torch.long, device=DEVICE)
+
+    def step():
+        masks_x, masks = multiblock(N_IMAGES)
+        view_index, masks_x_valid, masks_valid = None, None, None
+        if n_views > 1:
+            masks_x, view_index, masks_x_valid = flatten_views(masks_x)
+            masks, _, masks_valid = flatten_views(masks)
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            with torch.no_grad():
+                V = vision_encoder(images)
+                target = target_crosser(T, V, text_masks)
+                target = apply_masks(F.layer_norm(target, (target.size(-1),)), masks, index=view_index)
+            context_T, context_masks = (T, text_masks) if view_index is None else (T[view_index], text_masks[view_index])
+            context = context_crosser(context_T, apply_masks(V, masks_x, index=view_index), context_masks, vision_masks=masks_x_valid)
+            predicted = predictor(context, masks_x, masks, masks_x_valid, masks_valid)
+            loss = F.smooth_l1_loss(predicted, target, reduction='none')
+            if masks_valid is not None:
+                loss = loss * masks_valid[..., None]
+                loss = loss.sum() / (masks_valid.sum() * loss.size(-1))
+            else:
+                loss = loss.mean()
+        loss.backward()
+
+    step()  # warmup
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(N_ITERS):
+        step()
+    torch.cuda.synchronize()
+    ms_per_image = (time.perf_counter() - start) / N_ITERS / N_IMAGES * 1000
+    return ms_per_image, torch.cuda.max_memory_allocated() / 1024**3
+
+
+def main():
+    vision_encoder = vit_huge(img_size=[GRID * 16]).to(DEVICE).eval()
+    for p in vision_encoder.parameters():
+        p.requires_grad = False
+    context_crosser = x_t2i_module(
+        text_embed_dim=T_EMBED_DIM,
+        vision_embed_dim=V_EMBED_DIM,
+        hidden_dim=H_EMBED_DIM,
+        depth=CROSS_ATTN_DEPTH,
+        num_heads=8,
+        qkv_bias=True,
+    ).to(DEVICE)
+    target_crosser = copy.deepcopy(context_crosser)
+    for p in target_crosser.parameters():
+        p.requires_grad = False
+    predictor = vit_predictor(
+        embed_dim=H_EMBED_DIM,
+        depth=PRED_DEPTH,
+        num_heads=12,
+        predictor_embed_dim=PRED_EMBED_DIM,
+        num_patches=GRID * GRID,
+    ).to(DEVICE)
+
+    print(f"{N_IMAGES} images per step, grid={GRID}x{GRID}")
+    print(f"{'views':>5} | {'ms / image':>10} | {'ms / mask pair':>14} | {'peak GB':>7}")
+    for n_views in N_VIEWS:
+        ms, peak = bench(vision_encoder, context_crosser, target_crosser, predictor, n_views)
+        print(f"{n_views:>5} | {ms:>10.2f} | {ms / n_views:>14.2f} | {peak:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
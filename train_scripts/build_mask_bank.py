@@ -0,0 +1,52 @@
+import argparse
+
+import yaml
+
+from src.masks.custom_multiblock import MultiBlock
+from src.masks.multiblock import MaskCollator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute a seeded mask bank for MultiBlock (T-JEPA) or MaskCollator (src/train.py).")
+    parser.add_argument("path", help="Output .npz file")
+    parser.add_argument("--kind", choices=["multiblock", "collator"], default="multiblock")
+    parser.add_argument("--groups", type=int, default=10000, help="Number of distinct steps before the bank cycles")
+    parser.add_argument("--group-size", type=int, default=1, help="Masks per step: 1 = shared across the batch, else >= batch size")
+    parser.add_argument("--seed", type=int, default=0)
+    # -- MultiBlock
+    parser.add_argument("--grid-size", type=int, default=28)
+    parser.add_argument("--block-scale", type=float, nargs=2, default=(0.15, 0.2))
+    parser.add_argument("--block-aspect-ratio", type=float, nargs=2, default=(0.75, 1.5))
+    # -- MaskCollator
+    parser.add_argument("--config", default=None, help="src/train.py yaml config, for --kind collator")
+    args = parser.parse_args()
+
+    if args.kind == "multiblock":
+        multiblock = MultiBlock(
+            grid_size=args.grid_size,
+            block_scale=tuple(args.block_scale),
+            block_aspect_ratio=tuple(args.block_aspect_ratio),
+            device_context_masks='cpu',
+            device_predict_masks='cpu',
+        )
+        multiblock.build_mask_bank(args.path, n_groups=args.groups, group_size=args.group_size, seed=args.seed)
+    else:
+        with open(args.config, 'r') as f:
+            params = yaml.load(f, Loader=yaml.FullLoader)
+        collator = MaskCollator(
+            input_size=params['data']['crop_size'],
+            patch_size=params['mask']['patch_size'],
+            pred_mask_scale=params['mask']['pred_mask_scale'],
+            enc_mask_scale=params['mask']['enc_mask_scale'],
+            aspect_ratio=params['mask']['aspect_ratio'],
+            nenc=params['mask']['num_enc_masks'],
+            npred=params['mask']['num_pred_masks'],
+            allow_overlap=params['mask']['allow_overlap'],
+            min_keep=params['mask']['min_keep'],
+        )
+        group_size = max(args.group_size, params['data']['batch_size'])
+        collator.build_mask_bank(args.path, n_groups=args.groups, group_size=group_size, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
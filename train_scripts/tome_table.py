@@ -0,0 +1,96 @@
+import os
+import time
+
+import torch
+from tqdm import tqdm
+
+from src.models.modules import MLP
+from load_tijepa_448 import load_448, MODEL_CONFIG
+from eval_on_mvsa import encode_dataset, train_simple_linear_module
+from vqa_dataset import VQADataset
+from metrics import calculate_metrics_from_logits
+
+# Accuracy vs throughput of the frozen ViT-H with token merging (ToMe), one row per r
+DEVICE = 'cuda:0'
+R_VALUES = [0, 4, 8, 12, 16, 20]  # tokens merged after each of the 32 blocks
+
+TIJEPA_CHECKPOINT = "trains/SMALL-A100-448-10k-OBS-SCHEDULER/epoch-300.pt"
+VQA_CHECKPOINT = "trains/VQA-1732161891/epoch-30.pt"  # crosser + mlp_head fine-tuned by train_VQA.py
+VQA_MAX_VAL = 5000
+MLP_HEAD_HIDDEN_DIM = 1536
+
+MVSA_TENSOR_FOLDER = "src/datasets/mvsa-tensor"
+MVSA_SAVE_PATH = "src/datasets/mvsa-tome"  # per-r embeddings
+MVSA_EPOCHS = 5
+
+THROUGHPUT_BATCH = 32
+N_ITERS = 10
+
+
+@torch.no_grad()
+def throughput(vision_encoder):
+    """ Images / s and output tokens of the vision encoder on a 448px batch. """
+    images = torch.randn(THROUGHPUT_BATCH, 3, MODEL_CONFIG.SIZE, MODEL_CONFIG.SIZE, device=DEVICE)
+    with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+        n_tokens = vision_encoder(images).size(1)  # warmup
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(N_ITERS):
+            vision_encoder(images)
+        torch.cuda.synchronize()
+    return THROUGHPUT_BATCH * N_ITERS / (time.perf_counter() - start), n_tokens
+
+
+@torch.no_grad()
+def vqa_accuracy(text_encoder, vision_encoder, crosser, mlp_head):
+    dataset = VQADataset(batch_size=1, img_size=MODEL_CONFIG.SIZE, shuffle=False, max=None, max_val=VQA_MAX_VAL)
+    all_logits, all_answers = [], []
+    for images, questions, answers in tqdm(dataset.iter_val(), desc="VQA validation"):
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            encoded_text, text_attn_mask = text_encoder(questions)
+            cross_encoded = crosser(encoded_text, vision_encoder(images), text_attn_mask)
+            all_logits.append(mlp_head(cross_encoded.mean(dim=1)).float())
+        all_answers.append(torch.tensor(answers, dtype=torch.long))
+    return calculate_metrics_from_logits(torch.cat(all_logits), torch.cat(all_answers))['accuracy']
+
+
+def mvsa_accuracy(r):
+    """ Encode MVSA with r merged tokens per block, then fit the linear probe; validation accuracy. """
+    save_path = os.path.join(MVSA_SAVE_PATH, f"r{r}")
+    os.makedirs(save_path, exist_ok=True)
+    encode_dataset(TIJEPA_CHECKPOINT, batch_size=64, device=DEVICE, save_path=save_path, tensor_folder=MVSA_TENSOR_FOLDER, merge_r=r)
+    metrics = train_simple_linear_module(save_path, hidden_size=MODEL_CONFIG.H_EMBED_DIM, device=DEVICE, epochs=MVSA_EPOCHS)
+    return metrics['accuracy']
+
+
+def main():
+    text_encoder, vision_encoder, crosser = load_448(TIJEPA_CHECKPOINT)
+    mlp_head = MLP(
+        in_features=MODEL_CONFIG.H_EMBED_DIM,
+        hidden_features=MLP_HEAD_HIDDEN_DIM,
+        out_features=3129,
+    ).to(DEVICE)
+    saved_dict = torch.load(VQA_CHECKPOINT, map_location='cpu')
+    crosser.load_state_dict(saved_dict['crosser'])
+    mlp_head.load_state_dict(saved_dict['mlp_head'])
+    del saved_dict
+    vision_encoder.eval()
+    crosser.eval()
+    mlp_head.eval()
+
+    rows = []
+    for r in R_VALUES:
+        vision_encoder.set_token_merging(r)
+        images_per_s, n_tokens = throughput(vision_encoder)
+        vqa = vqa_accuracy(text_encoder, vision_encoder, crosser, mlp_head)
+        mvsa = mvsa_accuracy(r)
+        rows.append((r, n_tokens, images_per_s, vqa, mvsa))
+
+    base = rows[0][2]
+    print(f"{'r':>3} | {'tokens out':>10} | {'images / s':>10} | {'speedup':>7} | {'VQA val acc':>11} | {'MVSA val acc':>12}")
+    for r, n_tokens, images_per_s, vqa, mvsa in rows:
+        print(f"{r:>3} | {n_tokens:>10} | {images_per_s:>10.1f} | {images_per_s / base:>6.2f}x | {vqa:>11.4f} | {mvsa:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,52 +4,54 @@ from PIL import Image
 from torchvision import transforms
 import torch.nn.functional as F
 
+from src.transforms import images_to_uint8
+from src.datasets.preprocess import preprocess_images, save_tensor_files
+
 # Configuration
 SOURCE_DIR = 'src/datasets/train'  # Folder containing images
 IMAGE_SIZE = 224  # Replace this with the size you need
-BATCH_SIZE = 16  # How many images to process in parallel (useful for GPU)
+NUM_WORKERS = None  # Processes decoding and resizing in parallel (None: all cores)
 DEST_DIR = f'src/datasets/train-tensors-{IMAGE_SIZE}'  # Folder to save transformed tensors
+STORAGE_DTYPE = 'float32'  # 'uint8' saves raw pixels (4x smaller), loaders convert batches back with images_to_float
 
 # Create the transformation pipeline
 transform = transforms.Compose([
     transforms.ToTensor()  # Convert PIL image to PyTorch tensor
 ])
 
-# Ensure the destination folder exists
-os.makedirs(DEST_DIR, exist_ok=True)
-
-# Function to load and transform an image, then save it as a .pt file
-def process_and_save_image(image_path, save_path, device):
+# Function to load and transform an image (runs in the worker processes)
+def process_image(image_path):
     # Open the image
     image = Image.open(image_path).convert("RGB")
-    
-    # Apply the transformation (on CPU)
+
+    # Apply the transformation
     tensor = transform(image).unsqueeze(0)  # Add batch dimension
-    
-    # Move tensor to GPU (or CUDA-enabled device)
-    tensor = tensor.to(device)
 
-    # Optionally, resize the image on GPU (if needed)
+    # Resize the image
     tensor = F.interpolate(tensor, size=(IMAGE_SIZE, IMAGE_SIZE))
-    
-    # Remove batch dimension and save tensor as .pt
-    torch.save(tensor.squeeze(0), save_path)
-
-# Check if GPU is available, otherwise fallback to CPU
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
-
-# Get a list of image files in the source directory
-image_files = [f for f in os.listdir(SOURCE_DIR) if f.endswith(('.jpg', '.jpeg', '.png'))]
-
-# Process the images in batches
-for i, image_file in enumerate(image_files[:1000]):
-    image_path = os.path.join(SOURCE_DIR, image_file)
-    save_path = os.path.join(DEST_DIR, os.path.splitext(image_file)[0] + '.pt')
-    
-    print(f"Processing {image_file} ({i+1}/{len(image_files)})")
-    
-    # Process and save the image tensor
-    process_and_save_image(image_path, save_path, device)
-
-print("All images processed and saved as tensors.")
+    if STORAGE_DTYPE == 'uint8':
+        tensor = images_to_uint8(tensor)
+
+    # Remove batch dimension
+    return tensor.squeeze(0)
+
+def main():
+    # Ensure the destination folder exists
+    os.makedirs(DEST_DIR, exist_ok=True)
+
+    # Get a list of image files in the source directory
+    image_files = [f for f in os.listdir(SOURCE_DIR) if f.endswith(('.jpg', '.jpeg', '.png'))]
+
+    # Process the images across all cores, resuming from the manifest
+    preprocess_images(
+        items=[(os.path.splitext(f)[0], os.path.join(SOURCE_DIR, f)) for f in image_files[:1000]],
+        process_fn=process_image,
+        write_fn=save_tensor_files(DEST_DIR),
+        manifest_path=os.path.join(DEST_DIR, 'manifest.txt'),
+        num_workers=NUM_WORKERS,
+    )
+
+    print("All images processed and saved as tensors.")
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,24 @@ from PIL import Image
 import json
 from tqdm import tqdm
 
+from src.datasets.image_shards import ImageShardStore
+from src.transforms import images_to_float
+
+
+def image_grouped_batches(rows, indices, batch_size, shuffle=True):
+    """
+    Batches of `indices` where all questions of an image are adjacent: images
+    are shuffled as a whole, then the flattened order is cut every `batch_size`.
+    """
+    groups = {}
+    for i in indices:
+        groups.setdefault(rows[i]['image_id'], []).append(i)
+    groups = list(groups.values())
+    if shuffle:
+        random.shuffle(groups)
+    order = [i for group in groups for i in group]
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
 class VQADataset(Dataset):
     def __init__(
         self,
@@ -35,6 +53,10 @@ class VQADataset(Dataset):
             ]
         ), 
         collator=None,
+        shard_folder=None,
+        storage_dtype='float32',
+        normalization=None,
+        group_images=False,
     ):
         self.batch_size = batch_size
         self.img_size = img_size
@@ -42,6 +64,11 @@ class VQADataset(Dataset):
         self.val_batch_size = val_batch_size
         
         self.tensor_folder = f"vqa_dataset/vqa_tensor_{img_size}" 
+        # Images written by `python vqa_dataset/to_tensor.py <folder> [start] --shard-folder <shard_folder>`, keyed by 12-digit image id
+        self.shard_store = ImageShardStore(shard_folder, img_size, dtype=storage_dtype) if shard_folder is not None else None
+        self.normalization = normalization # Optional ((mean), (std)), applied per batch after uint8 -> float
+        self.batch_sampler = None # Optional LengthBucketBatchSampler over train indices, replaces the shuffled batches
+        self.group_images = group_images # Batch questions by image and yield each image once, plus a question -> image index
         
         with open(os.path.join("vqa_dataset", "combined_data_train.json"), 'r') as f:
             self.train_dict = json.load(f)
@@ -106,15 +133,49 @@ class VQADataset(Dataset):
         self.max_val = max_val
         self.collator = collator
 
-    def get_V(self, idx, split="train"):
-        """ Load tensorized image from disk. """
+    def load_V(self, idx, split="train"):
+        """ Load tensorized image from disk, as stored (float32 or uint8). """
         set = self.train_dict if split == "train" else self.val_dict if split == "val" else self.test_dict
+        if self.shard_store is not None:
+            return self.shard_store.get_one(f"{set[idx]['image_id']:012d}").to(self.device)
         tensor_path = os.path.join(
             self.tensor_folder, 
             f"{set[idx]['image_id']:012d}.pt"  # Format as 12-digit number with leading zeros
         )
         return torch.load(tensor_path, map_location=self.device)
 
+    def get_V(self, idx, split="train"):
+        """ Load tensorized image from disk as a float model input. """
+        return images_to_float(self.load_V(idx, split), self.normalization)
+
+    def get_Vs(self, batch_indices, split="train"):
+        """ Load a batch of tensorized images, with a single gather when a shard store is used. """
+        if self.shard_store is not None:
+            set = self.train_dict if split == "train" else self.val_dict if split == "val" else self.test_dict
+            images = self.shard_store.get([f"{set[i]['image_id']:012d}" for i in batch_indices]).to(self.device)
+        else:
+            images = torch.stack([self.load_V(i, split) for i in batch_indices])
+        return images_to_float(images, self.normalization)
+
+    def get_grouped_Vs(self, batch_indices, split="train"):
+        """
+        Load every distinct image of a batch once. Returns the (U, C, H, W)
+        images and, per question, the row of its image as a LongTensor.
+        """
+        set = self.train_dict if split == "train" else self.val_dict if split == "val" else self.test_dict
+        image_ids = [set[i]['image_id'] for i in batch_indices]
+        first = {}
+        for i, image_id in zip(batch_indices, image_ids):
+            first.setdefault(image_id, i)
+        row = {image_id: j for j, image_id in enumerate(first)}
+
+        if self.shard_store is not None:
+            images = self.shard_store.get([f"{image_id:012d}" for image_id in first]).to(self.device)
+        else:
+            images = torch.stack([self.load_V(i, split) for i in first.values()])
+        image_index = torch.tensor([row[image_id] for image_id in image_ids], dtype=torch.long, device=self.device)
+        return images_to_float(images, self.normalization), image_index
+
     def get_Q(self, idx, split="train"):
         """ Get a random caption for a given image. """
         set = self.train_dict if split == "train" else self.val_dict if split == "val" else self.test_dict
@@ -132,34 +193,82 @@ class VQADataset(Dataset):
         """ Number of batches in the dataset. """
         return (len(self.train_dict) + self.batch_size - 1) // self.batch_size
 
+    def num_samples(self):
+        """ Number of training questions, the length of the map-style view. """
+        return len(self.train_dict)
+
+    def __getitem__(self, idx):
+        """ One (image, question, answer id) training sample on the CPU, batched by default_collate. """
+        image_id = self.train_dict[idx]['image_id']
+        if self.shard_store is not None:
+            image = self.shard_store.get_one(f"{image_id:012d}")
+        else:
+            image = torch.load(os.path.join(self.tensor_folder, f"{image_id:012d}.pt"), map_location='cpu')
+        return image, self.get_Q(idx), self.mapper[self.get_A(idx)]
+
+    def to_device(self, batch, non_blocking=False):
+        """ Move a collated batch to the device and turn stored images into float model inputs. """
+        images, questions, answers = batch
+        images = images_to_float(images.to(self.device, non_blocking=non_blocking), self.normalization)
+        return images, questions, answers
+
+    def text_lengths(self, token_store):
+        """ Token count of every training question, for length-bucketed batching. """
+        return token_store.lengths([row['questions'] for row in self.train_dict])
+
     def __iter__(self):
-        """ Iterator to yield batches of images and captions. """
-        random.shuffle(self.train_dict)
-            
-        self.current_idx = 0
-        while self.current_idx < len(self.train_dict):
-            batch_indices = range(self.current_idx, min(self.current_idx + self.batch_size, len(self.train_dict)))
-            images = [self.get_V(i) for i in batch_indices]
+        """
+        Iterator to yield batches of images and captions. With `group_images`,
+        yields (unique images, questions, answers, image_index) instead.
+        """
+        if self.group_images:
+            for batch_indices in image_grouped_batches(self.train_dict, range(len(self.train_dict)), self.batch_size):
+                images, image_index = self.get_grouped_Vs(batch_indices)
+                questions = [self.get_Q(i) for i in batch_indices]
+                answers = [self.get_A(i) for i in batch_indices]
+
+                yield images, questions, [self.mapper[ans] for ans in answers], image_index
+            return
+
+        if self.batch_sampler is not None:
+            # Indices of similar question length, shuffled by the sampler itself
+            batches = self.batch_sampler.batches()
+        else:
+            random.shuffle(self.train_dict)
+            batches = [
+                range(start, min(start + self.batch_size, len(self.train_dict)))
+                for start in range(0, len(self.train_dict), self.batch_size)
+            ]
+
+        for batch_indices in batches:
+            images = self.get_Vs(batch_indices)
             questions = [self.get_Q(i) for i in batch_indices]
             answers = [self.get_A(i) for i in batch_indices]
 
-            self.current_idx += self.batch_size
-
-            yield torch.stack(images), questions, [self.mapper[ans] for ans in answers]
+            yield images, questions, [self.mapper[ans] for ans in answers]
 
     def iter_val(self):
         """ Iterator to yield batches of images and captions. """
+        if self.group_images:
+            batches = image_grouped_batches(self.val_dict, range(min(self.max_val, len(self.val_dict))), self.val_batch_size, shuffle=False)
+            for batch_indices in batches:
+                images, image_index = self.get_grouped_Vs(batch_indices, 'val')
+                questions = [self.get_Q(i, 'val') for i in batch_indices]
+                answers = [self.get_A(i, 'val') for i in batch_indices]
+
+                yield images, questions, [self.mapper[ans] for ans in answers], image_index
+            return
             
         self.current_idx = 0
         while self.current_idx < self.max_val:
             batch_indices = range(self.current_idx, min(self.current_idx + self.val_batch_size, self.max_val))
-            images = [self.get_V(i, 'val') for i in batch_indices]
+            images = self.get_Vs(batch_indices, 'val')
             questions = [self.get_Q(i, 'val') for i in batch_indices]
             answers = [self.get_A(i, 'val') for i in batch_indices]
 
             self.current_idx += self.val_batch_size
 
-            yield torch.stack(images), questions, [self.mapper[ans] for ans in answers]
+            yield images, questions, [self.mapper[ans] for ans in answers]
 
     def iter_test(self):
         """ Iterator to yield batches of images and captions. """
@@ -167,13 +276,13 @@ class VQADataset(Dataset):
         self.current_idx = 0
         while self.current_idx < len(self.test_dict):
             batch_indices = range(self.current_idx, min(self.current_idx + self.val_batch_size, len(self.test_dict)))
-            images = [self.get_V(i, 'val') for i in batch_indices]
+            images = self.get_Vs(batch_indices, 'val')
             questions = [self.get_Q(i, 'val') for i in batch_indices]
             ids = [self.get_ID(i) for i in batch_indices]
             
             self.current_idx += self.val_batch_size
 
-            yield torch.stack(images), questions, ids
+            yield images, questions, ids
 
             
 # collator = MaskCollator()
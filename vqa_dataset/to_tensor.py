@@ -1,66 +1,74 @@
 import os
 import sys
-from PIL import Image
-import torch
-import torchvision.transforms.functional as F
+import argparse
+from functools import partial
 from torchvision import transforms
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.datasets.image_shards import ImageShardStore
+from src.datasets.preprocess import load_image_tensor, preprocess_images, save_tensor_files, save_to_shards
+
 # Folder to save tensor files
 tensor_folder = "vqa_tensor_448"
 
 # Transformation to apply to each image
 transform = transforms.Compose([transforms.ToTensor()])
 
-# Function to process and save an image as a tensor
-def process_and_save_image(image_path, save_folder=tensor_folder, transform=transform):
-    # Derive the save path
-    image_file = os.path.basename(image_path)
-    save_path = os.path.join(save_folder, os.path.splitext(image_file)[0][-12:] + ".pt")
-
-    # Skip if the tensor file already exists
-    if os.path.exists(save_path):
-        return
+# Key of an image: its 12-digit COCO image id
+def image_key(image_path):
+    return os.path.splitext(os.path.basename(image_path))[0][-12:]
 
-    # Open, transform, and resize the image
-    image = Image.open(image_path).convert("RGB")
-    tensor = transform(image).unsqueeze(0)  # Add batch dimension
-    tensor = F.resize(tensor, (448, 448))  # Resize
-    torch.save(tensor.squeeze(0), save_path)  # Save without batch dimension
-    
 # Main function
 def main():
-    # Get folder path and start index from command-line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python to_tensor.py <folder_path> <start_index>")
-        return
-
-    folder_path = sys.argv[1]
-    start_index = int(sys.argv[2])
-    batch_size = 100000  # Number of images to process in this batch
-    final_index = start_index + batch_size
+    parser = argparse.ArgumentParser(description="Tensorize VQA/COCO images in parallel, resumable through a manifest.")
+    parser.add_argument("folder_path")
+    parser.add_argument("start_index", nargs="?", type=int, default=0)
+    parser.add_argument("--count", type=int, default=None, help="Number of images to process (default: all remaining)")
+    parser.add_argument("--shard-folder", default=None, help="Write into an ImageShardStore instead of one .pt per image")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "uint8"])
+    parser.add_argument("--workers", type=int, default=None, help="Pool size (default: all cores)")
+    args = parser.parse_args()
 
     # Get all image file paths
     image_files = sorted(
-        [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith((".png", ".jpg", ".jpeg"))]
+        [os.path.join(args.folder_path, f) for f in os.listdir(args.folder_path) if f.lower().endswith((".png", ".jpg", ".jpeg"))]
     )
 
     # Determine the range to process
     total_images = len(image_files)
-    
-    if start_index >= total_images:
-        print(f"Start index {start_index} exceeds the number of images ({total_images}).")
+
+    if args.start_index >= total_images:
+        print(f"Start index {args.start_index} exceeds the number of images ({total_images}).")
         return
 
-    end_index = min(final_index, total_images)  # Ensure we don't exceed the folder size
+    end_index = total_images if args.count is None else min(args.start_index + args.count, total_images)
+
+    print(f"Processing images {args.start_index} to {end_index} of {total_images}...")
 
-    print(f"Processing images {start_index} to {end_index} of {total_images}...")
+    items = [(image_key(p), p) for p in image_files[args.start_index:end_index]]
+    process_fn = partial(load_image_tensor, transform=transform, img_size=448, storage_dtype=args.dtype)
 
-    # Process images in the specified range
-    for idx in range(start_index, end_index):
-        real_idx = idx + 1
-        image_path = image_files[idx]
-        process_and_save_image(image_path)
-        print(f"\rProcessed {real_idx}/{total_images} {image_path}", end='')
+    if args.shard_folder is not None:
+        store = ImageShardStore(args.shard_folder, 448, dtype=args.dtype)
+        preprocess_images(
+            items, process_fn, save_to_shards(store),
+            manifest_path=os.path.join(args.shard_folder, "manifest.txt"),
+            done=store.keys(),
+            num_workers=args.workers,
+            commit_fn=store.save_index, # index.json rewritten every 32 chunks, not per chunk
+            commit_every=32,
+        )
+    else:
+        os.makedirs(tensor_folder, exist_ok=True)
+        manifest_path = os.path.join(tensor_folder, "manifest.txt")
+        # Folders written before manifests existed: trust the .pt files already there
+        done = [] if os.path.exists(manifest_path) else [os.path.splitext(f)[0] for f in os.listdir(tensor_folder)]
+        preprocess_images(
+            items, process_fn, save_tensor_files(tensor_folder),
+            manifest_path=manifest_path,
+            done=done,
+            num_workers=args.workers,
+        )
 
     print("Processing complete.")
 